@@ -1,11 +1,47 @@
 from utils.llm_provider import LLMProvider
+from utils.metrics import current_tags, instrumented
+from utils.context_builder import ContextBuilder, shared_context_builder
+from utils.coherence import split_paragraphs
+from utils.edit_script import (
+    EditScriptError, RefinementLog, RefinementReport, apply_edits, numbered_paragraphs, shared_refinement_log
+)
+from utils.structured_output import StructuredOutputError
+from utils.tokens import estimate_tokens
 from models.story_context import StoryContext
+from models.schemas import EditScript
+from dataclasses import asdict
+from typing import Iterator, AsyncIterator, List, Optional
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# "rewrite" regenerates the whole chapter; "edits" asks for paragraph edits
+# and applies them locally, rewriting only when the script is unusable
+REFINE_MODES = ("rewrite", "edits")
 
 class ChapterRefinerAgent:
-    def __init__(self, llm_provider: LLMProvider):
+    def __init__(
+        self,
+        llm_provider: LLMProvider,
+        context_builder: Optional[ContextBuilder] = None,
+        mode: str = "rewrite",
+        refinement_log: Optional[RefinementLog] = None
+    ):
+        if mode not in REFINE_MODES:
+            raise ValueError(f"Unknown refine mode {mode!r}, expected one of {', '.join(REFINE_MODES)}")
         self.llm = llm_provider
+        self.context_builder = context_builder or shared_context_builder
+        self.mode = mode
+        self.refinement_log = refinement_log or shared_refinement_log
+
+    def report(self, story_id: Optional[str] = None) -> List[RefinementReport]:
+        """
+        Refinement reports of a story's chapters, in chapter order.
+        """
+        return self.refinement_log.reports(story_id)
 
+    @instrumented
     def refine_chapter(
         self,
         story_context: StoryContext,
@@ -16,9 +52,188 @@ class ChapterRefinerAgent:
         """
         Refines a chapter by removing redundant or repetitive lines and enhancing articulation.
         """
-        context_injection = self._prepare_context_injection(
+        if self.mode == "edits":
+            paragraphs = split_paragraphs(chapter_content)
+            messages = self._build_edit_messages(story_context, chapter_info, paragraphs, scene_layout)
+            try:
+                script = self.llm.generate_structured(messages, EditScript)
+                return self._apply(chapter_info, paragraphs, script)
+            except (StructuredOutputError, EditScriptError) as e:
+                logger.warning("Edit script for chapter %s unusable (%s), rewriting it instead", chapter_info[0], e)
+                script_tokens = _script_tokens(e)
+        messages = self._build_refine_messages(story_context, chapter_info, chapter_content, scene_layout)
+        refined = self.llm.generate_completion(messages)
+        return self._rewritten(chapter_info, refined, script_tokens if self.mode == "edits" else None)
+
+    @instrumented
+    async def arefine_chapter(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        chapter_content: str,
+        scene_layout: str
+    ) -> str:
+        """
+        Async variant of refine_chapter, requires an AsyncLLMProvider.
+        """
+        if self.mode == "edits":
+            paragraphs = split_paragraphs(chapter_content)
+            messages = self._build_edit_messages(story_context, chapter_info, paragraphs, scene_layout)
+            try:
+                script = await self.llm.agenerate_structured(messages, EditScript)
+                return self._apply(chapter_info, paragraphs, script)
+            except (StructuredOutputError, EditScriptError) as e:
+                logger.warning("Edit script for chapter %s unusable (%s), rewriting it instead", chapter_info[0], e)
+                script_tokens = _script_tokens(e)
+        messages = self._build_refine_messages(story_context, chapter_info, chapter_content, scene_layout)
+        refined = await self.llm.agenerate_completion(messages)
+        return self._rewritten(chapter_info, refined, script_tokens if self.mode == "edits" else None)
+
+    @instrumented
+    def stream_refine_chapter(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        chapter_content: str,
+        scene_layout: str
+    ) -> Iterator[str]:
+        """
+        Streaming variant of refine_chapter, yields text deltas as they arrive.
+        An edit script is applied whole, so in "edits" mode the chapter comes
+        as one piece.
+        """
+        if self.mode == "edits":
+            return self._refined_once(story_context, chapter_info, chapter_content, scene_layout)
+        messages = self._build_refine_messages(story_context, chapter_info, chapter_content, scene_layout)
+        return self._reported_stream(chapter_info, self.llm.stream_completion(messages))
+
+    @instrumented
+    def astream_refine_chapter(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        chapter_content: str,
+        scene_layout: str
+    ) -> AsyncIterator[str]:
+        if self.mode == "edits":
+            return self._arefined_once(story_context, chapter_info, chapter_content, scene_layout)
+        messages = self._build_refine_messages(story_context, chapter_info, chapter_content, scene_layout)
+        return self._areported_stream(chapter_info, self.llm.astream_completion(messages))
+
+    def _refined_once(self, *args) -> Iterator[str]:
+        yield self.refine_chapter(*args)
+
+    async def _arefined_once(self, *args) -> AsyncIterator[str]:
+        yield await self.arefine_chapter(*args)
+
+    def _reported_stream(self, chapter_info, stream: Iterator[str]) -> Iterator[str]:
+        parts = []
+        for delta in stream:
+            parts.append(delta)
+            yield delta
+        self._rewritten(chapter_info, "".join(parts))
+
+    async def _areported_stream(self, chapter_info, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        parts = []
+        async for delta in stream:
+            parts.append(delta)
+            yield delta
+        self._rewritten(chapter_info, "".join(parts))
+
+    def _apply(self, chapter_info, paragraphs: List[str], script: EditScript) -> str:
+        response = json.dumps(asdict(script))
+        try:
+            refined = apply_edits(paragraphs, script)
+        except EditScriptError as e:
+            e.response = response
+            raise
+        self._record(RefinementReport(
+            chapter=chapter_info[0],
+            mode="edits",
+            edits=len(script.edits),
+            output_tokens=estimate_tokens(response),
+            rewrite_tokens=estimate_tokens(refined)
+        ))
+        return refined
+
+    def _rewritten(self, chapter_info, refined: str, script_tokens: Optional[int] = None) -> str:
+        rewrite_tokens = estimate_tokens(refined)
+        self._record(RefinementReport(
+            chapter=chapter_info[0],
+            mode="rewrite" if script_tokens is None else "fallback",
+            output_tokens=rewrite_tokens + (script_tokens or 0),
+            rewrite_tokens=rewrite_tokens
+        ))
+        return refined
+
+    def _record(self, report: RefinementReport):
+        self.refinement_log.record(current_tags().get("story_id"), report)
+
+    def _build_edit_messages(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        paragraphs: List[str],
+        scene_layout: str
+    ) -> list:
+        context_injection = self.context_builder.build(
+            story_context,
+            f"Chapter {chapter_info[0]}",
+            model=self.llm.router.route().model
+        )
+
+        return [
+            {
+                "role": "system",
+                "content": """
+                You are a skilled editor specializing in refining narrative content.
+                You edit chapters paragraph by paragraph and return only your edits, never the whole chapter.
+                Your edits should:
+                - Eliminate redundancy and repetition.
+                - Improve articulation and flow.
+                - Ensure consistency with the established story context.
+                - Maintain the story's tone and voice.
+                Do not alter the plot or character arcs. Leave paragraphs that read well untouched.
+
+                Respond with only a JSON object of this form:
+                {"edits": [
+                    {"op": "replace", "paragraphs": [3], "text": "the rewritten paragraph"},
+                    {"op": "delete", "paragraphs": [7]},
+                    {"op": "merge", "paragraphs": [9, 10], "text": "one paragraph replacing 9 and 10"}
+                ]}
+                Paragraphs are referred to by their [n] numbers. A paragraph may appear in one edit only,
+                merges cover consecutive paragraphs. Return {"edits": []} if nothing needs changing.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"""This is chapter {chapter_info[0]} of {chapter_info[1]} in the series.
+                The story genre is: {story_context.genre}
+
+                These are the numbered paragraphs of the raw chapter:
+                ---
+                {numbered_paragraphs(paragraphs)}
+                ---
+
+                The context of the story is:
+                {context_injection}
+
+                This is the scene layout of the chapter, the edited chapter must still follow it: {scene_layout}
+                """
+            }
+        ]
+
+    def _build_refine_messages(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        chapter_content: str,
+        scene_layout: str
+    ) -> list:
+        context_injection = self.context_builder.build(
             story_context, 
-            f"Chapter {chapter_info[0]}"
+            f"Chapter {chapter_info[0]}",
+            model=self.llm.router.route().model
         )
 
         messages = [
@@ -60,23 +275,8 @@ class ChapterRefinerAgent:
             }
         ]
 
-        return self.llm.generate_completion(messages)
+        return messages
 
-    def _prepare_context_injection(self, story_context: StoryContext, chapter_title: str) -> str:
-        """
-        Prepare a detailed context injection for chapter refinement.
-        """
-        if isinstance(story_context, dict):
-            story_context = StoryContext(**story_context)
-
-        context_details = {
-            "Story Title": story_context.title,
-            "Genre": story_context.genre,
-            "Central Theme": story_context.central_theme,
-            "Chapter Title": chapter_title,
-            "Protagonist Details": story_context.protagonist,
-            "Active Plot Threads": story_context.active_plot_threads,
-            "Unresolved Tensions": story_context.unresolved_tensions
-        }
-
-        return json.dumps(context_details, indent=2)
\ No newline at end of file
+def _script_tokens(error: Exception) -> int:
+    # The unusable script's output was paid for too
+    return estimate_tokens(error.response)
@@ -1,25 +1,292 @@
-from utils.llm_provider import LLMProvider
+from utils.llm_provider import LLMProvider, LLMProviderError
+from utils.metrics import instrumented
+from utils.context_builder import ContextBuilder, shared_context_builder
+from utils.retrieval import RetrievalIndex
+from utils.coherence import split_paragraphs
+from utils.scenes import Scene, parse_scenes, MIN_SCENES, MAX_SCENES
+from utils.structured_output import StructuredOutputError
 from models.story_context import StoryContext
-import json
+from models.schemas import SceneTransitions
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, AsyncIterator, List, Optional, Tuple
+import asyncio
+import contextvars
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+# "single" writes the chapter in one completion; "scenes" writes every scene
+# of the layout at once and joins them with a short transition pass
+DRAFT_MODES = ("single", "scenes")
+# Tokens of a whole chapter (about 2000-3000 words), shared out between its scenes
+CHAPTER_TOKENS = 3500
+# Headroom over a scene's share, so a scene is not cut off mid-sentence
+SCENE_TOKEN_HEADROOM = 1.5
+TRANSITION_MAX_TOKENS = 600
 
 class ChapterWritingAgent:
-    def __init__(self, llm_provider: LLMProvider):
+    def __init__(
+        self,
+        llm_provider: LLMProvider,
+        context_builder: Optional[ContextBuilder] = None,
+        mode: str = "single"
+    ):
+        if mode not in DRAFT_MODES:
+            raise ValueError(f"Unknown draft mode {mode!r}, expected one of {', '.join(DRAFT_MODES)}")
         self.llm = llm_provider
+        self.context_builder = context_builder or shared_context_builder
+        self.mode = mode
     
+    @instrumented
     def generate_chapter(
         self, 
         story_context: StoryContext, 
         chapter_info: str, 
         scene_layout: str,
         previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
     ) -> str:        
         """
         Generate a chapter with narrative continuity
         """
-        context_injection = self._prepare_context_injection(
+        scenes = self._scene_plan(scene_layout)
+        if scenes:
+            return self._write_scenes(story_context, chapter_info, scenes, previous_chapter_summary, retrieval)
+        messages = self._build_chapter_messages(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        return self.llm.generate_completion(messages)
+
+    @instrumented
+    async def agenerate_chapter(
+        self, 
+        story_context: StoryContext, 
+        chapter_info: str, 
+        scene_layout: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> str:
+        """
+        Async variant of generate_chapter, requires an AsyncLLMProvider.
+        """
+        scenes = self._scene_plan(scene_layout)
+        if scenes:
+            return await self._awrite_scenes(story_context, chapter_info, scenes, previous_chapter_summary, retrieval)
+        messages = self._build_chapter_messages(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        return await self.llm.agenerate_completion(messages)
+
+    @instrumented
+    def stream_chapter(
+        self, 
+        story_context: StoryContext, 
+        chapter_info: str, 
+        scene_layout: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> Iterator[str]:
+        """
+        Streaming variant of generate_chapter, yields text deltas as they arrive.
+        Scenes written in parallel are only joined at the end, so in "scenes"
+        mode the chapter comes as one piece.
+        """
+        if self._scene_plan(scene_layout):
+            return self._written_once(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        messages = self._build_chapter_messages(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        return self.llm.stream_completion(messages)
+
+    @instrumented
+    def astream_chapter(
+        self, 
+        story_context: StoryContext, 
+        chapter_info: str, 
+        scene_layout: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> AsyncIterator[str]:
+        if self._scene_plan(scene_layout):
+            return self._awritten_once(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        messages = self._build_chapter_messages(story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval)
+        return self.llm.astream_completion(messages)
+
+    def _written_once(self, *args) -> Iterator[str]:
+        yield self.generate_chapter(*args)
+
+    async def _awritten_once(self, *args) -> AsyncIterator[str]:
+        yield await self.agenerate_chapter(*args)
+
+    def _scene_plan(self, scene_layout: str) -> List[Scene]:
+        """
+        The layout's scenes when they are to be written in parallel, else [].
+        """
+        if self.mode != "scenes":
+            return []
+        scenes = parse_scenes(scene_layout)
+        return scenes if MIN_SCENES <= len(scenes) <= MAX_SCENES else []
+
+    def _write_scenes(self, story_context, chapter_info, scenes, previous_chapter_summary, retrieval) -> str:
+        background = self._background(story_context, chapter_info, "\n".join(scene.handoff for scene in scenes),
+                                      previous_chapter_summary, retrieval)
+        max_tokens = _scene_max_tokens(scenes)
+        with ThreadPoolExecutor(max_workers=len(scenes)) as pool:
+            # Each call runs in a copy of our context, so metric tags carry over
+            futures = [
+                pool.submit(
+                    contextvars.copy_context().run, self.llm.generate_completion,
+                    self._build_scene_messages(story_context, chapter_info, scenes, scene, background),
+                    max_tokens=max_tokens
+                )
+                for scene in scenes
+            ]
+            drafts = [future.result() for future in futures]
+        try:
+            transitions = self.llm.generate_structured(
+                self._build_transition_messages(story_context, scenes, drafts), SceneTransitions,
+                max_tokens=TRANSITION_MAX_TOKENS
+            )
+        except (StructuredOutputError, LLMProviderError) as e:
+            logger.warning("Transitions for chapter %s failed (%s), joining its scenes as they are", chapter_info[0], e)
+            transitions = SceneTransitions()
+        return _stitch(drafts, transitions)
+
+    async def _awrite_scenes(self, story_context, chapter_info, scenes, previous_chapter_summary, retrieval) -> str:
+        background = self._background(story_context, chapter_info, "\n".join(scene.handoff for scene in scenes),
+                                      previous_chapter_summary, retrieval)
+        max_tokens = _scene_max_tokens(scenes)
+        drafts = await asyncio.gather(*(
+            self.llm.agenerate_completion(
+                self._build_scene_messages(story_context, chapter_info, scenes, scene, background),
+                max_tokens=max_tokens
+            )
+            for scene in scenes
+        ))
+        try:
+            transitions = await self.llm.agenerate_structured(
+                self._build_transition_messages(story_context, scenes, drafts), SceneTransitions,
+                max_tokens=TRANSITION_MAX_TOKENS
+            )
+        except (StructuredOutputError, LLMProviderError) as e:
+            logger.warning("Transitions for chapter %s failed (%s), joining its scenes as they are", chapter_info[0], e)
+            transitions = SceneTransitions()
+        return _stitch(list(drafts), transitions)
+
+    def _background(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        scene_layout: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> Tuple[str, str]:
+        """
+        Story context and earlier passages for a chapter's prompt.
+        """
+        context_injection = self.context_builder.build(
             story_context, 
             f"Chapter {chapter_info[0]}", 
-            previous_chapter_summary
+            previous_chapter_summary,
+            model=self.llm.router.route().model
+        )
+        earlier_passages = ""
+        if retrieval is not None:
+            # The layout names who and what the chapter is about, look those up
+            query = " ".join([
+                str(story_context.protagonist.get("name", "")),
+                str(story_context.antagonist.get("name", "")),
+                scene_layout
+            ])
+            passages = retrieval.relevant_passages(query, before_chapter=chapter_info[0])
+            if passages:
+                earlier_passages = f"Passages from earlier chapters, keep names, places and facts consistent with them but do not repeat them : {passages}"
+        return context_injection, earlier_passages
+
+    def _build_scene_messages(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        scenes: List[Scene],
+        scene: Scene,
+        background: Tuple[str, str]
+    ) -> list:
+        context_injection, earlier_passages = background
+        words = 2500 // len(scenes)
+        if scene.number > 1:
+            before = f"The scene before this one, written by someone else (do not write it): {scenes[scene.number - 2].handoff}"
+        else:
+            before = "This scene opens the chapter."
+        if scene.number < len(scenes):
+            after = f"The scene after this one, written by someone else (do not write it, leave it room): {scenes[scene.number].handoff}"
+        elif chapter_info[0] == chapter_info[1]:
+            after = "This scene closes the final chapter, give the story a reasonable conclusion that still leaves the reader something to ponder."
+        else:
+            after = "This scene closes the chapter, end it in a way that pulls the reader into the next one."
+
+        return [
+            {
+                "role": "system",
+                "content": f"""
+                You are a master storyteller writing one scene of a chapter. The other scenes of the
+                chapter are being written at the same time by other writers from the same outline.
+                Key guidelines:
+                - Maintain narrative consistency
+                - Write only your scene, starting inside it and stopping where it ends
+                - Make it approximately {words} words of continuous prose, no headings or scene labels
+                - Show character growth through drama, dialogue and emotion
+                """
+            },
+            {
+                "role": "user",
+                "content": f"""This scene is part of chapter number {chapter_info[0]} in a series of {chapter_info[1]} chapters.
+                            Make sure to add a lot of drama, fights, and emotions based on the genre of the story which is : {story_context.genre}
+                            This is the entire context of the plot up untill now : {context_injection}
+                            {earlier_passages}
+                            This context is only for you to understand and continue writing the story, dont include things like tension and charector details seperately in the scene.
+                            The chapter's scenes are:
+                            {chr(10).join(f"{other.number}. {other.title or other.handoff}" for other in scenes)}
+                            {before}
+                            {after}
+                            Write scene {scene.number} now, {scene.title} : {scene.outline}
+                            It has to be strictly like a story and not points. It should be how stories are written in books.
+                            """
+            }
+        ]
+
+    def _build_transition_messages(self, story_context: StoryContext, scenes: List[Scene], drafts: List[str]) -> list:
+        seams = "\n\n".join(
+            f"After scene {number}:\nEnd of scene {number}: {_last_paragraph(drafts[number - 1])}\n"
+            f"Start of scene {number + 1}: {_first_paragraph(drafts[number])}"
+            for number in range(1, len(drafts))
+        )
+        return [
+            {
+                "role": "system",
+                "content": """
+                You are an editor joining scenes that were written separately into one chapter.
+                For every seam between two scenes write a bridge of one to three sentences that carries the reader
+                from the end of one scene into the start of the next: time passing, a change of place, a shift of view.
+                Match the story's tone. Use an empty text where the scenes already flow into each other.
+
+                Respond with only a JSON object of this form:
+                {"transitions": [{"after_scene": 1, "text": "the bridge"}]}
+                """
+            },
+            {
+                "role": "user",
+                "content": f"""The story genre is: {story_context.genre}
+
+                {seams}
+                """
+            }
+        ]
+
+    def _build_chapter_messages(
+        self, 
+        story_context: StoryContext, 
+        chapter_info: str, 
+        scene_layout: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> list:
+        context_injection, earlier_passages = self._background(
+            story_context, chapter_info, scene_layout, previous_chapter_summary, retrieval
         )
         
         messages = [
@@ -50,6 +317,7 @@ class ChapterWritingAgent:
                             You have to end the storyline if it is the last chapter, make sure to give a reasonable conclusion to the story, but with hints that will leave the reader to ponder more and think about other scenarios
                             Make sure to add a lot of drama, fights, and emotions based on the genre of the story which is : {story_context.genre}
                             This is the entire context of the plot up untill now : {context_injection}
+                            {earlier_passages}
                             This context is only for you to understand and continue writing the story, dont include things like tension and charector details seperately in the chapter content.
                             This is the scene layout of the chapter, adhere to this layout while generating the chapter : {scene_layout}
                             Write the chapter in a continuous flow and dont mention the scenes as they were presented in the scene layout, the scenes are just to guide you towards how to write the chapter
@@ -59,31 +327,31 @@ class ChapterWritingAgent:
             }
         ]
         
-        return self.llm.generate_completion(messages)
-    
-    def _prepare_context_injection(
-        self, 
-        story_context: StoryContext, 
-        chapter_title: str, 
-        previous_chapter_summary: str = None
-    ) -> str:
-        """
-        Prepare a detailed context injection for chapter generation
-        """
-        if isinstance(story_context, dict):
-            story_context = StoryContext(**story_context)
-
-        context_details = {
-            "Story Title": story_context.title,
-            "Genre": story_context.genre,
-            "Central Theme": story_context.central_theme,
-            "Chapter Title": chapter_title,
-            "Protagonist Details": story_context.protagonist,
-            "Active Plot Threads": story_context.active_plot_threads,
-            "Unresolved Tensions": story_context.unresolved_tensions
-        }
-        
-        if previous_chapter_summary:
-            context_details["Previous Chapter Summary"] = previous_chapter_summary
-        
-        return json.dumps(context_details, indent=2)
\ No newline at end of file
+        return messages
+
+def _scene_max_tokens(scenes: List[Scene]) -> int:
+    return math.ceil(CHAPTER_TOKENS / len(scenes) * SCENE_TOKEN_HEADROOM)
+
+def _first_paragraph(text: str) -> str:
+    paragraphs = split_paragraphs(text)
+    return paragraphs[0] if paragraphs else ""
+
+def _last_paragraph(text: str) -> str:
+    paragraphs = split_paragraphs(text)
+    return paragraphs[-1] if paragraphs else ""
+
+def _stitch(drafts: List[str], transitions: SceneTransitions) -> str:
+    """
+    Scenes in order, each seam bridged by its transition when there is one.
+    """
+    bridges = {
+        transition.after_scene: transition.text.strip()
+        for transition in transitions.transitions
+        if transition.text.strip()
+    }
+    parts = []
+    for number, draft in enumerate(drafts, start=1):
+        parts.append(draft.strip())
+        if number < len(drafts) and number in bridges:
+            parts.append(bridges[number])
+    return "\n\n".join(part for part in parts if part)
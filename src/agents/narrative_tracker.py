@@ -1,12 +1,27 @@
-from utils.llm_provider import LLMProvider
+from utils.llm_provider import LLMProvider, LLMProviderError, JSON_RESPONSE_FORMAT
+from utils.metrics import instrumented
+from utils.coherence import (
+    CoherenceIssue, CoherenceReport, coherence_windows, window_key, numbered_chapter, parse_issues, merge_issues
+)
 from models.story_context import StoryContext
+from models.schemas import NarrativeAnalysis
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import contextvars
 import json
-from typing import List, Dict, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Window checks run at once by check_narrative_coherence
+COHERENCE_WORKERS = 4
 
 class NarrativeTrackingAgent:
     def __init__(self, llm_provider: LLMProvider):
         self.llm = llm_provider
     
+    @instrumented
     def analyze_chapter_narrative(
         self, 
         story_context: StoryContext, 
@@ -16,7 +31,31 @@ class NarrativeTrackingAgent:
         """
         Analyze the narrative progression and update story context
         """
-        messages = [
+        messages = self._build_analysis_messages(story_context, chapter_content, previous_summary)
+        analysis = self.llm.generate_structured(messages, NarrativeAnalysis)
+        return self._update_story_context(story_context, analysis)
+
+    @instrumented
+    async def aanalyze_chapter_narrative(
+        self, 
+        story_context: StoryContext, 
+        chapter_content: str,
+        previous_summary: str,
+    ) -> StoryContext:
+        """
+        Async variant of analyze_chapter_narrative, requires an AsyncLLMProvider.
+        """
+        messages = self._build_analysis_messages(story_context, chapter_content, previous_summary)
+        analysis = await self.llm.agenerate_structured(messages, NarrativeAnalysis)
+        return self._update_story_context(story_context, analysis)
+
+    def _build_analysis_messages(
+        self, 
+        story_context: StoryContext, 
+        chapter_content: str,
+        previous_summary: str,
+    ) -> list:
+        return [
             {
                 "role": "system",
                 "content": """
@@ -55,85 +94,236 @@ class NarrativeTrackingAgent:
                 "content": f"This is the story plot context {story_context}, This is the summary of what has happened in the previous chapters : {previous_summary}, and this is the generated chapter : {chapter_content}"
             }
         ]
-        
-        response = self.llm.generate_completion(messages)
-
-        try:
-            narrative_analysis = json.loads(response)
-            return self._update_story_context(story_context, narrative_analysis)
-        except json.JSONDecodeError:
-            print("Failed to parse narrative analysis")
-            print(response)
 
-            return story_context  # Return the original context if parsing fails
-
-    
     def _update_story_context(
         self, 
         story_context: StoryContext, 
-        narrative_analysis: Dict[str, Any]
+        narrative_analysis: NarrativeAnalysis
     ) -> StoryContext:
         """
-        Update the story context based on narrative analysis
+        Update the story context based on narrative analysis.
+        Returns the next context snapshot; the given one is left untouched and
+        the arcs and lists the analysis does not change are shared.
         """
+        character_arcs = story_context.character_arcs
+        active_plot_threads = story_context.active_plot_threads
+        unresolved_tensions = story_context.unresolved_tensions
+
         # Update character arcs
-        if 'character_developments' in narrative_analysis:
-            for character, arc in narrative_analysis['character_developments'].items():
-                if character not in story_context.character_arcs:
-                    story_context.character_arcs[character] = []
-                story_context.character_arcs[character].append(arc)
+        if narrative_analysis.character_developments:
+            character_arcs = dict(character_arcs)
+            for character, arc in narrative_analysis.character_developments.items():
+                character_arcs[character] = character_arcs.get(character, ()) + (arc,)
         
         # Update plot threads
-        if 'plot_thread_status' in narrative_analysis:
-            for thread, status in narrative_analysis['plot_thread_status'].items():
-                if thread in story_context.active_plot_threads:
-                    story_context.active_plot_threads.remove(thread)
-                story_context.active_plot_threads.append(f"{thread} - {status}")
+        if narrative_analysis.plot_thread_status:
+            active_plot_threads = list(active_plot_threads)
+            for thread, status in narrative_analysis.plot_thread_status.items():
+                if thread in active_plot_threads:
+                    active_plot_threads.remove(thread)
+                active_plot_threads.append(f"{thread} - {status}")
         
         # Add new tensions
-        if 'new_tensions' in narrative_analysis:
-            story_context.unresolved_tensions.extend(narrative_analysis['new_tensions'])
+        if narrative_analysis.new_tensions:
+            unresolved_tensions = unresolved_tensions + tuple(narrative_analysis.new_tensions)
         
+        story_context = story_context.replace(
+            character_arcs=character_arcs,
+            active_plot_threads=active_plot_threads,
+            unresolved_tensions=unresolved_tensions
+        )
         return story_context
 
     
+    @instrumented
     def check_narrative_coherence(
         self, 
         story_context: StoryContext, 
-        generated_chapters: List[str]
+        generated_chapters: List[str],
+        cache: Optional[Dict[str, List[CoherenceIssue]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Map-reduce coherence check across generated chapters. Overlapping
+        windows of chapters are checked in parallel, then their issues are
+        merged and summarised. Window results are kept in cache under the hash
+        of each chapter in the window, so after an edit only the windows that
+        contain the edited chapter are checked again.
+        """
+        cache = {} if cache is None else cache
+        report, pending = self._plan_coherence_windows(story_context, generated_chapters, cache)
+        with ThreadPoolExecutor(max_workers=COHERENCE_WORKERS) as pool:
+            # Each call runs in a copy of our context, so metric tags carry over
+            futures = [
+                pool.submit(
+                    contextvars.copy_context().run, self.llm.generate_completion, messages,
+                    response_format=JSON_RESPONSE_FORMAT
+                )
+                for _, _, messages in pending
+            ]
+            responses = [_outcome(future) for future in futures]
+        findings = self._collect_window_issues(report, pending, responses, generated_chapters, cache)
+
+        report.issues = merge_issues(findings)
+        if report.issues:
+            report.summary = self.llm.generate_completion(self._build_coherence_summary_messages(story_context, report.issues))
+        else:
+            report.summary = "No coherence issues found."
+        return report.to_dict()
+
+    @instrumented
+    async def acheck_narrative_coherence(
+        self, 
+        story_context: StoryContext, 
+        generated_chapters: List[str],
+        cache: Optional[Dict[str, List[CoherenceIssue]]] = None
     ) -> Dict[str, Any]:
         """
-        Perform a high-level coherence check across generated chapters
+        Async variant of check_narrative_coherence, requires an AsyncLLMProvider.
         """
-        messages = [
+        cache = {} if cache is None else cache
+        report, pending = self._plan_coherence_windows(story_context, generated_chapters, cache)
+        responses = await asyncio.gather(
+            *(self.llm.agenerate_completion(messages, response_format=JSON_RESPONSE_FORMAT) for _, _, messages in pending),
+            return_exceptions=True
+        )
+        findings = self._collect_window_issues(report, pending, responses, generated_chapters, cache)
+
+        report.issues = merge_issues(findings)
+        if report.issues:
+            report.summary = await self.llm.agenerate_completion(self._build_coherence_summary_messages(story_context, report.issues))
+        else:
+            report.summary = "No coherence issues found."
+        return report.to_dict()
+
+    def _plan_coherence_windows(
+        self,
+        story_context: StoryContext,
+        generated_chapters: List[str],
+        cache: Dict[str, List[CoherenceIssue]]
+    ) -> Tuple[CoherenceReport, List[Tuple[Tuple[int, ...], str, list]]]:
+        """
+        The report so far, holding the cached windows' issues, and the
+        windows still to check with their cache key and messages.
+        """
+        premise = _premise(story_context)
+        report = CoherenceReport()
+        pending = []
+        for window in coherence_windows(len(generated_chapters)):
+            key = window_key(premise, window, generated_chapters)
+            if key in cache:
+                report.windows_cached += 1
+                report.issues.extend(cache[key])
+            else:
+                pending.append((window, key, self._build_coherence_messages(premise, window, generated_chapters)))
+        return report, pending
+
+    def _collect_window_issues(
+        self,
+        report: CoherenceReport,
+        pending: List[Tuple[Tuple[int, ...], str, list]],
+        responses: List[Any],
+        generated_chapters: List[str],
+        cache: Dict[str, List[CoherenceIssue]]
+    ) -> List[List[CoherenceIssue]]:
+        findings = [report.issues]
+        for (window, key, _), response in zip(pending, responses):
+            report.windows_checked += 1
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                issues = parse_issues(response, window, generated_chapters)
+            except (LLMProviderError, ValueError) as e:
+                # Failed windows are not cached, the next check retries them
+                logger.warning("Coherence check of chapters %s failed: %s", list(window), e)
+                report.failed_windows.append(window)
+                continue
+            cache[key] = issues
+            findings.append(issues)
+        return findings
+
+    def _build_coherence_messages(
+        self, 
+        premise: str,
+        window: Tuple[int, ...],
+        generated_chapters: List[str]
+    ) -> list:
+        chapters = "\n\n".join(
+            f"Chapter {number}:\n{numbered_chapter(number, generated_chapters[number - 1])}" for number in window
+        )
+        return [
             {
                 "role": "system",
                 "content": """
-                Evaluate the narrative coherence of the generated chapters.
-                Assess:
-                - Consistency of character arcs
-                - Plot thread progression
-                - Thematic continuity
-                - Potential narrative gaps or inconsistencies
+                You are a continuity editor checking consecutive chapters of a story for narrative coherence.
+                Look for:
+                - Characters acting against their established traits or arcs, or knowing things they should not
+                - Contradicted facts: names, places, objects, injuries, relationships, timeline
+                - Plot threads that are dropped or resolved without explanation
+                - Gaps or jumps between the chapters that the text does not account for
                 
-                Provide recommendations for improvement if needed.
+                Every paragraph is tagged [chapter.paragraph]. Point each issue at the paragraph where it shows.
+
+                Respond STRICTLY in the following JSON format:
+                {
+                    "issues": [
+                        {
+                            "chapter": 2,
+                            "paragraph": 14,
+                            "related_chapter": 1,
+                            "type": "character | fact | plot | timeline | theme",
+                            "severity": "low | medium | high",
+                            "description": "What is inconsistent",
+                            "suggestion": "How to fix it"
+                        }
+                    ]
+                }
+
+                Use an empty list if the chapters are consistent. Respond with only the required JSON, no text before or after the JSON.
                 """
             },
             {
                 "role": "user",
                 "content": f"""
-                Story Context:
-                {json.dumps(story_context.__dict__, indent=2)}
+                Story premise: {premise}
                 
-                Generated Chapters:
-                {json.dumps(generated_chapters, indent=2)}
+                {chapters}
                 """
             }
         ]
-        
-        coherence_analysis = self.llm.generate_completion(messages)
-        
-        return {
-            "coherence_report": coherence_analysis,
-            "needs_revision": len(generated_chapters) > 2  # Example condition
-        }
\ No newline at end of file
+
+    def _build_coherence_summary_messages(self, story_context: StoryContext, issues: List[CoherenceIssue]) -> list:
+        findings = "\n".join(
+            f"- Chapter {issue.chapter}, paragraph {issue.paragraph} ({issue.severity} {issue.kind}): {issue.description}"
+            for issue in issues
+        )
+        return [
+            {
+                "role": "system",
+                "content": """
+                You are an editor summarising a continuity review of a story.
+                Group related findings, say which chapters need revision first and
+                give short, concrete recommendations. Do not invent new issues.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"Story: {story_context.title}\n\nFindings:\n{findings}"
+            }
+        ]
+
+def _premise(story_context: StoryContext) -> str:
+    # Only the parts of the context that do not change chapter to chapter, so
+    # cached window results stay valid as the story goes on
+    return json.dumps({
+        "title": story_context.title,
+        "genre": story_context.genre,
+        "central_theme": story_context.central_theme,
+        "protagonist": story_context.protagonist,
+        "antagonist": story_context.antagonist
+    }, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def _outcome(future: Future) -> Any:
+    try:
+        return future.result()
+    except Exception as e:
+        return e
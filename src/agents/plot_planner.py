@@ -1,17 +1,38 @@
 from utils.llm_provider import LLMProvider
+from utils.metrics import instrumented
 from models.story_context import StoryContext
+from models.schemas import StoryStructure
 import json
 
 class PlotPlannerAgent:
     def __init__(self, llm_provider: LLMProvider):
         self.llm = llm_provider
 
+    @instrumented
     def generate_story_structure(
         self, 
         prompt: str, 
         genre: str = "general fiction"
     ) -> StoryContext:
-        messages = [
+        messages = self._build_structure_messages(prompt, genre)
+        structure = self.llm.generate_structured(messages, StoryStructure)
+        return structure.to_story_context(genre)
+
+    @instrumented
+    async def agenerate_story_structure(
+        self, 
+        prompt: str, 
+        genre: str = "general fiction"
+    ) -> StoryContext:
+        """
+        Async variant of generate_story_structure, requires an AsyncLLMProvider.
+        """
+        messages = self._build_structure_messages(prompt, genre)
+        structure = await self.llm.agenerate_structured(messages, StoryStructure)
+        return structure.to_story_context(genre)
+
+    def _build_structure_messages(self, prompt: str, genre: str) -> list:
+        return [
             {
                 "role": "system",
                 "content": """
@@ -57,25 +78,8 @@ class PlotPlannerAgent:
                 "content": f"You need to keep the story about this specific prompt : {prompt} which fits this specific genre : {genre}"
             }
         ]
-        
-        response = self.llm.generate_completion(messages, model='llama-3.3-70b-versatile')
-        
-        try:
-            story_data = json.loads(response)
-            context = StoryContext(
-                title=story_data.get('title', ''),
-                genre=genre,
-                central_theme=story_data.get('central_theme', ''),
-                protagonist=story_data.get('protagonist', {}),
-                antagonist=story_data.get('antagonist', {}),
-                active_plot_threads=story_data.get('plot_threads', []),
-                unresolved_tensions=story_data.get('tensions', [])
-            )
-            return context
-        except json.JSONDecodeError:
-            print("Failed to parse story structure")
-            return StoryContext()
 
+    @instrumented
     def modify_story_structure(
         self, 
         prompt: str, 
@@ -83,7 +87,32 @@ class PlotPlannerAgent:
         existing_structure: StoryContext, 
         additional_prompt: str
     ) -> StoryContext:
-        messages = [
+        messages = self._build_modify_messages(prompt, existing_structure, additional_prompt)
+        structure = self.llm.generate_structured(messages, StoryStructure)
+        return structure.to_story_context(genre)
+
+    @instrumented
+    async def amodify_story_structure(
+        self, 
+        prompt: str, 
+        genre: str, 
+        existing_structure: StoryContext, 
+        additional_prompt: str
+    ) -> StoryContext:
+        """
+        Async variant of modify_story_structure, requires an AsyncLLMProvider.
+        """
+        messages = self._build_modify_messages(prompt, existing_structure, additional_prompt)
+        structure = await self.llm.agenerate_structured(messages, StoryStructure)
+        return structure.to_story_context(genre)
+
+    def _build_modify_messages(
+        self, 
+        prompt: str, 
+        existing_structure: StoryContext, 
+        additional_prompt: str
+    ) -> list:
+        return [
             {
                 "role": "system",
                 "content": """
@@ -130,21 +159,3 @@ class PlotPlannerAgent:
                 "content": f"You need to modify the story to incorporate this additional prompt: {additional_prompt}"
             }
         ]
-
-        response = self.llm.generate_completion(messages, model='llama-3.3-70b-versatile')
-
-        try:
-            modified_story_data = json.loads(response)
-            modified_context = StoryContext(
-                title=modified_story_data.get('title', ''),
-                genre=genre,
-                central_theme=modified_story_data.get('central_theme', ''),
-                protagonist=modified_story_data.get('protagonist', {}),
-                antagonist=modified_story_data.get('antagonist', {}),
-                active_plot_threads=modified_story_data.get('plot_threads', []),
-                unresolved_tensions=modified_story_data.get('tensions', [])
-            )
-            return modified_context
-        except json.JSONDecodeError:
-            print("Failed to parse modified story structure")
-            return existing_structure
\ No newline at end of file
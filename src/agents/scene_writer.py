@@ -1,24 +1,56 @@
 from utils.llm_provider import LLMProvider
+from utils.metrics import instrumented
+from utils.context_builder import ContextBuilder, shared_context_builder
+from utils.retrieval import RetrievalIndex
 from models.story_context import StoryContext
-import json
+from typing import Optional
 
 class ScenePlanningAgent:
-    def __init__(self, llm_provider: LLMProvider):
+    def __init__(self, llm_provider: LLMProvider, context_builder: Optional[ContextBuilder] = None):
         self.llm = llm_provider
+        self.context_builder = context_builder or shared_context_builder
     
+    @instrumented
     def plan_chapter_scenes(
         self, 
         story_context: StoryContext,
         chapter_info: str,
-        previous_chapter_summary: str = None
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
     ) -> str:
-        context_injection = self._prepare_context_injection(
+        messages = self._build_plan_messages(story_context, chapter_info, previous_chapter_summary, retrieval)
+        return self.llm.generate_completion(messages)
+
+    @instrumented
+    async def aplan_chapter_scenes(
+        self, 
+        story_context: StoryContext,
+        chapter_info: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> str:
+        """
+        Async variant of plan_chapter_scenes, requires an AsyncLLMProvider.
+        """
+        messages = self._build_plan_messages(story_context, chapter_info, previous_chapter_summary, retrieval)
+        return await self.llm.agenerate_completion(messages)
+
+    def _build_plan_messages(
+        self, 
+        story_context: StoryContext,
+        chapter_info: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
+    ) -> list:
+        context_injection = self.context_builder.build(
             story_context,
             f"Chapter {chapter_info[0]}",
-            previous_chapter_summary
+            previous_chapter_summary,
+            model=self.llm.router.route().model
         )
+        earlier_passages = self._earlier_passages(story_context, chapter_info, previous_chapter_summary, retrieval)
         
-        messages = [
+        return [
             {
                 "role": "system",
                 "content": """
@@ -54,7 +86,7 @@ class ScenePlanningAgent:
                 - Maintain genre conventions while being original
                 
                 Context: {context_injection}
-                
+                {earlier_passages}
                 Provide a scene-by-scene breakdown focusing on dramatic structure and narrative flow.
                 Each scene should advance both plot and character development while building tension.
 
@@ -62,9 +94,8 @@ class ScenePlanningAgent:
                 """
             }
         ]
-        
-        return self.llm.generate_completion(messages, model='llama-3.3-70b-versatile')
     
+    @instrumented
     def modify_chapter_scenes(
         self,
         story_context: StoryContext,
@@ -73,13 +104,44 @@ class ScenePlanningAgent:
         additional_prompt: str,
         previous_chapter_summary: str = None
     ) -> str:
-        context_injection = self._prepare_context_injection(
+        messages = self._build_modify_messages(
+            story_context, chapter_info, existing_scenes, additional_prompt, previous_chapter_summary
+        )
+        return self.llm.generate_completion(messages)
+
+    @instrumented
+    async def amodify_chapter_scenes(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        existing_scenes: str,
+        additional_prompt: str,
+        previous_chapter_summary: str = None
+    ) -> str:
+        """
+        Async variant of modify_chapter_scenes, requires an AsyncLLMProvider.
+        """
+        messages = self._build_modify_messages(
+            story_context, chapter_info, existing_scenes, additional_prompt, previous_chapter_summary
+        )
+        return await self.llm.agenerate_completion(messages)
+
+    def _build_modify_messages(
+        self,
+        story_context: StoryContext,
+        chapter_info: str,
+        existing_scenes: str,
+        additional_prompt: str,
+        previous_chapter_summary: str = None
+    ) -> list:
+        context_injection = self.context_builder.build(
             story_context,
             f"Chapter {chapter_info[0]}",
-            previous_chapter_summary
+            previous_chapter_summary,
+            model=self.llm.router.route().model
         )
         
-        messages = [
+        return [
             {
                 "role": "system",
                 "content": """
@@ -108,29 +170,31 @@ class ScenePlanningAgent:
                 """
             }
         ]
-        
-        return self.llm.generate_completion(messages, model='llama-3.3-70b-versatile')
 
-    def _prepare_context_injection(
+    def _earlier_passages(
         self,
         story_context: StoryContext,
-        chapter_title: str,
-        previous_chapter_summary: str = None
+        chapter_info: str,
+        previous_chapter_summary: str = None,
+        retrieval: Optional[RetrievalIndex] = None
     ) -> str:
-        if isinstance(story_context, dict):
-            story_context = StoryContext(**story_context)
-            
-        context_details = {
-            "Story Title": story_context.title,
-            "Genre": story_context.genre,
-            "Central Theme": story_context.central_theme,
-            "Chapter Title": chapter_title,
-            "Protagonist Details": story_context.protagonist,
-            "Active Plot Threads": story_context.active_plot_threads,
-            "Unresolved Tensions": story_context.unresolved_tensions
-        }
-        
-        if previous_chapter_summary:
-            context_details["Previous Chapter Summary"] = previous_chapter_summary
-            
-        return json.dumps(context_details, indent=2)
\ No newline at end of file
+        """
+        Passages of earlier chapters about the characters, threads and tensions
+        the plan is likely to pick up.
+        """
+        if retrieval is None:
+            return ""
+        query = " ".join([
+            str(story_context.protagonist.get("name", "")),
+            str(story_context.antagonist.get("name", "")),
+            *story_context.active_plot_threads[-3:],
+            *story_context.unresolved_tensions[-3:],
+            getattr(previous_chapter_summary, "latest", previous_chapter_summary or "")
+        ])
+        passages = retrieval.relevant_passages(query, before_chapter=chapter_info[0])
+        if not passages:
+            return ""
+        return f"""
+                Passages from earlier chapters, for continuity of names, places and events:
+                {passages}
+                """
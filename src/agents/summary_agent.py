@@ -1,30 +1,126 @@
 from utils.llm_provider import LLMProvider
+from utils.metrics import instrumented
+from models.summary_memory import SummaryMemory
+from typing import List, Union
 
 class ChapterSummaryAgent:
     def __init__(self, llm_provider: LLMProvider):
         self.llm = llm_provider
     
-    def generate_chapter_summary(self, chapter_content: str, previous_summary: str) -> str:
-        messages = [
+    @instrumented
+    def generate_chapter_summary(self, chapter_content: str, previous_summary: Union[SummaryMemory, str, None]) -> str:
+        """
+        Summary of this chapter alone; the story memory is only there for continuity.
+        """
+        messages = self._build_summary_messages(chapter_content, previous_summary)
+        return self.llm.generate_completion(messages)
+
+    @instrumented
+    async def agenerate_chapter_summary(self, chapter_content: str, previous_summary: Union[SummaryMemory, str, None]) -> str:
+        """
+        Async variant of generate_chapter_summary, requires an AsyncLLMProvider.
+        """
+        messages = self._build_summary_messages(chapter_content, previous_summary)
+        return await self.llm.agenerate_completion(messages)
+
+    @instrumented
+    def update_summary_memory(self, chapter_content: str, memory: Union[SummaryMemory, str, None]) -> SummaryMemory:
+        """
+        Add the chapter to the story memory. Arc summaries are only written when
+        a level fills up, and the synopsis only when an arc summary was written.
+        """
+        memory = SummaryMemory.coerce(memory)
+        memory = memory.add_chapter(self.generate_chapter_summary(chapter_content, memory))
+        rolled_up = False
+        due = memory.rollup_due()
+        while due:
+            level, summaries = due
+            memory = memory.add_summary(level + 1, self.llm.generate_completion(self._build_rollup_messages(memory, level, summaries)))
+            rolled_up = True
+            due = memory.rollup_due()
+        if rolled_up:
+            memory = memory.with_synopsis(self.llm.generate_completion(self._build_synopsis_messages(memory)))
+        return memory
+
+    @instrumented
+    async def aupdate_summary_memory(self, chapter_content: str, memory: Union[SummaryMemory, str, None]) -> SummaryMemory:
+        """
+        Async variant of update_summary_memory, requires an AsyncLLMProvider.
+        """
+        memory = SummaryMemory.coerce(memory)
+        memory = memory.add_chapter(await self.agenerate_chapter_summary(chapter_content, memory))
+        rolled_up = False
+        due = memory.rollup_due()
+        while due:
+            level, summaries = due
+            memory = memory.add_summary(level + 1, await self.llm.agenerate_completion(self._build_rollup_messages(memory, level, summaries)))
+            rolled_up = True
+            due = memory.rollup_due()
+        if rolled_up:
+            memory = memory.with_synopsis(await self.llm.agenerate_completion(self._build_synopsis_messages(memory)))
+        return memory
+
+    def _build_summary_messages(self, chapter_content: str, previous_summary: Union[SummaryMemory, str, None]) -> list:
+        return [
             {
                 "role": "system",
                 "content": """
-                Provide a concise, objective summary of the chapter. Also pay attention to the summary of the previous chapter provided
-                Create a new summary of this chapter combined with the summary of the previous chapter. Keep the important details from this chapter and the previous summary as well
+                Provide a concise, objective summary of the chapter. The summary of the story so far is provided
+                only so names, places and threads stay consistent, do not repeat it.
                 Focus on:
                 - Key events
                 - Character developments
                 - Plot progression
                 - Emerging tensions
                 
-                Keep the summary to 6-8 sentences.
+                Keep the summary to 3-5 sentences.
                 Directly start with the summary, no text before or after that.
                 """
             },
             {
                 "role": "user",
-                "content": f"Here is the current chapter content : {chapter_content}, and this is the previous chapter summary : {previous_summary} (If this is None then assume it is the first chapter), Start directly with the summary, no text before or after that"
+                "content": f"Here is the current chapter content : {chapter_content}, and this is the summary of the story so far : {previous_summary or None} (If this is None then assume it is the first chapter), Start directly with the summary, no text before or after that"
+            }
+        ]
+
+    def _build_rollup_messages(self, memory: SummaryMemory, level: int, summaries: List[str]) -> list:
+        start = len(memory.levels[level + 1]) * memory.arc_size if level + 1 < len(memory.levels) else 0
+        first, _ = memory.chapter_span(level, start)
+        _, last = memory.chapter_span(level, start + len(summaries) - 1)
+        numbered = "\n".join(f"{i + 1}. {summary}" for i, summary in enumerate(summaries))
+        return [
+            {
+                "role": "system",
+                "content": """
+                You condense consecutive summaries of a novel into one summary of that story arc.
+                Keep the events that matter for the rest of the story: turning points, character changes,
+                open plot threads and unresolved tensions. Drop scene-level detail.
+                
+                Keep the summary to 4-6 sentences.
+                Directly start with the summary, no text before or after that.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"These summaries cover chapters {first} to {last}, in order:\n{numbered}"
+            }
+        ]
+
+    def _build_synopsis_messages(self, memory: SummaryMemory) -> list:
+        return [
+            {
+                "role": "system",
+                "content": """
+                You maintain the synopsis of a novel that is still being written.
+                Update the previous synopsis with the newest arc summaries so it covers the whole story so far:
+                premise, main arcs, where the characters now stand and what is still unresolved.
+                
+                Keep the synopsis to 6-8 sentences.
+                Directly start with the synopsis, no text before or after that.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"Previous synopsis : {memory.synopsis or None}\nStory memory, most condensed first :\n{memory.render(include_synopsis=False)}"
             }
         ]
-        
-        return self.llm.generate_completion(messages)
\ No newline at end of file
@@ -1,48 +1,235 @@
 import streamlit as st
 import os
+import uuid
 from dotenv import load_dotenv
 
-from utils.llm_provider import LLMProvider
-from utils.get_pdf import create_pdf
-from utils.overview import story_overview
-from agents.plot_planner import PlotPlannerAgent
-from agents.summary_agent import ChapterSummaryAgent
-from agents.chapter_writer import ChapterWritingAgent
-from agents.narrative_tracker import NarrativeTrackingAgent
-from agents.chapter_refiner import ChapterRefinerAgent
-from agents.scene_writer import ScenePlanningAgent
+from utils.overview import (
+    story_overview, cache_overview, scheduler_overview, speculation_overview, refinement_overview, metrics_overview,
+    export_overview
+)
+from utils.metrics import metric_tags
+from utils.registry import (
+    checkpoint_store, export_manager, job_runner, process_metrics, session_agents, session_provider, session_speculator
+)
+from utils.retrieval import RetrievalIndex
+from utils.llm_provider import LLMProviderError
+from utils.structured_output import StructuredOutputError
+from pipeline.chapter_stages import build_chapter_graph
+from pipeline.checkpoint import CHAPTER_STAGES, CONTEXT_OVERRIDE_STAGE
 
 load_dotenv()
 
+# Whether advanced mode drafts ahead of the user unless they opt out
+SPECULATE_DEFAULT = os.getenv('SPECULATIVE_PREFETCH', '1') == '1'
+
+# Failures a stage can be retried after, e.g. API retries running out on a 429
+# or a model answer that stayed invalid after re-asking
+RETRYABLE_ERRORS = (LLMProviderError, StructuredOutputError)
+
+def show_stage_error(error):
+    """
+    Reports a failed stage. The session is left as it was and finished stages
+    stay checkpointed, so pressing the button again resumes from there.
+    """
+    st.error(f"Generation failed: {error}. Try again to continue from the last completed step.")
+
 def generate_story_context(plot_planner, story_prompt, genre):
     return plot_planner.generate_story_structure(story_prompt, genre.lower())
 
 def modify_story_context(plot_planner, prompt, genre, existing_structure, feedback):
     return plot_planner.modify_story_structure(prompt, genre, existing_structure, feedback)
 
-def generate_chapter(story_context, chapter_num, total_chapters, previous_summary, 
-                    scene_planner, chapter_writer, chapter_refiner):
-    scene_layout = scene_planner.plan_chapter_scenes(
-        story_context,
-        [chapter_num, total_chapters],
-        previous_summary
-    )
-    
-    chapter_content = chapter_writer.generate_chapter(
-        story_context,
-        [chapter_num, total_chapters],
-        scene_layout,
-        previous_summary
+def submit_generation_job(runner, llm_provider):
+    """
+    Generate the remaining chapters in the background, resuming from the
+    last checkpointed stage.
+    """
+    return runner.submit(
+        llm_provider,
+        st.session_state.story_id,
+        st.session_state.story_context,
+        st.session_state.num_chapters,
+        st.session_state.previous_summary,
+        start_chapter=len(st.session_state.generated_chapters) + 1,
+        prefetch_next_scenes=st.session_state.pipelined
     )
-    
-    refined_chapter = chapter_refiner.refine_chapter(
-        story_context,
-        [chapter_num, total_chapters],
-        chapter_content,
-        scene_layout
+
+def collect_job_chapters(job):
+    """
+    Moves chapters the job has finished into the session, each once.
+    """
+    done = max(0, len(st.session_state.generated_chapters) - job.start_chapter + 1)
+    for result in job.results(done):
+        st.session_state.generated_chapters.append(result.refined)
+        st.session_state.previous_summary = result.summary
+        st.session_state.story_context = result.story_context
+
+def generation_progress(runner, llm_provider, polling):
+    """
+    Shows the story's chapters and its job's progress. While the job runs
+    this is polled as a fragment, so the rest of the page stays usable; when
+    it ends the whole page is refreshed once.
+    """
+    job = runner.get(st.session_state.story_id)
+    if job is not None:
+        collect_job_chapters(job)
+
+    for i, chapter in enumerate(st.session_state.generated_chapters):
+        with st.expander(f"Chapter {i+1}"):
+            st.write(chapter)
+
+    if job is None:
+        return
+    if polling and job.done:
+        st.rerun()
+    if not job.done:
+        if job.status == "queued":
+            status = "Waiting for a free generation slot..."
+        elif job.stage:
+            status = f"Chapter {job.chapter}: {job.stage.replace('_', ' ')} done"
+        else:
+            status = "Starting..."
+        st.progress(job.progress, text=status)
+        draft = job.partial.get(job.chapter, {}).get("draft")
+        if draft:
+            with st.expander(f"Chapter {job.chapter} (draft, being refined)"):
+                st.write(draft)
+        if st.button("Stop generation"):
+            job.cancel()
+    elif job.status in ("failed", "cancelled"):
+        if job.status == "failed":
+            st.error(f"Generation failed: {job.error}")
+        else:
+            st.warning("Generation stopped.")
+        if len(st.session_state.generated_chapters) < st.session_state.num_chapters and st.button("Resume generation"):
+            submit_generation_job(runner, llm_provider)
+            st.rerun()
+
+def chapter_stage_graph(scene_planner, chapter_writer, chapter_refiner, summary_agent, narrative_tracker,
+                        checkpoints):
+    """
+    Stage graph for the advanced-mode chapter, memoized in the session so each
+    button only runs the stages it still needs. Every stage is checkpointed.
+    """
+    placeholder = st.empty()
+    story_id = st.session_state.story_id
+    chapter_num = st.session_state.current_chapter
+
+    def render(stream):
+        with placeholder.container():
+            return st.write_stream(stream)
+
+    def on_stage(stage, value):
+        checkpoints.save_stage(story_id, chapter_num, stage, value)
+
+    return build_chapter_graph(
+        scene_planner,
+        chapter_writer,
+        chapter_refiner,
+        summary_agent,
+        narrative_tracker,
+        memo=st.session_state.chapter_memo,
+        render=render,
+        on_stage=on_stage,
+        retrieval=retrieval_index()
     )
-    
-    return refined_chapter, scene_layout
+
+def speculative_stage(speculator, chapter_graph, stage, chapter_inputs, checkpoints):
+    """
+    The stage's output from a speculative run started on the same inputs, seeded
+    into the graph and checkpointed; None when there is none to use.
+    """
+    if speculator is None:
+        return None
+    value = speculator.take(stage, chapter_graph.fingerprint_of(stage, chapter_inputs))
+    if value is not None:
+        chapter_graph.seed(stage, value, chapter_inputs)
+        checkpoints.save_stage(st.session_state.story_id, st.session_state.current_chapter, stage, value)
+    return value
+
+def retrieval_index():
+    """
+    The session's retrieval index over the generated chapters, brought up to
+    date with them. Restored or switched stories are indexed on first use.
+    """
+    if st.session_state.get("retrieval") is None:
+        st.session_state.retrieval = RetrievalIndex()
+    st.session_state.retrieval.sync(st.session_state.generated_chapters)
+    return st.session_state.retrieval
+
+def start_story(checkpoints, mode, story_prompt, genre, num_chapters, story_context):
+    """
+    Registers a new story under a fresh id and puts the id in the URL, so a
+    refresh or restart can resume it from its checkpoints.
+    """
+    story_id = uuid.uuid4().hex
+    checkpoints.save_story(story_id, story_prompt, genre, num_chapters, story_context, mode=mode)
+    st.query_params["story"] = story_id
+    st.session_state.story_id = story_id
+
+def restore_story(checkpoints, story_id):
+    """
+    Rebuilds the session from a story's checkpoints. Returns False if the id is unknown.
+    """
+    checkpoint = checkpoints.load_story(story_id)
+    if checkpoint is None:
+        return False
+
+    state = checkpoint.resume_state()
+    st.session_state.story_id = story_id
+    st.session_state.generation_mode = checkpoint.mode
+    st.session_state.num_chapters = checkpoint.num_chapters
+    st.session_state.pipelined = False
+    st.session_state.speculate = SPECULATE_DEFAULT
+    st.session_state.initial_prompt = checkpoint.prompt
+    st.session_state.genre = checkpoint.genre
+    st.session_state.story_title = checkpoint.story_context.title
+    st.session_state.story_theme = checkpoint.story_context.central_theme
+    st.session_state.story_context = state["story_context"]
+    st.session_state.previous_summary = state["previous_summary"]
+    st.session_state.generated_chapters = state["chapters"]
+    st.session_state.current_chapter = state["next_chapter"]
+    st.session_state.scene_layout = state["pending_stages"].get("scene_layout")
+    st.session_state.context_modified = CONTEXT_OVERRIDE_STAGE in state["pending_stages"]
+    st.session_state.restored_stages = state["pending_stages"]
+    st.session_state.retrieval = None
+    return True
+
+def open_story(story_id):
+    """
+    Switch the session to another saved story or branch, keeping the usage
+    metrics, the session's agents and its speculation counts.
+    """
+    if st.session_state.get("speculator") is not None:
+        st.session_state.speculator.discard()
+    for key in list(st.session_state.keys()):
+        if key not in ("metrics", "llm_provider", "agents", "speculator"):
+            del st.session_state[key]
+    st.query_params["story"] = story_id
+    st.rerun()
+
+def saved_stories(checkpoints):
+    with st.sidebar.expander("💾 Saved Stories"):
+        for story in checkpoints.list_stories():
+            label = story["title"] or story["prompt"][:40] or story["story_id"][:8]
+            if story["parent_id"]:
+                label += f" (branch from chapter {story['fork_chapter']})"
+            if st.button(f"Resume: {label}", key=f"resume_{story['story_id']}"):
+                open_story(story["story_id"])
+
+def branch_controls(checkpoints):
+    """
+    Fork the story at a chapter. The fork shares the earlier chapters and
+    continues in advanced mode, so the chosen chapter can be steered.
+    """
+    chapters = len(st.session_state.generated_chapters)
+    if not chapters or not st.session_state.story_id:
+        return
+    with st.expander("🌿 Branch this story"):
+        chapter = st.number_input("Rewrite from chapter", min_value=1, max_value=chapters, value=chapters)
+        if st.button("Fork"):
+            fork_id = checkpoints.fork_story(st.session_state.story_id, int(chapter), mode="advanced")
+            open_story(fork_id)
 
 def modify_chapter_scenes(scene_planner, story_context, chapter_info, existing_scenes, feedback, previous_summary):
     return scene_planner.modify_chapter_scenes(
@@ -69,184 +256,277 @@ def main():
         st.session_state.initial_prompt = None
         st.session_state.genre = None
         st.session_state.context_modified = False
+        st.session_state.chapter_memo = {}
+        st.session_state.story_id = None
+        st.session_state.restored_stages = None
+        st.session_state.retrieval = None
+        st.session_state.stage_warning = None
 
-    llm_provider = LLMProvider(api_key=os.getenv('GROQ_API_KEY'))
-    plot_planner = PlotPlannerAgent(llm_provider)
-    summary_agent = ChapterSummaryAgent(llm_provider)
-    chapter_writer = ChapterWritingAgent(llm_provider)
-    chapter_refiner = ChapterRefinerAgent(llm_provider)
-    narrative_tracker = NarrativeTrackingAgent(llm_provider)
-    scene_planner = ScenePlanningAgent(llm_provider)
+    # Built once per session on process-wide clients, not on every rerun
+    llm_provider = session_provider(st.session_state)
+    agents = session_agents(st.session_state)
+    plot_planner = agents.plot_planner
+    summary_agent = agents.summary_agent
+    chapter_writer = agents.chapter_writer
+    chapter_refiner = agents.chapter_refiner
+    narrative_tracker = agents.narrative_tracker
+    scene_planner = agents.scene_planner
+    checkpoints = checkpoint_store(os.getenv('CHECKPOINT_PATH', '.cache/checkpoints.sqlite'))
+    
+    if not st.session_state.story_id and "story" in st.query_params:
+        if not restore_story(checkpoints, st.query_params["story"]):
+            st.query_params.clear()
     
     if not st.session_state.generation_mode:
         story_prompt = st.text_input("Enter your story concept:")
         genre = st.selectbox("Select Genre", [
             "General Fiction", "Science Fiction", "Fantasy", "Mystery", "Romance"
         ])
-        num_chapters = st.slider("Number of Chapters", 1, 10, 3)
+        num_chapters = st.slider("Number of Chapters", 1, 200, 3)
+        pipelined = st.checkbox(
+            "Pipelined quick generation",
+            help="Start planning the next chapter before the current one has been analysed."
+        )
+        speculate = st.checkbox(
+            "Speculative advanced generation",
+            value=SPECULATE_DEFAULT,
+            help="Draft the chapter while you review its scene layout, and plan the next chapter's scenes "
+                 "while you read this one. Unused drafts cost tokens."
+        )
         
         _, _, col3, col4, _, _ = st.columns(6)
         with col3:
             if st.button("Quick Generation"):
-                st.session_state.generation_mode = "quick"
-                st.session_state.num_chapters = num_chapters
-                st.session_state.initial_prompt = story_prompt
-                st.session_state.genre = genre
-                story_context = generate_story_context(plot_planner, story_prompt, genre)
-                st.session_state.story_context = story_context
-                st.session_state.story_title = story_context.__dict__['title']
-                st.session_state.story_theme = story_context.__dict__['central_theme']
-                st.rerun()
+                try:
+                    with metric_tags(priority="interactive"):
+                        story_context = generate_story_context(plot_planner, story_prompt, genre)
+                except RETRYABLE_ERRORS as e:
+                    show_stage_error(e)
+                else:
+                    st.session_state.generation_mode = "quick"
+                    st.session_state.num_chapters = num_chapters
+                    st.session_state.pipelined = pipelined
+                    st.session_state.initial_prompt = story_prompt
+                    st.session_state.genre = genre
+                    st.session_state.story_context = story_context
+                    st.session_state.story_title = story_context.__dict__['title']
+                    st.session_state.story_theme = story_context.__dict__['central_theme']
+                    start_story(checkpoints, "quick", story_prompt, genre, num_chapters, story_context)
+                    st.rerun()
                 
         with col4:
             if st.button("Advanced Generation"):
-                st.session_state.generation_mode = "advanced"
-                st.session_state.num_chapters = num_chapters
-                st.session_state.initial_prompt = story_prompt
-                st.session_state.genre = genre
-                story_context = generate_story_context(plot_planner, story_prompt, genre)
-                st.session_state.story_context = story_context
-                st.session_state.story_title = story_context.__dict__['title']
-                st.session_state.story_theme = story_context.__dict__['central_theme']
-                st.rerun()
+                try:
+                    with metric_tags(priority="interactive"):
+                        story_context = generate_story_context(plot_planner, story_prompt, genre)
+                except RETRYABLE_ERRORS as e:
+                    show_stage_error(e)
+                else:
+                    st.session_state.generation_mode = "advanced"
+                    st.session_state.num_chapters = num_chapters
+                    st.session_state.speculate = speculate
+                    st.session_state.initial_prompt = story_prompt
+                    st.session_state.genre = genre
+                    st.session_state.story_context = story_context
+                    st.session_state.story_title = story_context.__dict__['title']
+                    st.session_state.story_theme = story_context.__dict__['central_theme']
+                    start_story(checkpoints, "advanced", story_prompt, genre, num_chapters, story_context)
+                    st.rerun()
     
     if st.session_state.generation_mode == "quick":
         story_overview(st.session_state.story_context.__dict__)
 
         st.divider()
         
-        progress_placeholder = st.empty()
-        chapters_container = st.container()
+        # Generation runs as a job outside this script; reruns only poll it
+        runner = job_runner(os.getenv('CHECKPOINT_PATH', '.cache/checkpoints.sqlite'))
+        job = runner.get(st.session_state.story_id)
+        if job is None and len(st.session_state.generated_chapters) < st.session_state.num_chapters:
+            job = submit_generation_job(runner, llm_provider)
+        polling = job is not None and not job.done
+        st.fragment(generation_progress, run_every=1.0 if polling else None)(runner, llm_provider, polling)
         
-        if not st.session_state.generated_chapters:
-            for i in range(st.session_state.num_chapters):
-                progress_placeholder.write(f"Generating Chapter {i+1}...")
-                
-                chapter, scene_layout = generate_chapter(
-                    st.session_state.story_context,
-                    i + 1,
-                    st.session_state.num_chapters,
-                    st.session_state.previous_summary,
-                    scene_planner,
-                    chapter_writer,
-                    chapter_refiner
-                )
-                
-                st.session_state.generated_chapters.append(chapter)
-                with chapters_container:
-                    with st.expander(f"Chapter {i+1}", expanded=True):
-                        st.write(chapter)
-                
-                chapter_summary = summary_agent.generate_chapter_summary(
-                    chapter,
-                    st.session_state.previous_summary
-                )
-                st.session_state.previous_summary = chapter_summary
-                st.session_state.story_context = narrative_tracker.analyze_chapter_narrative(
-                    st.session_state.story_context,
-                    chapter,
-                    st.session_state.previous_summary
-                )
-            
-            progress_placeholder.empty()
-        else:
-            for i, chapter in enumerate(st.session_state.generated_chapters):
-                with chapters_container:
-                    with st.expander(f"Chapter {i+1}"):
-                        st.write(chapter)
+        branch_controls(checkpoints)
     
     elif st.session_state.generation_mode == "advanced":
         story_overview(st.session_state.story_context.__dict__)
 
         st.divider()
         
-        if st.session_state.current_chapter <= st.session_state.num_chapters:
-            st.subheader(f"Chapter {st.session_state.current_chapter} Generation")
+        # Set before the rerun that accepted the chapter, shown once
+        if st.session_state.get("stage_warning"):
+            st.warning(st.session_state.stage_warning)
+            st.session_state.stage_warning = None
+        
+        # A user is waiting on every call made here, so they go ahead of background jobs
+        with metric_tags(story_id=st.session_state.story_id, chapter=st.session_state.current_chapter,
+                         priority="interactive"):
+            if st.session_state.current_chapter <= st.session_state.num_chapters:
+                st.subheader(f"Chapter {st.session_state.current_chapter} Generation")
             
-            # Only show context modification before scene layout is generated
-            if not st.session_state.scene_layout and not st.session_state.context_modified:
-                context_feedback = st.text_area(
-                    "Modify story context (optional):",
-                    key=f"context_feedback_{st.session_state.current_chapter}"
-                )
+                # Only show context modification before scene layout is generated
+                if not st.session_state.scene_layout and not st.session_state.context_modified:
+                    context_feedback = st.text_area(
+                        "Modify story context (optional):",
+                        key=f"context_feedback_{st.session_state.current_chapter}"
+                    )
                 
-                if context_feedback:
-                    if st.button("Update Context"):
-                        st.session_state.story_context = modify_story_context(
-                            plot_planner,
-                            st.session_state.initial_prompt,
-                            st.session_state.genre,
-                            st.session_state.story_context,
-                            context_feedback
-                        )
-                        st.session_state.context_modified = True
-                        story_overview(st.session_state.story_context.__dict__)
+                    if context_feedback:
+                        if st.button("Update Context"):
+                            try:
+                                story_context = modify_story_context(
+                                    plot_planner,
+                                    st.session_state.initial_prompt,
+                                    st.session_state.genre,
+                                    st.session_state.story_context,
+                                    context_feedback
+                                )
+                            except RETRYABLE_ERRORS as e:
+                                show_stage_error(e)
+                            else:
+                                st.session_state.story_context = story_context
+                                st.session_state.context_modified = True
+                                checkpoints.discard_stages(
+                                    st.session_state.story_id, st.session_state.current_chapter, CHAPTER_STAGES
+                                )
+                                checkpoints.save_stage(
+                                    st.session_state.story_id,
+                                    st.session_state.current_chapter,
+                                    CONTEXT_OVERRIDE_STAGE,
+                                    st.session_state.story_context
+                                )
+                                story_overview(st.session_state.story_context.__dict__)
             
-            if not st.session_state.scene_layout:
-                if st.button("Generate Scene Layout"):
-                    chapter, scene_layout = generate_chapter(
-                        st.session_state.story_context,
-                        st.session_state.current_chapter,
-                        st.session_state.num_chapters,
-                        st.session_state.previous_summary,
-                        scene_planner,
-                        chapter_writer,
-                        chapter_refiner
-                    )
-                    st.session_state.scene_layout = scene_layout
-                    st.rerun()
+                chapter_graph = chapter_stage_graph(
+                    scene_planner,
+                    chapter_writer,
+                    chapter_refiner,
+                    summary_agent,
+                    narrative_tracker,
+                    checkpoints
+                )
+                chapter_inputs = {
+                    "story_context": st.session_state.story_context,
+                    "chapter_info": [st.session_state.current_chapter, st.session_state.num_chapters],
+                    "previous_summary": st.session_state.previous_summary
+                }
+            
+                # Stages restored from a checkpoint count as already run
+                if st.session_state.restored_stages:
+                    for stage in CHAPTER_STAGES:
+                        if stage not in st.session_state.restored_stages:
+                            break
+                        chapter_graph.seed(stage, st.session_state.restored_stages[stage], chapter_inputs)
+                    st.session_state.restored_stages = None
+            
+                speculator = session_speculator(st.session_state) if st.session_state.get("speculate") else None
+            
+                if not st.session_state.scene_layout:
+                    if st.button("Generate Scene Layout"):
+                        try:
+                            scene_layout = speculative_stage(speculator, chapter_graph, "scene_layout", chapter_inputs, checkpoints)
+                            if scene_layout is None:
+                                scene_layout = chapter_graph.run("scene_layout", chapter_inputs)
+                        except RETRYABLE_ERRORS as e:
+                            show_stage_error(e)
+                        else:
+                            st.session_state.scene_layout = scene_layout
+                            st.rerun()
             
-            if st.session_state.scene_layout:
-                st.write("### Scene Layout")
-                st.write(st.session_state.scene_layout)
+                if st.session_state.scene_layout:
+                    st.write("### Scene Layout")
+                    st.write(st.session_state.scene_layout)
                 
-                scene_feedback = st.text_area(
-                    "Modify scene layout (optional):",
-                    key=f"scene_feedback_{st.session_state.current_chapter}"
-                )
+                    scene_feedback = st.text_area(
+                        "Modify scene layout (optional):",
+                        key=f"scene_feedback_{st.session_state.current_chapter}"
+                    )
                 
-                if st.button("Generate Chapter"):
-                    if scene_feedback:
-                        modified_scenes = modify_chapter_scenes(
-                            scene_planner,
-                            st.session_state.story_context,
-                            f"Chapter {st.session_state.current_chapter}/{st.session_state.num_chapters}",
-                            st.session_state.scene_layout,
-                            scene_feedback,
-                            st.session_state.previous_summary
+                    # Draft from the layout as shown while the user reviews it
+                    scene_layout = chapter_graph.cached("scene_layout")
+                    if speculator is not None and scene_layout and not chapter_graph.memoized("draft", chapter_inputs):
+                        retrieval = st.session_state.retrieval
+                        speculator.start(
+                            "draft",
+                            chapter_graph.fingerprint_of("draft", chapter_inputs),
+                            lambda: chapter_writer.agenerate_chapter(
+                                chapter_inputs["story_context"],
+                                chapter_inputs["chapter_info"],
+                                scene_layout,
+                                chapter_inputs["previous_summary"],
+                                retrieval
+                            )
                         )
-                        st.session_state.scene_layout = modified_scenes
-                    
-                    chapter_content = chapter_writer.generate_chapter(
-                        st.session_state.story_context,
-                        [st.session_state.current_chapter, st.session_state.num_chapters],
-                        st.session_state.scene_layout,
-                        st.session_state.previous_summary
-                    )
+                
+                    if st.button("Generate Chapter"):
+                        try:
+                            if scene_feedback:
+                                if speculator is not None:
+                                    speculator.discard("draft")
+                                modified_scenes = modify_chapter_scenes(
+                                    scene_planner,
+                                    st.session_state.story_context,
+                                    [st.session_state.current_chapter, st.session_state.num_chapters],
+                                    st.session_state.scene_layout,
+                                    scene_feedback,
+                                    st.session_state.previous_summary
+                                )
+                                st.session_state.scene_layout = modified_scenes
+                                checkpoints.discard_stages(
+                                    st.session_state.story_id,
+                                    st.session_state.current_chapter,
+                                    chapter_graph.downstream("scene_layout")
+                                )
+                                chapter_graph.override("scene_layout", modified_scenes, chapter_inputs)
+                            else:
+                                speculative_stage(speculator, chapter_graph, "draft", chapter_inputs, checkpoints)
                     
-                    refined_chapter = chapter_refiner.refine_chapter(
-                        st.session_state.story_context,
-                        [st.session_state.current_chapter, st.session_state.num_chapters],
-                        chapter_content,
-                        st.session_state.scene_layout
-                    )
+                            # Only the stages downstream of what is already memoized run here
+                            outputs = chapter_graph.run_all(["refined", "summary"], chapter_inputs)
+                        except RETRYABLE_ERRORS as e:
+                            show_stage_error(e)
+                        else:
+                            try:
+                                story_context = chapter_graph.run("narrative", chapter_inputs)
+                            except RETRYABLE_ERRORS as e:
+                                # The chapter stands without it, the next one is planned from the old context
+                                story_context = st.session_state.story_context
+                                checkpoints.save_stage(
+                                    st.session_state.story_id, st.session_state.current_chapter, "narrative", story_context
+                                )
+                                st.session_state.stage_warning = (
+                                    f"Narrative tracking for chapter {st.session_state.current_chapter} failed ({e}), "
+                                    "the story context was kept as it was."
+                                )
+                            st.session_state.generated_chapters.append(outputs["refined"])
+                            st.session_state.previous_summary = outputs["summary"]
+                            st.session_state.story_context = story_context
                     
-                    st.session_state.generated_chapters.append(refined_chapter)
-                    chapter_summary = summary_agent.generate_chapter_summary(
-                        refined_chapter,
-                        st.session_state.previous_summary
-                    )
-                    st.session_state.previous_summary = chapter_summary
-                    st.session_state.story_context = narrative_tracker.analyze_chapter_narrative(
-                        st.session_state.story_context,
-                        refined_chapter,
-                        st.session_state.previous_summary
-                    )
+                            st.session_state.current_chapter += 1
+                            st.session_state.scene_layout = None
+                            st.session_state.context_modified = False
+                            st.session_state.chapter_memo = {}
                     
-                    st.session_state.current_chapter += 1
-                    st.session_state.scene_layout = None
-                    st.session_state.context_modified = False
-                    st.rerun()
+                            # Plan the next chapter's scenes while this one is read
+                            if speculator is not None and st.session_state.current_chapter <= st.session_state.num_chapters:
+                                next_inputs = {
+                                    "story_context": st.session_state.story_context,
+                                    "chapter_info": [st.session_state.current_chapter, st.session_state.num_chapters],
+                                    "previous_summary": st.session_state.previous_summary
+                                }
+                                retrieval = retrieval_index()
+                                speculator.start(
+                                    "scene_layout",
+                                    chapter_graph.fingerprint_of("scene_layout", next_inputs),
+                                    lambda: scene_planner.aplan_chapter_scenes(
+                                        next_inputs["story_context"],
+                                        next_inputs["chapter_info"],
+                                        next_inputs["previous_summary"],
+                                        retrieval
+                                    ),
+                                    chapter=st.session_state.current_chapter
+                                )
+                            st.rerun()
         
         for i, chapter in enumerate(st.session_state.generated_chapters):
             with st.expander(f"Chapter {i+1}"):
@@ -254,11 +534,31 @@ def main():
         
         if st.session_state.current_chapter > st.session_state.num_chapters:
             st.success("Story generation complete!")
+        
+        branch_controls(checkpoints)
     
+    if st.session_state.generated_chapters:
+        export_overview(
+            export_manager(),
+            st.session_state.story_title,
+            st.session_state.story_theme,
+            st.session_state.generated_chapters
+        )
+
+    cache_overview(llm_provider.cache.stats())
+    scheduler_overview(llm_provider.scheduler.stats())
+    if st.session_state.get("speculator") is not None:
+        speculation_overview(st.session_state.speculator.stats())
+    refinement_overview(chapter_refiner.report(st.session_state.story_id))
+    metrics_overview(st.session_state.metrics, st.session_state.story_id)
+    process_metrics().write_prometheus(os.getenv('METRICS_PROM_PATH', '.cache/metrics.prom'))
+    saved_stories(checkpoints)
+
     if st.session_state.generation_mode:
         if st.button("Start New Story"):
             for key in st.session_state.keys():
                 del st.session_state[key]
+            st.query_params.clear()
             st.rerun()
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from dotenv import load_dotenv
+
+from utils.llm_provider import AsyncLLMProvider
+from utils.llm_cache import LLMCache
+from utils.metrics import MetricsCollector, metric_tags
+from utils.rate_limiter import RequestScheduler
+from utils.model_router import load_router
+from utils.export import EXPORT_FORMATS, Book, ExportManager
+from pipeline.story_pipeline import StoryPipeline, StoryRequest
+from pipeline.checkpoint import CheckpointStore
+from agents.chapter_refiner import REFINE_MODES
+from agents.chapter_writer import DRAFT_MODES
+
+# Load environment variables
+load_dotenv()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate many stories headlessly from a JSONL file of "
+                    '{"prompt": ..., "genre": ..., "chapters": ..., "id": ...} lines.'
+    )
+    parser.add_argument("input", help="JSONL file of story requests, '-' for stdin")
+    parser.add_argument("--output", default="-", help="JSONL file to append finished stories to (default: stdout)")
+    parser.add_argument("--export-dir", "--pdf-dir", dest="export_dir", default=None,
+                        help="Directory to write each story's exports into, named by story id")
+    parser.add_argument("--formats", default="pdf",
+                        help=f"Comma-separated export formats, any of {', '.join(EXPORT_FORMATS)} (default: pdf)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Stories generated at the same time")
+    parser.add_argument("--calls-per-story", type=int, default=int(os.getenv('MAX_CALLS_PER_STORY', '3')),
+                        help="LLM calls one story may have in flight, so stories share the quota fairly")
+    parser.add_argument("--cache", default=os.getenv('LLM_CACHE_PATH', '.cache/llm_responses.sqlite'),
+                        help="LLM response cache file, empty to disable")
+    parser.add_argument("--checkpoints", default=os.getenv('CHECKPOINT_PATH', '.cache/checkpoints.sqlite'),
+                        help="Stage checkpoint file; rerunning the same ids resumes them. Empty to disable")
+    parser.add_argument("--metrics-json", default=None,
+                        help="Write per-call token, latency and cost records here when the batch ends")
+    parser.add_argument("--metrics-prom", default=os.getenv('METRICS_PROM_PATH'),
+                        help="Prometheus text file, refreshed after every story")
+    parser.add_argument("--refine-mode", choices=REFINE_MODES, default=os.getenv('REFINE_MODE', 'rewrite'),
+                        help="Refine chapters by full rewrite or by applying paragraph edits (fewer output tokens)")
+    parser.add_argument("--draft-mode", choices=DRAFT_MODES, default=os.getenv('DRAFT_MODE', 'single'),
+                        help="Draft chapters in one pass or write their scenes in parallel (lower latency)")
+    parser.add_argument("--model-profiles", default=os.getenv('MODEL_PROFILES_PATH'),
+                        help="JSON file of per-agent model, max_tokens, temperature and SLO overrides")
+    return parser.parse_args(argv)
+
+def read_requests(path):
+    """
+    Story requests from the JSONL file. A malformed line is reported and
+    yielded as an error record instead, so the rest of the batch still runs.
+    """
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield StoryRequest.from_dict(json.loads(line))
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError) as e:
+                error = f"Invalid request: {type(e).__name__}: {e}"
+                print(f"Line {line_number} skipped: {error}", file=sys.stderr)
+                yield {"line": line_number, "error": error}
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+async def run_batch(args):
+    llm_provider = AsyncLLMProvider(
+        api_key=os.getenv('GROQ_API_KEY'),
+        cache=LLMCache(path=args.cache) if args.cache else None,
+        scheduler=RequestScheduler(max_calls_per_story=args.calls_per_story),
+        metrics=MetricsCollector(),
+        router=load_router(args.model_profiles)
+    )
+    pipeline = StoryPipeline(
+        llm_provider,
+        checkpoints=CheckpointStore(args.checkpoints) if args.checkpoints else None,
+        refine_mode=args.refine_mode,
+        draft_mode=args.draft_mode
+    )
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    export_manager = None
+    if args.export_dir:
+        os.makedirs(args.export_dir, exist_ok=True)
+        export_manager = ExportManager(args.export_dir)
+    formats = [export_format.strip() for export_format in args.formats.split(",") if export_format.strip()]
+
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        while True:
+            request = await queue.get()
+            if request is None:
+                return
+            try:
+                with metric_tags(priority="batch"):
+                    result = await pipeline.agenerate(request)
+                record = result.to_dict()
+                if export_manager is not None:
+                    # All formats in one pass over the chapters, laid out in worker processes
+                    book = Book.from_generated(result.title, result.story_context.central_theme, result.pdf_chapters())
+                    job = export_manager.submit(book, formats, basename=request.story_id)
+                    await asyncio.to_thread(job.wait)
+                    if job.status == "failed":
+                        raise RuntimeError(f"Export failed: {job.error}")
+                    record["exports"] = job.paths
+                    if "pdf" in job.paths:
+                        record["pdf"] = job.paths["pdf"]
+            except Exception as e:
+                failures += 1
+                print(f"Story {request.story_id} failed: {e}", file=sys.stderr)
+                record = {"id": request.story_id, "prompt": request.prompt, "error": str(e)}
+            record["metrics"] = llm_provider.metrics.totals(request.story_id)
+            record["refinement"] = [report.to_dict() for report in pipeline.chapter_refiner.report(request.story_id)]
+            pipeline.chapter_refiner.refinement_log.discard(request.story_id)
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            if args.metrics_prom:
+                llm_provider.metrics.write_prometheus(args.metrics_prom)
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    try:
+        # Reading stdin blocks, so lines are read off the event loop
+        requests = read_requests(args.input)
+        while True:
+            request = await asyncio.to_thread(next, requests, None)
+            if request is None:
+                break
+            if isinstance(request, dict):
+                failures += 1
+                output.write(json.dumps(request) + "\n")
+                output.flush()
+                continue
+            await queue.put(request)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if export_manager is not None:
+            export_manager.shutdown()
+        if args.metrics_json:
+            llm_provider.metrics.write_json(args.metrics_json)
+
+    return 1 if failures else 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    return asyncio.run(run_batch(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
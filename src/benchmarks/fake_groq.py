@@ -0,0 +1,224 @@
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+from dataclasses import dataclass
+from types import SimpleNamespace
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from utils.tokens import estimate_message_tokens, estimate_tokens
+
+# Four-character words, so one word is roughly one token under utils.tokens
+_VOCABULARY = ["the ", "and ", "was ", "her ", "his ", "sky ", "old ", "sea ", "ran ", "fog ", "map ", "key "]
+# Tokens per streamed chunk
+STREAM_CHUNK_TOKENS = 16
+# Scenes in a fake chapter layout
+FAKE_SCENES = 5
+
+STORY_STRUCTURE = {
+    "title": "The Lantern Keeper",
+    "genre": "fantasy",
+    "central_theme": "Light survives in small hands",
+    "protagonist": {
+        "name": "Mira",
+        "background": "A lamplighter's apprentice in a drowned city",
+        "primary_goal": "Relight the harbour beacon",
+        "internal_conflict": "Fear of repeating her mentor's failure"
+    },
+    "antagonist": {
+        "name": "The Tide Warden",
+        "motivation": "Keep the city dark and obedient",
+        "power_source": "Command of the flood gates"
+    },
+    "plot_threads": ["The missing beacon key", "The warden's bargain", "Mira's mentor's disappearance"],
+    "tensions": ["The flood gates open at the next new moon", "A traitor among the lamplighters"]
+}
+
+NARRATIVE_ANALYSIS = {
+    "character_developments": {
+        "Mira": {
+            "arc_progression": "Chooses to act without permission",
+            "emotional_state": "Determined but shaken",
+            "key_decision": "Steals the harbour map"
+        }
+    },
+    "plot_thread_status": {"The missing beacon key": "A lead points to the old lighthouse"},
+    "new_tensions": ["The warden knows the map is gone"],
+    "thematic_progression": {"Light survives in small hands": "Mira lights a lamp for a stranger"}
+}
+
+@dataclass
+class FakeBackendConfig:
+    """
+    Behaviour of the fake backend. latency is the wait before the first token,
+    tokens_per_second the generation speed after it (0 means instant).
+    failure_rate of the calls raise a throttling error carrying retry_after.
+    """
+    latency: float = 0.05
+    tokens_per_second: float = 2000.0
+    completion_tokens: int = 600
+    failure_rate: float = 0.0
+    failure_status: int = 429
+    retry_after: Optional[float] = 0.0
+    seed: int = 0
+
+class FakeAPIError(Exception):
+    """
+    Shaped like groq.APIStatusError as far as the scheduler looks at it.
+    """
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"Fake backend returned {status_code}")
+        self.status_code = status_code
+        headers = {} if retry_after is None else {"retry-after": str(retry_after)}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+class _FakeBackend:
+    def __init__(self, config: Optional[FakeBackendConfig] = None):
+        self.config = config or FakeBackendConfig()
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+
+    def plan(self, messages: List[Dict[str, str]], max_tokens: int):
+        """
+        Decide the outcome of one call: raises the injected failure, or returns
+        the response text, its token count and the time generating it takes.
+        """
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.config.failure_rate
+            if failed:
+                self.failures += 1
+        if failed:
+            raise FakeAPIError(self.config.failure_status, self.config.retry_after)
+
+        content = fake_response(messages, min(self.config.completion_tokens, max_tokens))
+        completion_tokens = estimate_tokens(content)
+        generation = completion_tokens / self.config.tokens_per_second if self.config.tokens_per_second else 0.0
+        return content, completion_tokens, generation
+
+    def completion(self, model: str, messages: List[Dict[str, str]], content: str, completion_tokens: int):
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content), finish_reason="stop")],
+            usage=_usage(messages, completion_tokens)
+        )
+
+    def chunks(self, messages: List[Dict[str, str]], content: str, completion_tokens: int) -> List[Any]:
+        words = content.split(" ")
+        step = STREAM_CHUNK_TOKENS
+        pieces = [" ".join(words[i:i + step]) + (" " if i + step < len(words) else "") for i in range(0, len(words), step)]
+        chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], x_groq=None)
+            for piece in pieces
+        ]
+        chunks.append(SimpleNamespace(choices=[], x_groq=SimpleNamespace(usage=_usage(messages, completion_tokens))))
+        return chunks
+
+class _Completions:
+    def __init__(self, backend: _FakeBackend):
+        self._backend = backend
+
+    def create(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float = 1.0,
+        max_tokens: int = 1024,
+        stream: bool = False,
+        **kwargs
+    ):
+        content, completion_tokens, generation = self._backend.plan(messages, max_tokens)
+        if stream:
+            return self._stream(messages, content, completion_tokens, generation)
+        time.sleep(self._backend.config.latency + generation)
+        return self._backend.completion(model, messages, content, completion_tokens)
+
+    def _stream(self, messages, content, completion_tokens, generation) -> Iterator[Any]:
+        chunks = self._backend.chunks(messages, content, completion_tokens)
+        time.sleep(self._backend.config.latency)
+        for chunk in chunks:
+            time.sleep(generation / len(chunks))
+            yield chunk
+
+class _AsyncCompletions(_Completions):
+    async def create(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float = 1.0,
+        max_tokens: int = 1024,
+        stream: bool = False,
+        **kwargs
+    ):
+        content, completion_tokens, generation = self._backend.plan(messages, max_tokens)
+        if stream:
+            return self._astream(messages, content, completion_tokens, generation)
+        await asyncio.sleep(self._backend.config.latency + generation)
+        return self._backend.completion(model, messages, content, completion_tokens)
+
+    async def _astream(self, messages, content, completion_tokens, generation) -> AsyncIterator[Any]:
+        chunks = self._backend.chunks(messages, content, completion_tokens)
+        await asyncio.sleep(self._backend.config.latency)
+        for chunk in chunks:
+            await asyncio.sleep(generation / len(chunks))
+            yield chunk
+
+class FakeGroq:
+    """
+    Stand-in for groq.Groq: deterministic responses, simulated latency and
+    token rate, and injected failures. Pass as LLMProvider(client=...).
+    """
+    def __init__(self, config: Optional[FakeBackendConfig] = None):
+        self.backend = _FakeBackend(config)
+        self.chat = SimpleNamespace(completions=_Completions(self.backend))
+
+class FakeAsyncGroq:
+    """
+    Stand-in for groq.AsyncGroq, pass as AsyncLLMProvider(async_client=...).
+    """
+    def __init__(self, config: Optional[FakeBackendConfig] = None):
+        self.backend = _FakeBackend(config)
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(self.backend))
+
+def fake_response(messages: List[Dict[str, str]], completion_tokens: int) -> str:
+    """
+    Deterministic reply to a prompt: the JSON an agent asks for, or prose of
+    about completion_tokens tokens seeded by the prompt.
+    """
+    system = messages[0].get("content", "") if messages else ""
+    if '"plot_threads"' in system:
+        return json.dumps(STORY_STRUCTURE)
+    if '"character_developments"' in system:
+        return json.dumps(NARRATIVE_ANALYSIS)
+    if '"transitions"' in system:
+        seams = user_seams(messages)
+        return json.dumps({"transitions": [{"after_scene": seam, "text": "Night fell over the harbour."} for seam in seams]})
+
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+    rng = random.Random(digest)
+    words = [rng.choice(_VOCABULARY) for _ in range(max(1, completion_tokens - 4))]
+    if "scene outlines" in system:
+        # A layout the scene-parallel writer can split
+        per_scene = max(1, len(words) // FAKE_SCENES)
+        return "\n".join(
+            f"Scene {number}: The Fake Scene {number}\n" + "".join(words[(number - 1) * per_scene:number * per_scene]).strip()
+            for number in range(1, FAKE_SCENES + 1)
+        )
+    return "Chapter 1: The Fake Chapter\n" + "".join(words).strip()
+
+def user_seams(messages: List[Dict[str, str]]) -> List[int]:
+    content = messages[-1].get("content", "") if messages else ""
+    return [int(number) for number in re.findall(r"After scene (\d+):", content)]
+
+def _usage(messages: List[Dict[str, str]], completion_tokens: int):
+    prompt_tokens = estimate_message_tokens(messages)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    )
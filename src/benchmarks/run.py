@@ -0,0 +1,406 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import replace
+from typing import Any, Callable, Dict, List, Optional
+
+from models.story_context import StoryContext
+from utils.llm_provider import AsyncLLMProvider
+from utils.llm_cache import LLMCache
+from utils.rate_limiter import RateLimit, RequestScheduler, DEFAULT_RATE_LIMITS
+from utils.metrics import MetricsCollector
+from utils.model_router import ModelRouter
+from utils.tokens import estimate_message_tokens
+from utils.get_pdf import create_pdf
+from agents.plot_planner import PlotPlannerAgent
+from agents.summary_agent import ChapterSummaryAgent
+from agents.chapter_writer import ChapterWritingAgent, DRAFT_MODES
+from agents.narrative_tracker import NarrativeTrackingAgent
+from agents.chapter_refiner import ChapterRefinerAgent
+from agents.scene_writer import ScenePlanningAgent
+from pipeline.chapter_stages import build_chapter_graph
+from pipeline.story_pipeline import StoryPipeline
+from pipeline.checkpoint import CheckpointStore
+from benchmarks.fake_groq import FakeAsyncGroq, FakeBackendConfig, FakeGroq, STORY_STRUCTURE
+
+SUITES = ["throughput", "stage_overhead", "context", "pdf", "startup", "scenes"]
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Limits high enough that the scheduler never throttles the fake backend
+UNLIMITED = RateLimit(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks against a fake Groq backend; results are printed as JSON."
+    )
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"Comma separated subset of {', '.join(SUITES)}")
+    parser.add_argument("--output", default="-", help="JSON file to write results to (default: stdout)")
+    parser.add_argument("--chapters", type=int, default=5, help="Chapters per throughput run")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake time to first token, seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=2000.0, help="Fake generation speed, 0 for instant")
+    parser.add_argument("--completion-tokens", type=int, default=600, help="Fake completion length")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of fake calls that fail with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-rate-limits", action="store_true",
+                        help="Throttle with the Groq free-tier limits instead of running unthrottled")
+    parser.add_argument("--iterations", type=int, default=20, help="Chapters timed by stage_overhead")
+    parser.add_argument("--context-sizes", default="0,10,100,1000",
+                        help="Plot threads, tensions and character arcs added per context benchmark")
+    parser.add_argument("--pdf-chapters", default="10,50,100,500", help="Book sizes for the pdf benchmark")
+    parser.add_argument("--pdf-words", type=int, default=2500, help="Words per chapter in the pdf benchmark")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreters timed per import in the startup benchmark")
+    parser.add_argument("--chapter-tokens", type=int, default=3500,
+                        help="Fake length of a chapter written in one pass, in the scenes benchmark")
+    return parser.parse_args(argv)
+
+def build_provider(config: FakeBackendConfig, real_rate_limits: bool = False) -> AsyncLLMProvider:
+    limits = DEFAULT_RATE_LIMITS if real_rate_limits else {model: UNLIMITED for model in DEFAULT_RATE_LIMITS}
+    return AsyncLLMProvider(
+        api_key="benchmark",
+        scheduler=RequestScheduler(limits=limits),
+        metrics=MetricsCollector(),
+        client=FakeGroq(config),
+        async_client=FakeAsyncGroq(config)
+    )
+
+def story_context() -> StoryContext:
+    return StoryContext(
+        title=STORY_STRUCTURE["title"],
+        genre=STORY_STRUCTURE["genre"],
+        central_theme=STORY_STRUCTURE["central_theme"],
+        protagonist=dict(STORY_STRUCTURE["protagonist"]),
+        antagonist=dict(STORY_STRUCTURE["antagonist"]),
+        active_plot_threads=list(STORY_STRUCTURE["plot_threads"]),
+        unresolved_tensions=list(STORY_STRUCTURE["tensions"])
+    )
+
+def run_sequential(llm_provider: AsyncLLMProvider, num_chapters: int):
+    """
+    The chapter loop of main.py without the UI: the draft is streamed, the
+    refined text kept, and summary and narrative read the draft.
+    """
+    scene_planner = ScenePlanningAgent(llm_provider)
+    chapter_writer = ChapterWritingAgent(llm_provider)
+    chapter_refiner = ChapterRefinerAgent(llm_provider)
+    summary_agent = ChapterSummaryAgent(llm_provider)
+    narrative_tracker = NarrativeTrackingAgent(llm_provider)
+
+    context = story_context()
+    previous_summary = None
+    for i in range(num_chapters):
+        chapter_info = [i + 1, num_chapters]
+        scene_layout = scene_planner.plan_chapter_scenes(context, chapter_info, previous_summary)
+        chapter_content = "".join(chapter_writer.stream_chapter(context, chapter_info, scene_layout, previous_summary))
+        chapter_refiner.refine_chapter(context, chapter_info, chapter_content, scene_layout)
+        previous_summary = summary_agent.update_summary_memory(chapter_content, previous_summary)
+        context = narrative_tracker.analyze_chapter_narrative(context, chapter_content, previous_summary)
+
+async def run_pipelined(llm_provider: AsyncLLMProvider, num_chapters: int):
+    async for _ in StoryPipeline(llm_provider).achapters(story_context(), num_chapters):
+        pass
+
+def bench_throughput(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    results = []
+    runs = [
+        ("sequential", lambda provider: run_sequential(provider, args.chapters)),
+        ("pipelined", lambda provider: asyncio.run(run_pipelined(provider, args.chapters))),
+    ]
+    for mode, run in runs:
+        llm_provider = build_provider(config, args.real_rate_limits)
+        started = time.perf_counter()
+        run(llm_provider)
+        wall = time.perf_counter() - started
+        totals = llm_provider.metrics.totals()
+        results.append({
+            "mode": mode,
+            "chapters": args.chapters,
+            "wall_seconds": wall,
+            "chapters_per_minute": args.chapters * 60 / wall if wall else 0.0,
+            "llm_calls": totals["calls"],
+            "llm_seconds": totals["latency"],
+            "retries": totals["retries"],
+            "prompt_tokens": totals["prompt_tokens"],
+            "completion_tokens": totals["completion_tokens"],
+        })
+    return results
+
+def bench_stage_overhead(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    """
+    Local cost of each stage (prompt building, scheduling, metrics, parsing)
+    with a backend that answers instantly. Producing the fake text is included.
+    """
+    instant = replace(config, latency=0.0, tokens_per_second=0.0, failure_rate=0.0, completion_tokens=64)
+    llm_provider = build_provider(instant)
+    agents = (
+        ScenePlanningAgent(llm_provider),
+        ChapterWritingAgent(llm_provider),
+        ChapterRefinerAgent(llm_provider),
+        ChapterSummaryAgent(llm_provider),
+        NarrativeTrackingAgent(llm_provider),
+    )
+    timings: Dict[str, List[float]] = {}
+    graph_seconds = []
+
+    def timed(name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.setdefault(name, []).append(time.perf_counter() - started)
+        return run
+
+    context = story_context()
+    previous_summary = None
+    for chapter in range(1, args.iterations + 1):
+        graph = build_chapter_graph(*agents)
+        for stage in graph.stages.values():
+            stage.func = timed(stage.name, stage.func)
+        started = time.perf_counter()
+        outputs = graph.run_all(["summary", "narrative"], {
+            "story_context": context,
+            "chapter_info": [chapter, args.iterations],
+            "previous_summary": previous_summary
+        })
+        graph_seconds.append(time.perf_counter() - started)
+        context, previous_summary = outputs["narrative"], outputs["summary"]
+
+    results = [_distribution({"stage": name}, samples) for name, samples in timings.items()]
+    stage_total = [sum(samples[i] for samples in timings.values()) for i in range(len(graph_seconds))]
+    results.append(_distribution({"stage": "graph_bookkeeping"}, [
+        total - stages for total, stages in zip(graph_seconds, stage_total)
+    ]))
+    return results
+
+def bench_context(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    """
+    Cost of turning a growing StoryContext into each agent's prompt.
+    """
+    llm_provider = build_provider(config)
+    scene_planner = ScenePlanningAgent(llm_provider)
+    chapter_writer = ChapterWritingAgent(llm_provider)
+    chapter_refiner = ChapterRefinerAgent(llm_provider)
+    narrative_tracker = NarrativeTrackingAgent(llm_provider)
+    summary = "The lamplighters argued about the beacon until dawn. " * 20
+    chapter = "Mira ran along the flooded quay. " * 400
+
+    results = []
+    for size in [int(size) for size in args.context_sizes.split(",") if size]:
+        context = story_context()
+        context = context.replace(
+            active_plot_threads=context.active_plot_threads
+            + tuple(f"Plot thread {i} - the thread moved on in chapter {i}" for i in range(size)),
+            unresolved_tensions=context.unresolved_tensions
+            + tuple(f"Tension {i} between the guilds over the harbour" for i in range(size)),
+            character_arcs={
+                f"Character {i}": [{"arc_progression": "Changed", "emotional_state": "Tense", "key_decision": "Stayed"}]
+                for i in range(size)
+            }
+        )
+        builders = {
+            "scene_planner": lambda: scene_planner._build_plan_messages(context, [2, 10], summary),
+            "chapter_writer": lambda: chapter_writer._build_chapter_messages(context, [2, 10], summary, summary),
+            "chapter_refiner": lambda: chapter_refiner._build_refine_messages(context, [2, 10], chapter, summary),
+            "narrative_tracker": lambda: narrative_tracker._build_analysis_messages(context, chapter, summary),
+        }
+        for agent, build in builders.items():
+            samples = []
+            for _ in range(args.iterations):
+                started = time.perf_counter()
+                messages = build()
+                samples.append(time.perf_counter() - started)
+            row = _distribution({"agent": agent, "context_size": size}, samples)
+            row["prompt_tokens"] = estimate_message_tokens(messages)
+            results.append(row)
+    return results
+
+def bench_pdf(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    paragraph = ("Mira held the lantern higher as the tide pulled at the steps. " * 10).strip()
+    paragraphs_per_chapter = max(1, args.pdf_words // len(paragraph.split()))
+    body = "\n\n".join([paragraph] * paragraphs_per_chapter)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for count in [int(count) for count in args.pdf_chapters.split(",") if count]:
+            chapters = [f"Chapter {i}: The Long Night {i}\n{body}" for i in range(1, count + 1)]
+            path = os.path.join(directory, f"book-{count}.pdf")
+            tracemalloc.start()
+            started = time.perf_counter()
+            create_pdf(path, STORY_STRUCTURE["title"], STORY_STRUCTURE["central_theme"], chapters)
+            seconds = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({
+                "chapters": count,
+                "words_per_chapter": paragraphs_per_chapter * len(paragraph.split()),
+                "seconds": seconds,
+                "peak_memory_bytes": peak,
+                "file_bytes": os.path.getsize(path),
+            })
+    return results
+
+def bench_startup(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    """
+    Cold start: importing each app in a fresh interpreter, next to importing
+    the export code it now loads lazily. Per rerun: building the provider,
+    agents, response cache and checkpoint store as the apps did on every
+    rerun, against taking them from the registry.
+    """
+    from utils.registry import checkpoint_store, session_agents, session_provider
+
+    results = []
+    env = {**os.environ, "GROQ_API_KEY": os.getenv("GROQ_API_KEY", "benchmark")}
+    imports = {"app": "import app", "main": "import main", "app_with_export": "import app, utils.export"}
+    for name, statement in imports.items():
+        samples = []
+        for _ in range(args.startup_runs):
+            output = subprocess.run(
+                [sys.executable, "-c", f"import time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started)"],
+                cwd=SOURCE_DIR, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            samples.append(float(output.strip().splitlines()[-1]))
+        results.append(_distribution({"phase": "cold_import", "target": name}, samples))
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "llm.sqlite")
+        checkpoint_path = os.path.join(directory, "checkpoints.sqlite")
+        saved_env = {key: os.environ.get(key) for key in ("GROQ_API_KEY", "LLM_CACHE_PATH")}
+        os.environ.update({"GROQ_API_KEY": env["GROQ_API_KEY"], "LLM_CACHE_PATH": cache_path})
+        try:
+            def rebuild():
+                llm_provider = AsyncLLMProvider(
+                    api_key=env["GROQ_API_KEY"],
+                    cache=LLMCache(path=cache_path),
+                    metrics=MetricsCollector(),
+                    router=ModelRouter()
+                )
+                for agent in (PlotPlannerAgent, ChapterSummaryAgent, ChapterWritingAgent,
+                              NarrativeTrackingAgent, ChapterRefinerAgent, ScenePlanningAgent):
+                    agent(llm_provider)
+                CheckpointStore(checkpoint_path)
+
+            state: Dict[str, Any] = {}
+            def registry():
+                session_provider(state)
+                session_agents(state)
+                checkpoint_store(checkpoint_path)
+
+            for name, build in [("rebuild_every_rerun", rebuild), ("registry", registry)]:
+                build()
+                samples = []
+                for _ in range(args.iterations):
+                    started = time.perf_counter()
+                    build()
+                    samples.append(time.perf_counter() - started)
+                results.append(_distribution({"phase": "rerun", "target": name}, samples))
+        finally:
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+    return results
+
+def bench_scenes(args, config: FakeBackendConfig) -> List[Dict[str, Any]]:
+    """
+    Drafting a chapter in one completion against drafting its scenes at once
+    and joining them. The fake backend writes max_tokens for every call, so a
+    scene takes its share of the chapter plus headroom.
+    """
+    chapter = replace(config, completion_tokens=args.chapter_tokens)
+    layout_provider = build_provider(config)
+    context = story_context()
+    layouts = [
+        ScenePlanningAgent(layout_provider).plan_chapter_scenes(context, [i + 1, args.chapters])
+        for i in range(args.chapters)
+    ]
+
+    results = []
+    for mode in DRAFT_MODES:
+        llm_provider = build_provider(chapter)
+        chapter_writer = ChapterWritingAgent(llm_provider, mode=mode)
+        samples = []
+        for i, layout in enumerate(layouts):
+            started = time.perf_counter()
+            asyncio.run(chapter_writer.agenerate_chapter(context, [i + 1, args.chapters], layout))
+            samples.append(time.perf_counter() - started)
+        records = llm_provider.metrics.records()
+        row = _distribution({"mode": mode, "chapters": args.chapters}, samples)
+        row["llm_calls"] = len(records)
+        row["longest_call_ms"] = max(record.latency for record in records) * 1000
+        row["completion_tokens"] = sum(record.completion_tokens for record in records)
+        results.append(row)
+    return results
+
+BENCHMARKS = {
+    "throughput": bench_throughput,
+    "stage_overhead": bench_stage_overhead,
+    "context": bench_context,
+    "pdf": bench_pdf,
+    "startup": bench_startup,
+    "scenes": bench_scenes,
+}
+
+def run_benchmarks(args) -> Dict[str, Any]:
+    config = FakeBackendConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        failure_rate=args.failure_rate,
+        seed=args.seed
+    )
+    suites = [suite.strip() for suite in args.suites.split(",") if suite.strip()]
+    unknown = [suite for suite in suites if suite not in BENCHMARKS]
+    if unknown:
+        raise SystemExit(f"Unknown benchmark suites: {', '.join(unknown)}")
+
+    results = {}
+    for suite in suites:
+        print(f"Running {suite}...", file=sys.stderr)
+        results[suite] = BENCHMARKS[suite](args, config)
+    return {"meta": _meta(args), "results": results}
+
+def _distribution(row: Dict[str, Any], samples: List[float]) -> Dict[str, Any]:
+    ordered = sorted(samples)
+    row.update({
+        "samples": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    })
+    return row
+
+def _meta(args) -> Dict[str, Any]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": time.time(),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,51 @@
 import streamlit as st
 import os
+import uuid
 from dotenv import load_dotenv
 
-from utils.llm_provider import LLMProvider
-from utils.get_pdf import create_pdf
-from utils.overview import story_overview
-from agents.plot_planner import PlotPlannerAgent
-from agents.summary_agent import ChapterSummaryAgent
-from agents.chapter_writer import ChapterWritingAgent
-from agents.narrative_tracker import NarrativeTrackingAgent
-from agents.chapter_refiner import ChapterRefinerAgent
-from agents.scene_writer import ScenePlanningAgent
+from utils.overview import (
+    story_overview, cache_overview, scheduler_overview, refinement_overview, metrics_overview, export_overview
+)
+from utils.metrics import metric_tags
+from utils.registry import (
+    checkpoint_store, event_loop, export_manager, process_metrics, session_agents, session_provider
+)
+from utils.retrieval import RetrievalIndex
+from utils.llm_provider import LLMProviderError
+from utils.structured_output import StructuredOutputError
+from pipeline.pipelined import iterate_sync
+from pipeline.story_pipeline import StoryPipeline
 
 # Load environment variables
 load_dotenv()
 
+# Failures a story can be resumed after, e.g. API retries running out on a 429
+# or a model answer that stayed invalid after re-asking
+RETRYABLE_ERRORS = (LLMProviderError, StructuredOutputError)
+
+def show_generation_error(error):
+    """
+    Reports a failed generation. Finished stages stay checkpointed, so the
+    story can be resumed from where it stopped.
+    """
+    st.error(f"Generation failed: {error}. Resume the story to continue from the last completed step.")
+
+def show_pipelined_chapters(story_pipeline, story_context, num_chapters, story_id,
+                            previous_summary=None, start_chapter=1):
+    for result in iterate_sync(story_pipeline.achapters(
+        story_context, num_chapters, previous_summary, start_chapter=start_chapter, story_id=story_id,
+        retrieval=RetrievalIndex.from_chapters(st.session_state["generated_chapters"])
+    ), loop=event_loop()):
+        st.session_state["generated_chapters"].append(result.refined)
+        with st.expander(f"Chapter {result.chapter}"):
+            st.write(result.refined)
+            st.write("### Chapter Summary")
+            st.write(result.summary.latest)
+            st.caption(
+                f"{result.timing.wall_seconds:.1f}s wall clock, "
+                f"{result.timing.saved_seconds:.1f}s saved by overlapping stages"
+            )
+
 def main():
     st.set_page_config(layout="wide")
     st.title("Infinite Fiction Generator")
@@ -27,16 +58,44 @@ def main():
     if "generated_chapters" not in st.session_state:
         st.session_state["generated_chapters"] = []
 
-    # Initialize LLM Provider
-    llm_provider = LLMProvider(api_key=os.getenv('GROQ_API_KEY'))
+    # LLM Provider and Agents, kept for the session on process-wide clients
+    llm_provider = session_provider(st.session_state)
+    agents = session_agents(st.session_state)
+    plot_planner = agents.plot_planner
+    summary_agent = agents.summary_agent
+    chapter_writer = agents.chapter_writer
+    chapter_refiner = agents.chapter_refiner
+    narrative_tracker = agents.narrative_tracker
+    scene_planner = agents.scene_planner
+    checkpoints = checkpoint_store(os.getenv('CHECKPOINT_PATH', '.cache/checkpoints.sqlite'))
     
-    # Initialize Agents
-    plot_planner = PlotPlannerAgent(llm_provider)
-    summary_agent = ChapterSummaryAgent(llm_provider)
-    chapter_writer = ChapterWritingAgent(llm_provider)
-    chapter_refiner = ChapterRefinerAgent(llm_provider)
-    narrative_tracker = NarrativeTrackingAgent(llm_provider)
-    scene_planner = ScenePlanningAgent(llm_provider)
+    # Offer to finish a story that was interrupted, its id is kept in the URL
+    checkpoint = checkpoints.load_story(st.query_params["story"]) if "story" in st.query_params else None
+    if checkpoint is not None and len(checkpoint.completed_chapters()) < checkpoint.num_chapters:
+        if st.button(f"Resume \"{checkpoint.story_context.title}\""):
+            state = checkpoint.resume_state()
+            st.session_state["story_title"] = checkpoint.story_context.title
+            st.session_state["story_theme"] = checkpoint.story_context.central_theme
+            st.session_state["generated_chapters"] = list(state["chapters"])
+            
+            story_overview(checkpoint.story_context.__dict__)
+            for i, chapter in enumerate(state["chapters"]):
+                with st.expander(f"Chapter {i+1}"):
+                    st.write(chapter)
+            
+            try:
+                show_pipelined_chapters(
+                    StoryPipeline(
+                        llm_provider, checkpoints=checkpoints, refine_mode=chapter_refiner.mode, draft_mode=chapter_writer.mode
+                    ),
+                    state["story_context"],
+                    checkpoint.num_chapters,
+                    checkpoint.story_id,
+                    state["previous_summary"],
+                    start_chapter=state["next_chapter"]
+                )
+            except RETRYABLE_ERRORS as e:
+                show_generation_error(e)
     
     # User Input
     story_prompt = st.text_input("Enter your story concept:")
@@ -49,68 +108,118 @@ def main():
     ])
     
     # Number of chapters to generate
-    num_chapters = st.slider("Number of Chapters", 1, 10, 3)
+    num_chapters = st.slider("Number of Chapters", 1, 200, 3)
+    pipelined = st.checkbox(
+        "Pipelined generation",
+        help="Overlap independent stages and start planning the next chapter early; chapters appear when complete instead of streaming."
+    )
 
     if st.button("Generate Story"):
-        # Generate Initial Story Context
-        story_context = plot_planner.generate_story_structure(
-            story_prompt, 
-            genre.lower()
-        )
+        try:
+            # Generate Initial Story Context
+            story_context = plot_planner.generate_story_structure(
+                story_prompt, 
+                genre.lower()
+            )
 
-        story_context_dict = story_context.__dict__
-        st.session_state["story_title"] = story_context_dict['title']
-        st.session_state["story_theme"] = story_context_dict['central_theme']
+            story_context_dict = story_context.__dict__
+            st.session_state["story_title"] = story_context_dict['title']
+            st.session_state["story_theme"] = story_context_dict['central_theme']
 
-        story_overview(story_context_dict)
+            story_overview(story_context_dict)
         
-        # Generate Chapters
-        st.session_state["generated_chapters"] = []
-        previous_summary = None
+            # Checkpoint every stage so an interrupted story can be resumed
+            story_id = uuid.uuid4().hex
+            checkpoints.save_story(story_id, story_prompt, genre.lower(), num_chapters, story_context, mode="main")
+            st.query_params["story"] = story_id
         
-        for i in range(num_chapters):
-            st.write(f"### Generating Chapter {i+1}")
+            # Generate Chapters
+            st.session_state["generated_chapters"] = []
+            previous_summary = None
+            retrieval = RetrievalIndex()
+        
+            if pipelined:
+                show_pipelined_chapters(
+                    StoryPipeline(
+                        llm_provider, checkpoints=checkpoints, refine_mode=chapter_refiner.mode, draft_mode=chapter_writer.mode
+                    ),
+                    story_context,
+                    num_chapters,
+                    story_id
+                )
+            else:
+                for i in range(num_chapters):
+                    with metric_tags(story_id=story_id, chapter=i + 1):
+                        st.write(f"### Generating Chapter {i+1}")
 
-            scene_layout = scene_planner.plan_chapter_scenes(
-                story_context,
-                [i + 1, num_chapters], 
-                previous_summary
-            )
+                        scene_layout = scene_planner.plan_chapter_scenes(
+                            story_context,
+                            [i + 1, num_chapters], 
+                            previous_summary,
+                            retrieval
+                        )
+                        checkpoints.save_stage(story_id, i + 1, "scene_layout", scene_layout)
 
-            # Generate Chapter
-            chapter_content = chapter_writer.generate_chapter(
-                story_context, 
-                [i + 1, num_chapters],
-                scene_layout,
-                previous_summary
-            )
+                        # Generate Chapter, streamed into its expander as it is written
+                        chapter_expander = st.expander(f"Chapter {i+1}", expanded=True)
+                        with chapter_expander:
+                            chapter_content = st.write_stream(chapter_writer.stream_chapter(
+                                story_context, 
+                                [i + 1, num_chapters],
+                                scene_layout,
+                                previous_summary,
+                                retrieval
+                            ))
+                        checkpoints.save_stage(story_id, i + 1, "draft", chapter_content)
 
-            # Refine chapter
-            refined_chapter_content = chapter_refiner.refine_chapter(
-                story_context,
-                [i + 1, num_chapters],
-                chapter_content,
-                scene_layout
-            )
+                        # Refine chapter
+                        refined_chapter_content = chapter_refiner.refine_chapter(
+                            story_context,
+                            [i + 1, num_chapters],
+                            chapter_content,
+                            scene_layout
+                        )
+                        checkpoints.save_stage(story_id, i + 1, "refined", refined_chapter_content)
+                        retrieval.add_chapter(i + 1, refined_chapter_content)
 
-            st.session_state["generated_chapters"].append(refined_chapter_content)
+                        st.session_state["generated_chapters"].append(refined_chapter_content)
             
-            # Generate Chapter Summary
-            chapter_summary = summary_agent.generate_chapter_summary(chapter_content, previous_summary)
-            previous_summary = chapter_summary
+                        # Generate Chapter Summary
+                        chapter_summary = summary_agent.update_summary_memory(refined_chapter_content, previous_summary)
+                        previous_summary = chapter_summary
+                        checkpoints.save_stage(story_id, i + 1, "summary", chapter_summary)
             
-            # Track Narrative Progression
-            story_context = narrative_tracker.analyze_chapter_narrative(
-                story_context, 
-                chapter_content,
-                previous_summary
-            )
+                        # Track Narrative Progression, the chapter stands without it
+                        try:
+                            story_context = narrative_tracker.analyze_chapter_narrative(
+                                story_context, 
+                                refined_chapter_content,
+                                previous_summary
+                            )
+                        except RETRYABLE_ERRORS as e:
+                            st.warning(f"Narrative tracking for chapter {i+1} failed ({e}), the story context was kept as it was.")
+                        checkpoints.save_stage(story_id, i + 1, "narrative", story_context)
             
-            # Display Chapter
-            with st.expander(f"Chapter {i+1}"):
-                st.write(chapter_content)
-                st.write("### Chapter Summary")
-                st.write(chapter_summary)
+                        # Display Chapter Summary
+                        with chapter_expander:
+                            st.write("### Chapter Summary")
+                            st.write(chapter_summary.latest)
+        except RETRYABLE_ERRORS as e:
+            show_generation_error(e)
+
+    if st.session_state["generated_chapters"]:
+        export_overview(
+            export_manager(),
+            st.session_state["story_title"],
+            st.session_state["story_theme"],
+            st.session_state["generated_chapters"]
+        )
+
+    cache_overview(llm_provider.cache.stats())
+    scheduler_overview(llm_provider.scheduler.stats())
+    refinement_overview(chapter_refiner.report(st.query_params.get("story")))
+    metrics_overview(st.session_state["metrics"], st.query_params.get("story"))
+    process_metrics().write_prometheus(os.getenv('METRICS_PROM_PATH', '.cache/metrics.prom'))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
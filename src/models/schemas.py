@@ -0,0 +1,56 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from models.story_context import StoryContext
+
+# Shapes of the JSON the agents ask models for, validated by
+# LLMProvider.generate_structured before anything reads them
+
+@dataclass
+class StoryStructure:
+    title: str
+    central_theme: str
+    protagonist: Dict[str, Any]
+    antagonist: Dict[str, Any] = field(default_factory=dict)
+    genre: str = ""
+    plot_threads: List[str] = field(default_factory=list)
+    tensions: List[str] = field(default_factory=list)
+
+    def to_story_context(self, genre: str) -> StoryContext:
+        return StoryContext(
+            title=self.title,
+            genre=genre,
+            central_theme=self.central_theme,
+            protagonist=self.protagonist,
+            antagonist=self.antagonist,
+            active_plot_threads=self.plot_threads,
+            unresolved_tensions=self.tensions
+        )
+
+@dataclass
+class NarrativeAnalysis:
+    character_developments: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    plot_thread_status: Dict[str, str] = field(default_factory=dict)
+    new_tensions: List[str] = field(default_factory=list)
+    thematic_progression: Dict[str, str] = field(default_factory=dict)
+
+@dataclass
+class ParagraphEdit:
+    # "replace" one paragraph, "delete" some, or "merge" consecutive ones into text
+    op: str
+    paragraphs: List[int]
+    text: str = ""
+
+@dataclass
+class EditScript:
+    edits: List[ParagraphEdit] = field(default_factory=list)
+
+@dataclass
+class SceneTransition:
+    # Bridge placed between scene after_scene and the one following it
+    after_scene: int
+    text: str = ""
+
+@dataclass
+class SceneTransitions:
+    transitions: List[SceneTransition] = field(default_factory=list)
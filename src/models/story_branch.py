@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Union
+
+from models.story_context import StoryContext
+from models.summary_memory import SummaryMemory
+
+@dataclass(frozen=True)
+class ChapterNode:
+    """
+    One generated chapter and the story state right after it. Nodes link back
+    to the previous chapter and are never changed, so branches share them.
+    """
+    chapter: int
+    text: str
+    summary: Union[SummaryMemory, str]
+    story_context: StoryContext
+    scene_layout: str = ""
+    parent: Optional["ChapterNode"] = None
+
+@dataclass(frozen=True)
+class StoryBranch:
+    """
+    A persistent line of chapters. Appending or forking returns a new branch
+    that shares every earlier chapter node with this one, so a branch costs
+    one small object no matter how long the shared prefix is.
+    """
+    initial_context: StoryContext
+    head: Optional[ChapterNode] = None
+    name: str = "main"
+
+    @property
+    def story_context(self) -> StoryContext:
+        """
+        Context to write the next chapter from.
+        """
+        return self.head.story_context if self.head else self.initial_context
+
+    @property
+    def previous_summary(self) -> Optional[Union[SummaryMemory, str]]:
+        return self.head.summary if self.head else None
+
+    @property
+    def next_chapter(self) -> int:
+        return self.head.chapter + 1 if self.head else 1
+
+    def nodes(self) -> List[ChapterNode]:
+        return list(reversed(list(self._walk())))
+
+    def chapters(self) -> List[str]:
+        return [node.text for node in self.nodes()]
+
+    def node(self, chapter: int) -> Optional[ChapterNode]:
+        for node in self._walk():
+            if node.chapter == chapter:
+                return node
+        return None
+
+    def append(self, text: str, summary: Union[SummaryMemory, str], story_context: StoryContext, scene_layout: str = "") -> "StoryBranch":
+        node = ChapterNode(self.next_chapter, text, summary, story_context, scene_layout, self.head)
+        return StoryBranch(self.initial_context, node, self.name)
+
+    def fork(self, chapter: int, name: str) -> "StoryBranch":
+        """
+        New branch that keeps chapters before `chapter` and continues from there.
+        """
+        if chapter < 1 or chapter > self.next_chapter:
+            raise ValueError(f"Cannot fork at chapter {chapter}, the branch has {self.next_chapter - 1} chapters")
+        head = self.head
+        while head is not None and head.chapter >= chapter:
+            head = head.parent
+        return StoryBranch(self.initial_context, head, name)
+
+    def _walk(self) -> Iterator[ChapterNode]:
+        node = self.head
+        while node is not None:
+            yield node
+            node = node.parent
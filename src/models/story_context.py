@@ -1,23 +1,42 @@
-from dataclasses import dataclass, field
-from typing import List, Dict, Any
+from dataclasses import dataclass, field, fields, replace
+from typing import Tuple, Dict, Any
 
-@dataclass
+@dataclass(frozen=True)
 class StoryContext:
+    """
+    Immutable snapshot of the story so far. Every update returns a new
+    snapshot with version incremented, so caches can key prompts on it.
+    """
     title: str = ""
     genre: str = ""
     central_theme: str = ""
     protagonist: Dict[str, Any] = field(default_factory=dict)
     antagonist: Dict[str, Any] = field(default_factory=dict)
-    
+
     # Narrative tracking
-    active_plot_threads: List[str] = field(default_factory=list)
-    unresolved_tensions: List[str] = field(default_factory=list)
-    character_arcs: Dict[str, List[str]] = field(default_factory=dict)
+    active_plot_threads: Tuple[str, ...] = ()
+    unresolved_tensions: Tuple[str, ...] = ()
+    character_arcs: Dict[str, Tuple[Any, ...]] = field(default_factory=dict)
+
+    version: int = 0
+
+    def __post_init__(self):
+        # Lists from the models and from checkpoint JSON are frozen on the way in
+        object.__setattr__(self, "active_plot_threads", tuple(self.active_plot_threads))
+        object.__setattr__(self, "unresolved_tensions", tuple(self.unresolved_tensions))
+        object.__setattr__(self, "character_arcs", {
+            character: tuple(arc) for character, arc in self.character_arcs.items()
+        })
+
+    def replace(self, **changes) -> "StoryContext":
+        """
+        A new snapshot with the given fields changed and the next version.
+        """
+        return replace(self, version=self.version + 1, **changes)
 
-    def update(self, new_context: Dict[str, Any]):
+    def update(self, new_context: Dict[str, Any]) -> "StoryContext":
         """
-        Dynamically update story context
+        Dynamically update story context, returning the new snapshot
         """
-        for key, value in new_context.items():
-            if hasattr(self, key):
-                setattr(self, key, value)
\ No newline at end of file
+        names = {story_field.name for story_field in fields(self)} - {"version"}
+        return self.replace(**{key: value for key, value in new_context.items() if key in names})
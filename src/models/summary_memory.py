@@ -0,0 +1,87 @@
+from dataclasses import dataclass, replace
+from typing import List, Optional, Tuple, Union
+
+# Summaries of one level that are rolled up into one of the next level
+ARC_SIZE = 5
+
+@dataclass(frozen=True)
+class SummaryMemory:
+    """
+    Hierarchical story memory: level 0 holds one summary per chapter, each
+    entry of level n + 1 summarises arc_size consecutive entries of level n,
+    and the synopsis covers the whole book.
+
+    Only the entries not yet rolled up are rendered into prompts, fewer than
+    arc_size per level, so the rendered memory grows with the logarithm of the
+    chapter count. Instances are immutable; every update returns a new one.
+    """
+    arc_size: int = ARC_SIZE
+    levels: Tuple[Tuple[str, ...], ...] = ()
+    synopsis: str = ""
+
+    @classmethod
+    def coerce(cls, value: Union["SummaryMemory", str, None]) -> "SummaryMemory":
+        """
+        Accept the rolling summary strings older checkpoints hold, as the synopsis.
+        """
+        if isinstance(value, SummaryMemory):
+            return value
+        return cls(synopsis=value or "")
+
+    @property
+    def chapters(self) -> int:
+        return len(self.levels[0]) if self.levels else 0
+
+    @property
+    def latest(self) -> str:
+        """
+        Summary of the most recent chapter.
+        """
+        return self.levels[0][-1] if self.chapters else self.synopsis
+
+    def add_chapter(self, summary: str) -> "SummaryMemory":
+        return self.add_summary(0, summary)
+
+    def add_summary(self, level: int, summary: str) -> "SummaryMemory":
+        levels = list(self.levels) + [()] * (level + 1 - len(self.levels))
+        levels[level] = levels[level] + (summary,)
+        return replace(self, levels=tuple(levels))
+
+    def with_synopsis(self, synopsis: str) -> "SummaryMemory":
+        return replace(self, synopsis=synopsis)
+
+    def rollup_due(self) -> Optional[Tuple[int, List[str]]]:
+        """
+        Lowest level with arc_size entries not yet rolled up, and those entries.
+        """
+        for level in range(len(self.levels)):
+            pending = self._pending(level)
+            if len(pending) >= self.arc_size:
+                return level, list(pending[:self.arc_size])
+        return None
+
+    def chapter_span(self, level: int, index: int) -> Tuple[int, int]:
+        """
+        First and last chapter covered by entry `index` of `level`.
+        """
+        width = self.arc_size ** level
+        return index * width + 1, min((index + 1) * width, self.chapters)
+
+    def render(self, include_synopsis: bool = True) -> str:
+        parts = []
+        if self.synopsis and include_synopsis:
+            parts.append(f"Story so far: {self.synopsis}")
+        for level in reversed(range(len(self.levels))):
+            first_pending = len(self.levels[level]) - len(self._pending(level))
+            for index in range(first_pending, len(self.levels[level])):
+                first, last = self.chapter_span(level, index)
+                span = f"Chapter {first}" if first == last else f"Chapters {first}-{last}"
+                parts.append(f"{span}: {self.levels[level][index]}")
+        return "\n".join(parts)
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def _pending(self, level: int) -> Tuple[str, ...]:
+        rolled_up = len(self.levels[level + 1]) * self.arc_size if level + 1 < len(self.levels) else 0
+        return self.levels[level][rolled_up:]
@@ -0,0 +1,61 @@
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from pipeline.stage_graph import StageGraph
+from agents.scene_writer import ScenePlanningAgent
+from agents.chapter_writer import ChapterWritingAgent
+from agents.chapter_refiner import ChapterRefinerAgent
+from agents.summary_agent import ChapterSummaryAgent
+from agents.narrative_tracker import NarrativeTrackingAgent
+from utils.retrieval import RetrievalIndex
+
+# Values the caller supplies on every run; everything else is a stage
+CHAPTER_INPUTS = ["story_context", "chapter_info", "previous_summary"]
+
+def build_chapter_graph(
+    scene_planner: ScenePlanningAgent,
+    chapter_writer: ChapterWritingAgent,
+    chapter_refiner: ChapterRefinerAgent,
+    summary_agent: ChapterSummaryAgent,
+    narrative_tracker: NarrativeTrackingAgent,
+    memo: Optional[Dict[str, Dict[str, Any]]] = None,
+    render: Optional[Callable[[Iterator[str]], str]] = None,
+    on_stage: Optional[Callable[[str, Any], None]] = None,
+    retrieval: Optional[RetrievalIndex] = None
+) -> StageGraph:
+    """
+    Per-chapter flow: scene_layout -> draft -> refined -> summary -> narrative.
+
+    When render is given (e.g. st.write_stream) the draft and refined stages
+    stream their text through it and memoize what it returns. on_stage is
+    called with every stage output as it is produced, e.g. to checkpoint it.
+    retrieval, an index of the earlier chapters, gives the planner and writer
+    passages to stay consistent with.
+    """
+    graph = StageGraph(memo, on_stage)
+
+    def scene_layout(story_context, chapter_info, previous_summary):
+        return scene_planner.plan_chapter_scenes(story_context, chapter_info, previous_summary, retrieval)
+
+    def draft(story_context, chapter_info, scene_layout, previous_summary):
+        if render:
+            return render(chapter_writer.stream_chapter(story_context, chapter_info, scene_layout, previous_summary, retrieval))
+        return chapter_writer.generate_chapter(story_context, chapter_info, scene_layout, previous_summary, retrieval)
+
+    def refined(story_context, chapter_info, draft, scene_layout):
+        if render:
+            return render(chapter_refiner.stream_refine_chapter(story_context, chapter_info, draft, scene_layout))
+        return chapter_refiner.refine_chapter(story_context, chapter_info, draft, scene_layout)
+
+    def summary(refined, previous_summary):
+        return summary_agent.update_summary_memory(refined, previous_summary)
+
+    def narrative(story_context, refined, summary):
+        # The tracker returns a new context, the memoized inputs stay untouched
+        return narrative_tracker.analyze_chapter_narrative(story_context, refined, summary)
+
+    graph.add_stage("scene_layout", scene_layout, ["story_context", "chapter_info", "previous_summary"])
+    graph.add_stage("draft", draft, ["story_context", "chapter_info", "scene_layout", "previous_summary"])
+    graph.add_stage("refined", refined, ["story_context", "chapter_info", "draft", "scene_layout"])
+    graph.add_stage("summary", summary, ["refined", "previous_summary"])
+    graph.add_stage("narrative", narrative, ["story_context", "refined", "summary"])
+    return graph
@@ -0,0 +1,277 @@
+from typing import Any, Dict, List, Optional
+from dataclasses import dataclass, field, asdict, is_dataclass
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from models.story_context import StoryContext
+from models.story_branch import StoryBranch
+from models.summary_memory import SummaryMemory
+
+# Stages of one chapter, in the order they complete
+CHAPTER_STAGES = ["scene_layout", "draft", "refined", "summary", "narrative"]
+# Optional per-chapter input: a context the user edited before the chapter started
+CONTEXT_OVERRIDE_STAGE = "story_context"
+
+@dataclass
+class StoryCheckpoint:
+    story_id: str
+    prompt: str
+    genre: str
+    num_chapters: int
+    mode: str
+    story_context: StoryContext
+    chapters: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    parent_id: Optional[str] = None
+    fork_chapter: Optional[int] = None
+
+    def completed_chapters(self) -> List[int]:
+        """
+        Leading run of chapters whose every stage is checkpointed.
+        """
+        completed = []
+        for chapter in range(1, self.num_chapters + 1):
+            stages = self.chapters.get(chapter, {})
+            if not all(stage in stages for stage in CHAPTER_STAGES):
+                break
+            completed.append(chapter)
+        return completed
+
+    def branch(self) -> StoryBranch:
+        """
+        The completed chapters as a persistent branch.
+        """
+        branch = StoryBranch(self.story_context, name=self.story_id)
+        for chapter in self.completed_chapters():
+            stages = self.chapters[chapter]
+            branch = branch.append(stages["refined"], stages["summary"], stages["narrative"], stages["scene_layout"])
+        return branch
+
+    def resume_state(self) -> Dict[str, Any]:
+        """
+        Context, summary and refined chapters as they stood after the last
+        completed chapter; the next chapter to generate is len(chapters) + 1.
+        """
+        branch = self.branch()
+        pending_stages = self.chapters.get(branch.next_chapter, {})
+        return {
+            "story_context": pending_stages.get(CONTEXT_OVERRIDE_STAGE, branch.story_context),
+            "previous_summary": branch.previous_summary,
+            "chapters": branch.chapters(),
+            "next_chapter": branch.next_chapter,
+            "pending_stages": pending_stages,
+        }
+
+class CheckpointStore:
+    """
+    Crash-safe record of every finished pipeline stage, in SQLite with WAL so a
+    Streamlit session and background writers can share the file.
+
+    The story row keeps the story's parameters and its initial context; each
+    chapter stage is a separate row keyed by (story_id, chapter, stage).
+    A fork only records its parent and fork chapter: stages of earlier
+    chapters are read from the parent, so forking copies nothing.
+    """
+    def __init__(self, path: str = ".cache/checkpoints.sqlite"):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS stories (
+                story_id TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                genre TEXT NOT NULL,
+                num_chapters INTEGER NOT NULL,
+                mode TEXT NOT NULL,
+                story_context TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                parent_id TEXT,
+                fork_chapter INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                story_id TEXT NOT NULL,
+                chapter INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (story_id, chapter, stage)
+            );
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(stories)")}
+        if "parent_id" not in columns:
+            # Stores written before branching existed
+            self._conn.execute("ALTER TABLE stories ADD COLUMN parent_id TEXT")
+            self._conn.execute("ALTER TABLE stories ADD COLUMN fork_chapter INTEGER")
+        self._conn.commit()
+
+    def save_story(
+        self,
+        story_id: str,
+        prompt: str,
+        genre: str,
+        num_chapters: int,
+        story_context: StoryContext,
+        mode: str = ""
+    ):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stories "
+                "(story_id, prompt, genre, num_chapters, mode, story_context, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT created FROM stories WHERE story_id = ?), ?), ?)",
+                (story_id, prompt or "", genre or "", num_chapters, mode, _dump(story_context), story_id, now, now)
+            )
+            self._conn.commit()
+
+    def fork_story(self, story_id: str, chapter: int, fork_id: Optional[str] = None, mode: Optional[str] = None) -> str:
+        """
+        Branch a story so that chapters before `chapter` are shared with it and
+        `chapter` onwards can be generated differently. Returns the fork's id.
+        """
+        fork_id = fork_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prompt, genre, num_chapters, mode, story_context FROM stories WHERE story_id = ?",
+                (story_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(story_id)
+            prompt, genre, num_chapters, parent_mode, story_context = row
+            self._conn.execute(
+                "INSERT INTO stories "
+                "(story_id, prompt, genre, num_chapters, mode, story_context, created, updated, parent_id, fork_chapter) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (fork_id, prompt, genre, num_chapters, mode or parent_mode, story_context, now, now, story_id, chapter)
+            )
+            self._conn.commit()
+        return fork_id
+
+    def save_stage(self, story_id: str, chapter: int, stage: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stages (story_id, chapter, stage, value, created) VALUES (?, ?, ?, ?, ?)",
+                (story_id, chapter, stage, _dump(value), now)
+            )
+            self._conn.execute("UPDATE stories SET updated = ? WHERE story_id = ?", (now, story_id))
+            self._conn.commit()
+
+    def discard_stages(self, story_id: str, chapter: int, stages: List[str]):
+        """
+        Drop checkpointed stages that an edit has made stale.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM stages WHERE story_id = ? AND chapter = ? AND stage = ?",
+                [(story_id, chapter, stage) for stage in stages]
+            )
+            self._conn.commit()
+
+    def chapter_stages(self, story_id: str, chapter: int) -> Dict[str, Any]:
+        with self._lock:
+            story_id = self._stage_owner(story_id, chapter)
+            rows = self._conn.execute(
+                "SELECT stage, value FROM stages WHERE story_id = ? AND chapter = ?", (story_id, chapter)
+            ).fetchall()
+        return {stage: _load(value) for stage, value in rows}
+
+    def load_story(self, story_id: str) -> Optional[StoryCheckpoint]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prompt, genre, num_chapters, mode, story_context, parent_id, fork_chapter "
+                "FROM stories WHERE story_id = ?",
+                (story_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            stage_rows = self._story_stage_rows(story_id)
+
+        prompt, genre, num_chapters, mode, story_context, parent_id, fork_chapter = row
+        checkpoint = StoryCheckpoint(
+            story_id, prompt, genre, num_chapters, mode, _load(story_context),
+            parent_id=parent_id, fork_chapter=fork_chapter
+        )
+        for chapter, stage, value in stage_rows:
+            checkpoint.chapters.setdefault(chapter, {})[stage] = _load(value)
+        return checkpoint
+
+    def list_stories(self, limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT story_id, prompt, num_chapters, mode, story_context, updated, parent_id, fork_chapter "
+                "FROM stories ORDER BY updated DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [
+            {
+                "story_id": story_id,
+                "prompt": prompt,
+                "num_chapters": num_chapters,
+                "mode": mode,
+                "title": _load(story_context).title,
+                "updated": updated,
+                "parent_id": parent_id,
+                "fork_chapter": fork_chapter,
+            }
+            for story_id, prompt, num_chapters, mode, story_context, updated, parent_id, fork_chapter in rows
+        ]
+
+    def delete_story(self, story_id: str):
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM stories WHERE parent_id = ?", (story_id,)).fetchone():
+                raise ValueError(f"Story {story_id} has forks that read its chapters")
+            self._conn.execute("DELETE FROM stages WHERE story_id = ?", (story_id,))
+            self._conn.execute("DELETE FROM stories WHERE story_id = ?", (story_id,))
+            self._conn.commit()
+
+    def _stage_owner(self, story_id: str, chapter: int) -> str:
+        # Walk up the forks until the story that generated this chapter
+        while True:
+            row = self._conn.execute(
+                "SELECT parent_id, fork_chapter FROM stories WHERE story_id = ?", (story_id,)
+            ).fetchone()
+            if row is None or row[0] is None or chapter >= row[1]:
+                return story_id
+            story_id = row[0]
+
+    def _story_stage_rows(self, story_id: str, before: Optional[int] = None) -> List[tuple]:
+        rows = self._conn.execute(
+            "SELECT chapter, stage, value FROM stages WHERE story_id = ?", (story_id,)
+        ).fetchall()
+        rows = [row for row in rows if before is None or row[0] < before]
+        parent_id, fork_chapter = self._conn.execute(
+            "SELECT parent_id, fork_chapter FROM stories WHERE story_id = ?", (story_id,)
+        ).fetchone()
+        if parent_id is not None:
+            limit = fork_chapter if before is None else min(fork_chapter, before)
+            own = {row[0] for row in rows}
+            rows += [row for row in self._story_stage_rows(parent_id, limit) if row[0] not in own]
+        return rows
+
+def _dump(value: Any) -> str:
+    if isinstance(value, StoryContext):
+        return json.dumps({"type": "story_context", "value": asdict(value)})
+    if isinstance(value, SummaryMemory):
+        return json.dumps({"type": "summary_memory", "value": asdict(value)})
+    if is_dataclass(value):
+        raise TypeError(f"Cannot checkpoint {type(value).__name__}")
+    return json.dumps({"type": "json", "value": value})
+
+def _load(payload: str) -> Any:
+    data = json.loads(payload)
+    if data["type"] == "story_context":
+        return StoryContext(**data["value"])
+    if data["type"] == "summary_memory":
+        value = data["value"]
+        return SummaryMemory(value["arc_size"], tuple(tuple(level) for level in value["levels"]), value["synopsis"])
+    return data["value"]
@@ -0,0 +1,205 @@
+from typing import Any, Dict, List, Optional
+import asyncio
+import threading
+import time
+
+from models.story_context import StoryContext
+from models.summary_memory import SummaryMemory
+from utils.llm_provider import AsyncLLMProvider
+from utils.metrics import metric_tags
+from utils.retrieval import RetrievalIndex
+from pipeline.checkpoint import CheckpointStore, CHAPTER_STAGES
+from pipeline.pipelined import ChapterResult
+from pipeline.story_pipeline import StoryPipeline
+
+ACTIVE_STATUSES = ("queued", "running")
+
+class GenerationJob:
+    """
+    A story's chapters being generated in the background. The runner's loop
+    thread updates it and UI threads poll it; read chapters through
+    results(), which copies under the lock. version goes up on every change.
+    """
+    def __init__(self, job_id: str, num_chapters: int, start_chapter: int):
+        self.job_id = job_id
+        self.num_chapters = num_chapters
+        self.start_chapter = start_chapter
+        self.status = "queued"
+        self.error: Optional[str] = None
+        # Latest completed stage and its chapter, e.g. (3, "draft")
+        self.chapter: Optional[int] = None
+        self.stage: Optional[str] = None
+        # Stage outputs of chapters in progress, e.g. a draft before refining
+        self.partial: Dict[int, Dict[str, Any]] = {}
+        self.version = 0
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._chapters: List[ChapterResult] = []
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cancel_requested = False
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def progress(self) -> float:
+        """
+        Share of this job's stages completed.
+        """
+        total = (self.num_chapters - self.start_chapter + 1) * len(CHAPTER_STAGES)
+        if total <= 0 or self.status == "done":
+            return 1.0
+        with self._lock:
+            finished = len(self._chapters) * len(CHAPTER_STAGES) + sum(len(stages) for stages in self.partial.values())
+        return min(1.0, finished / total)
+
+    def results(self, since: int = 0) -> List[ChapterResult]:
+        """
+        Chapters completed so far, skipping the first since of them.
+        """
+        with self._lock:
+            return list(self._chapters[since:])
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def cancel(self):
+        self._cancel_requested = True
+        if self._task is not None and not self.done:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def _on_stage(self, chapter: int, stage: str, value: Any):
+        with self._lock:
+            self.chapter = chapter
+            self.stage = stage
+            self.partial.setdefault(chapter, {})[stage] = value
+            self.version += 1
+
+    def _add_chapter(self, result: ChapterResult):
+        with self._lock:
+            self._chapters.append(result)
+            self.partial.pop(result.chapter, None)
+            self.version += 1
+
+    def _finish(self, status: str, error: Optional[str] = None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.finished_at = time.time()
+            self.version += 1
+        self._finished.set()
+
+class JobRunner:
+    """
+    Owns chapter generation so it does not run in a Streamlit script. Jobs
+    are tasks on one event loop running in a background thread; max_jobs run
+    at a time and the rest wait their turn. Jobs stay in the runner, keyed by
+    story id, until discarded, so a rerun or a refresh finds its job again
+    and polls it instead of starting over.
+
+    Every stage is checkpointed, so a failed or cancelled job submitted again
+    picks up where it stopped.
+    """
+    def __init__(
+        self,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        max_jobs: int = 4,
+        checkpoints: Optional[CheckpointStore] = None,
+        refine_mode: str = "rewrite",
+        draft_mode: str = "single"
+    ):
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="job-runner", daemon=True).start()
+        self.loop = loop
+        self.max_jobs = max_jobs
+        self.checkpoints = checkpoints
+        self.refine_mode = refine_mode
+        self.draft_mode = draft_mode
+        # Made on the loop's thread by the first job
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        llm_provider: AsyncLLMProvider,
+        story_id: str,
+        story_context: StoryContext,
+        num_chapters: int,
+        previous_summary: Optional[SummaryMemory] = None,
+        start_chapter: int = 1,
+        retrieval: Optional[RetrievalIndex] = None,
+        prefetch_next_scenes: bool = True
+    ) -> GenerationJob:
+        """
+        Start generating chapters start_chapter..num_chapters. A job already
+        queued or running for story_id is returned instead of a second one.
+        retrieval must not be shared with the caller; by default it is built
+        from the checkpointed chapters.
+        """
+        with self._lock:
+            job = self._jobs.get(story_id)
+            if job is not None and job.status in ACTIVE_STATUSES:
+                return job
+            job = GenerationJob(story_id, num_chapters, start_chapter)
+            self._jobs[story_id] = job
+
+        pipeline = StoryPipeline(
+            llm_provider,
+            prefetch_next_scenes=prefetch_next_scenes,
+            checkpoints=self.checkpoints,
+            refine_mode=self.refine_mode,
+            draft_mode=self.draft_mode
+        )
+        chapters = pipeline.achapters(
+            story_context, num_chapters, previous_summary, start_chapter, story_id, retrieval, job._on_stage
+        )
+        job._loop = self.loop
+        asyncio.run_coroutine_threadsafe(self._run(job, chapters), self.loop)
+        return job
+
+    def get(self, story_id: str) -> Optional[GenerationJob]:
+        with self._lock:
+            return self._jobs.get(story_id)
+
+    def jobs(self) -> List[GenerationJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def active_jobs(self) -> int:
+        return sum(job.status in ACTIVE_STATUSES for job in self.jobs())
+
+    def discard(self, story_id: str):
+        """
+        Forget a job, cancelling it first if it is still going.
+        """
+        with self._lock:
+            job = self._jobs.pop(story_id, None)
+        if job is not None:
+            job.cancel()
+
+    async def _run(self, job: GenerationJob, chapters):
+        job._task = asyncio.current_task()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_jobs)
+        try:
+            if job._cancel_requested:
+                raise asyncio.CancelledError()
+            # Nobody is waiting on a background chapter, interactive calls go first
+            async with self._slots:
+                job.status = "running"
+                with metric_tags(priority="batch"):
+                    async for result in chapters:
+                        job._add_chapter(result)
+            job._finish("done")
+        except asyncio.CancelledError:
+            job._finish("cancelled")
+        except Exception as e:
+            job._finish("failed", f"{type(e).__name__}: {e}")
+        finally:
+            await chapters.aclose()
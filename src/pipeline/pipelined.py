@@ -0,0 +1,270 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional
+from dataclasses import dataclass, field
+import asyncio
+import time
+
+from models.story_context import StoryContext
+from models.summary_memory import SummaryMemory
+from agents.scene_writer import ScenePlanningAgent
+from agents.chapter_writer import ChapterWritingAgent
+from agents.chapter_refiner import ChapterRefinerAgent
+from agents.summary_agent import ChapterSummaryAgent
+from agents.narrative_tracker import NarrativeTrackingAgent
+from utils.metrics import metric_tags
+from utils.retrieval import RetrievalIndex
+from pipeline.checkpoint import CheckpointStore, CONTEXT_OVERRIDE_STAGE
+
+@dataclass
+class ChapterTiming:
+    chapter: int
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+    @property
+    def serial_seconds(self) -> float:
+        return sum(self.stage_seconds.values())
+
+    @property
+    def saved_seconds(self) -> float:
+        """
+        Wall-clock time the overlap saved compared to running every stage back to back.
+        """
+        return max(0.0, self.serial_seconds - self.wall_seconds)
+
+@dataclass
+class ChapterResult:
+    chapter: int
+    scene_layout: str
+    draft: str
+    refined: str
+    summary: SummaryMemory
+    story_context: StoryContext
+    timing: ChapterTiming
+
+@dataclass
+class _ScenePrefetch:
+    task: asyncio.Task
+    timing: ChapterTiming
+    story_context: StoryContext
+
+class PipelinedChapterGenerator:
+    """
+    Generates chapters with independent stages overlapped on one event loop.
+
+    Narrative analysis of chapter N reads its summary, as in the sequential
+    path, so it starts when the summary is done. With prefetch_next_scenes,
+    chapter N+1's scene plan runs alongside it, using the story context from
+    before N's narrative update. When that update lands it is reconciled:
+    "keep" leaves the plan as is and lets the writer and refiner see the updated
+    context; "replan" plans again if the planning-relevant context changed.
+
+    With a checkpoint store and a story_id every finished stage is saved, and
+    stages already checkpointed are loaded instead of regenerated, so an
+    interrupted story resumes from its last completed stage.
+
+    Every refined chapter is added to a retrieval index as it lands, and the
+    planner and writer of later chapters look up earlier passages in it.
+
+    The agents must share an AsyncLLMProvider.
+    """
+    def __init__(
+        self,
+        scene_planner: ScenePlanningAgent,
+        chapter_writer: ChapterWritingAgent,
+        chapter_refiner: ChapterRefinerAgent,
+        summary_agent: ChapterSummaryAgent,
+        narrative_tracker: NarrativeTrackingAgent,
+        prefetch_next_scenes: bool = True,
+        reconcile: str = "keep",
+        checkpoints: Optional[CheckpointStore] = None
+    ):
+        if reconcile not in ("keep", "replan"):
+            raise ValueError(f"Unknown reconcile policy: {reconcile}")
+        self.scene_planner = scene_planner
+        self.chapter_writer = chapter_writer
+        self.chapter_refiner = chapter_refiner
+        self.summary_agent = summary_agent
+        self.narrative_tracker = narrative_tracker
+        self.prefetch_next_scenes = prefetch_next_scenes
+        self.reconcile = reconcile
+        self.checkpoints = checkpoints
+
+    async def agenerate(
+        self,
+        story_context: StoryContext,
+        num_chapters: int,
+        previous_summary: Optional[SummaryMemory] = None,
+        start_chapter: int = 1,
+        story_id: Optional[str] = None,
+        retrieval: Optional[RetrievalIndex] = None,
+        on_stage: Optional[Callable[[int, str, Any], None]] = None
+    ) -> AsyncIterator[ChapterResult]:
+        """
+        Without a retrieval index one is built from the checkpointed chapters
+        before start_chapter, if any. on_stage is called with the chapter,
+        stage and output of every stage as it completes, checkpointed or not.
+        """
+        if retrieval is None:
+            retrieval = RetrievalIndex()
+            for chapter in range(1, start_chapter):
+                refined = self._saved_stages(story_id, chapter).get("refined")
+                if refined:
+                    retrieval.add_chapter(chapter, refined)
+        prefetch: Optional[_ScenePrefetch] = None
+        chapter_started = time.perf_counter()
+
+        try:
+            for chapter in range(start_chapter, num_chapters + 1):
+                chapter_info = [chapter, num_chapters]
+                saved = self._saved_stages(story_id, chapter)
+                story_context = saved.get(CONTEXT_OVERRIDE_STAGE, story_context)
+
+                def stage(name, timing, make):
+                    return self._stage(story_id, chapter, saved, name, timing, make, on_stage)
+
+                if prefetch is not None:
+                    timing = prefetch.timing
+                    scene_layout = await prefetch.task
+                    if self.reconcile == "replan" and _planning_view(prefetch.story_context) != _planning_view(story_context):
+                        saved.pop("scene_layout", None)
+                        scene_layout = await stage("scene_layout", timing, lambda: self.scene_planner.aplan_chapter_scenes(
+                            story_context, chapter_info, previous_summary, retrieval
+                        ))
+                    prefetch = None
+                else:
+                    timing = ChapterTiming(chapter)
+                    scene_layout = await stage("scene_layout", timing, lambda: self.scene_planner.aplan_chapter_scenes(
+                        story_context, chapter_info, previous_summary, retrieval
+                    ))
+
+                draft = await stage("draft", timing, lambda: self.chapter_writer.agenerate_chapter(
+                    story_context, chapter_info, scene_layout, previous_summary, retrieval
+                ))
+                refined = await stage("refined", timing, lambda: self.chapter_refiner.arefine_chapter(
+                    story_context, chapter_info, draft, scene_layout
+                ))
+                retrieval.add_chapter(chapter, refined)
+
+                summary = SummaryMemory.coerce(await stage("summary", timing, lambda: self.summary_agent.aupdate_summary_memory(
+                    refined, previous_summary
+                )))
+                # The tracker returns a new context, ours stays intact for the prefetch
+                narrative_task = asyncio.ensure_future(stage("narrative", timing, lambda: self.narrative_tracker.aanalyze_chapter_narrative(
+                    story_context, refined, summary
+                )))
+
+                try:
+                    if self.prefetch_next_scenes and chapter < num_chapters:
+                        next_chapter = chapter + 1
+                        next_timing = ChapterTiming(next_chapter)
+                        next_saved = self._saved_stages(story_id, next_chapter)
+                        # Bind the pre-narrative context now, the task may start after it is replaced
+                        prefetch = _ScenePrefetch(
+                            task=asyncio.ensure_future(self._stage(
+                                story_id, next_chapter, next_saved, "scene_layout", next_timing,
+                                lambda context=story_context, summary=summary: self.scene_planner.aplan_chapter_scenes(
+                                    context, [next_chapter, num_chapters], summary, retrieval
+                                ),
+                                on_stage
+                            )),
+                            timing=next_timing,
+                            story_context=story_context
+                        )
+                    story_context = await narrative_task
+                finally:
+                    narrative_task.cancel()
+
+                previous_summary = summary
+                now = time.perf_counter()
+                timing.wall_seconds = now - chapter_started
+                chapter_started = now
+
+                yield ChapterResult(chapter, scene_layout, draft, refined, summary, story_context, timing)
+        finally:
+            if prefetch is not None:
+                prefetch.task.cancel()
+
+    def _saved_stages(self, story_id: Optional[str], chapter: int) -> Dict[str, Any]:
+        if self.checkpoints is None or story_id is None:
+            return {}
+        return self.checkpoints.chapter_stages(story_id, chapter)
+
+    async def _stage(
+        self,
+        story_id: Optional[str],
+        chapter: int,
+        saved: Dict[str, Any],
+        name: str,
+        timing: ChapterTiming,
+        make: Callable[[], Awaitable[Any]],
+        on_stage: Optional[Callable[[int, str, Any], None]] = None
+    ) -> Any:
+        if name in saved:
+            value = saved[name]
+        else:
+            with metric_tags(story_id=story_id, chapter=chapter):
+                value = await _timed(timing, name, make())
+            if self.checkpoints is not None and story_id is not None:
+                self.checkpoints.save_stage(story_id, chapter, name, value)
+        if on_stage is not None:
+            on_stage(chapter, name, value)
+        return value
+
+def iterate_sync(results: AsyncIterator[Any], loop: Optional[asyncio.AbstractEventLoop] = None) -> Iterator[Any]:
+    """
+    Drive an async generator from synchronous code such as a Streamlit script.
+    Background tasks it started keep their progress between items.
+
+    loop, an event loop running in another thread, runs the generator there
+    instead of on a new loop, so async clients bound to it keep their
+    connections across calls.
+    """
+    if loop is not None:
+        yield from _iterate_on(results, loop)
+        return
+    loop = asyncio.new_event_loop()
+    iterator = results.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.close()
+
+def _iterate_on(results: AsyncIterator[Any], loop: asyncio.AbstractEventLoop) -> Iterator[Any]:
+    # Items are awaited on the loop's thread; the caller's context vars, such
+    # as metric tags, travel with each step
+    iterator = results.__aiter__()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(_anext(iterator), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(_aclose(iterator), loop).result()
+
+async def _anext(iterator: AsyncIterator[Any]) -> Any:
+    return await iterator.__anext__()
+
+async def _aclose(iterator: AsyncIterator[Any]):
+    await iterator.aclose()
+
+async def _timed(timing: ChapterTiming, stage: str, awaitable: Awaitable[Any]) -> Any:
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timing.stage_seconds[stage] = timing.stage_seconds.get(stage, 0.0) + time.perf_counter() - started
+
+def _planning_view(story_context: StoryContext) -> tuple:
+    return (
+        story_context.title,
+        story_context.central_theme,
+        repr(story_context.protagonist),
+        tuple(story_context.active_plot_threads),
+        tuple(story_context.unresolved_tensions)
+    )
@@ -0,0 +1,116 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+from concurrent.futures import Future, CancelledError
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import time
+import uuid
+
+from utils.metrics import MetricsCollector, metric_tags
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Speculation:
+    speculation_id: str
+    stage: str
+    # StageGraph fingerprint of the inputs the stage was run with
+    key: str
+    future: Future
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+class Speculator:
+    """
+    Runs a stage ahead of the user on a background event loop, e.g. the draft
+    while the user is still reading the scene layout. When the stage is asked
+    for, take() hands the result over if it was started from the same inputs
+    (the StageGraph fingerprint) and discards it otherwise.
+
+    Speculative calls are tagged with priority "batch", so they never hold up
+    interactive calls, and with a speculation id, so their tokens can be
+    counted from the metrics as used or wasted once the speculation is taken
+    or discarded. A speculation cancelled while its request is in flight has
+    no usage to count.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, metrics: MetricsCollector):
+        self.loop = loop
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.used_tokens = 0
+        self.wasted_tokens = 0
+        self._running: Dict[str, Speculation] = {}
+
+    def start(self, stage: str, key: str, make: Callable[[], Awaitable[Any]], **tags):
+        """
+        Run make() for the stage unless it is already running from the same
+        inputs; a speculation from other inputs is discarded first.
+        """
+        current = self._running.get(stage)
+        if current is not None:
+            if current.key == key:
+                return
+            self._discard(current)
+        speculation_id = uuid.uuid4().hex[:12]
+        with metric_tags(priority="batch", speculation=speculation_id, **tags):
+            future = asyncio.run_coroutine_threadsafe(make(), self.loop)
+        speculation = Speculation(speculation_id, stage, key, future)
+        future.add_done_callback(lambda _: setattr(speculation, "finished", time.monotonic()))
+        self._running[stage] = speculation
+
+    def running(self, stage: str) -> bool:
+        return stage in self._running
+
+    def take(self, stage: str, key: str) -> Optional[Any]:
+        """
+        The speculative output of the stage if it was started from these
+        inputs, waiting for it if it is still running; None on a miss.
+        """
+        speculation = self._running.pop(stage, None)
+        if speculation is None:
+            return None
+        if speculation.key != key:
+            self._discard(speculation)
+            return None
+        try:
+            value = speculation.future.result()
+        except (Exception, CancelledError) as e:
+            logger.warning("Speculative %s failed (%s), running it again", stage, e)
+            self.misses += 1
+            self.wasted_tokens += self.metrics.speculation_tokens(speculation.speculation_id)
+            return None
+        self.hits += 1
+        self.used_tokens += self.metrics.speculation_tokens(speculation.speculation_id)
+        # Time the user did not wait: all of the run, or the part already done when asked
+        finished = speculation.finished or time.monotonic()
+        self.seconds_saved += finished - speculation.started
+        return value
+
+    def discard(self, stage: Optional[str] = None):
+        """
+        Drop the speculation of a stage, or every one, e.g. after user feedback.
+        """
+        stages = list(self._running) if stage is None else [stage]
+        for name in stages:
+            speculation = self._running.pop(name, None)
+            if speculation is not None:
+                self._discard(speculation)
+
+    def stats(self) -> Dict[str, Any]:
+        resolved = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "running": len(self._running),
+            "hit_rate": self.hits / resolved if resolved else 0.0,
+            "used_tokens": self.used_tokens,
+            "wasted_tokens": self.wasted_tokens,
+            "seconds_saved": self.seconds_saved,
+        }
+
+    def _discard(self, speculation: Speculation):
+        speculation.future.cancel()
+        self.misses += 1
+        self.wasted_tokens += self.metrics.speculation_tokens(speculation.speculation_id)
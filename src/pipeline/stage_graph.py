@@ -0,0 +1,148 @@
+from typing import List, Dict, Any, Callable, Optional
+from dataclasses import dataclass, is_dataclass, asdict
+import hashlib
+import json
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[..., Any]
+    deps: List[str]
+
+def fingerprint(values: Dict[str, Any]) -> str:
+    """
+    Stable hash of a stage's input values, dataclasses included.
+    """
+    payload = json.dumps(values, sort_keys=True, default=_encode)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _encode(value: Any) -> Any:
+    if is_dataclass(value):
+        return asdict(value)
+    return repr(value)
+
+class StageGraph:
+    """
+    Named stages wired by their dependencies, with memoized outputs.
+
+    A stage only runs when the values it depends on have changed since its output
+    was memoized, so asking for a late stage runs just the missing or stale part
+    of the graph. The memo is a plain dict that callers may keep between runs
+    (e.g. in st.session_state). Stage functions receive their dependencies as
+    keyword arguments named after them.
+    """
+    def __init__(
+        self,
+        memo: Optional[Dict[str, Dict[str, Any]]] = None,
+        on_stage: Optional[Callable[[str, Any], None]] = None
+    ):
+        self.stages: Dict[str, Stage] = {}
+        self.memo = {} if memo is None else memo
+        self.on_stage = on_stage
+        self.executed: List[str] = []
+
+    def add_stage(self, name: str, func: Callable[..., Any], deps: List[str]):
+        self.stages[name] = Stage(name, func, deps)
+
+    def run(self, target: str, inputs: Dict[str, Any]) -> Any:
+        return self._resolve(target, inputs, {})
+
+    def run_all(self, targets: List[str], inputs: Dict[str, Any]) -> Dict[str, Any]:
+        resolved = {}
+        return {target: self._resolve(target, inputs, resolved) for target in targets}
+
+    def override(self, name: str, value: Any, inputs: Optional[Dict[str, Any]] = None):
+        """
+        Pin a stage's output to an externally edited value, e.g. a scene layout the
+        user revised. Downstream stages see the new value and re-run. The pin holds
+        while the stage's own inputs are unchanged: those given here, or without
+        them, the ones its memoized output was computed from.
+        """
+        if inputs is not None:
+            stage_fingerprint = self.fingerprint_of(name, inputs)
+        else:
+            stage_fingerprint = self.memo.get(name, {}).get("fingerprint")
+        self.memo[name] = {"fingerprint": stage_fingerprint, "value": value, "pinned": True}
+        if self.on_stage:
+            self.on_stage(name, value)
+
+    def seed(self, name: str, value: Any, inputs: Dict[str, Any]):
+        """
+        Record an output produced elsewhere (e.g. restored from a checkpoint) as
+        if the stage had computed it from these inputs. Seed upstream stages first.
+        """
+        self.memo[name] = {"fingerprint": self.fingerprint_of(name, inputs), "value": value, "pinned": False}
+
+    def fingerprint_of(self, name: str, inputs: Dict[str, Any]) -> str:
+        """
+        Fingerprint the stage would run with, taking upstream stages from the memo.
+        """
+        stage = self.stages[name]
+        dep_values = {
+            dep: self.cached(dep) if dep in self.stages else inputs[dep]
+            for dep in stage.deps
+        }
+        return fingerprint(dep_values)
+
+    def memoized(self, name: str, inputs: Dict[str, Any]) -> bool:
+        """
+        Whether the stage's memoized output is current for these inputs.
+        """
+        entry = self.memo.get(name)
+        if not entry:
+            return False
+        if entry["pinned"] and entry["fingerprint"] is None:
+            return True
+        return entry["fingerprint"] == self.fingerprint_of(name, inputs)
+
+    def invalidate(self, name: str):
+        for stage in [name] + self.downstream(name):
+            self.memo.pop(stage, None)
+
+    def downstream(self, name: str) -> List[str]:
+        found = []
+        frontier = [name]
+        while frontier:
+            current = frontier.pop()
+            for stage in self.stages.values():
+                if current in stage.deps and stage.name not in found:
+                    found.append(stage.name)
+                    frontier.append(stage.name)
+        return found
+
+    def cached(self, name: str) -> Any:
+        entry = self.memo.get(name)
+        return entry["value"] if entry else None
+
+    def _resolve(self, name: str, inputs: Dict[str, Any], resolved: Dict[str, Any]) -> Any:
+        if name in resolved:
+            return resolved[name]
+
+        if name not in self.stages:
+            if name not in inputs:
+                raise KeyError(f"Unknown stage or input: {name}")
+            resolved[name] = inputs[name]
+            return resolved[name]
+
+        entry = self.memo.get(name)
+        if entry and entry["pinned"] and entry["fingerprint"] is None:
+            # Pinned without knowing its inputs, held until invalidated
+            resolved[name] = entry["value"]
+            return resolved[name]
+
+        stage = self.stages[name]
+        dep_values = {dep: self._resolve(dep, inputs, resolved) for dep in stage.deps}
+        stage_fingerprint = fingerprint(dep_values)
+
+        # A pin whose inputs changed is dropped and the stage runs again
+        if entry and entry["fingerprint"] == stage_fingerprint:
+            value = entry["value"]
+        else:
+            value = stage.func(**dep_values)
+            self.memo[name] = {"fingerprint": stage_fingerprint, "value": value, "pinned": False}
+            self.executed.append(name)
+            if self.on_stage:
+                self.on_stage(name, value)
+
+        resolved[name] = value
+        return value
@@ -0,0 +1,209 @@
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from dataclasses import dataclass, field, asdict
+import asyncio
+import re
+import uuid
+
+from models.story_context import StoryContext
+from models.summary_memory import SummaryMemory
+from utils.llm_provider import AsyncLLMProvider
+from utils.metrics import metric_tags
+from utils.retrieval import RetrievalIndex
+from agents.plot_planner import PlotPlannerAgent
+from agents.summary_agent import ChapterSummaryAgent
+from agents.chapter_writer import ChapterWritingAgent
+from agents.narrative_tracker import NarrativeTrackingAgent
+from agents.chapter_refiner import ChapterRefinerAgent
+from agents.scene_writer import ScenePlanningAgent
+from pipeline.pipelined import ChapterResult, ChapterTiming, PipelinedChapterGenerator
+from pipeline.checkpoint import CheckpointStore, StoryCheckpoint
+
+@dataclass
+class StoryRequest:
+    prompt: str
+    genre: str = "general fiction"
+    num_chapters: int = 3
+    story_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "StoryRequest":
+        request = cls(
+            prompt=data["prompt"],
+            genre=data.get("genre", "general fiction").lower(),
+            num_chapters=int(data.get("chapters", data.get("num_chapters", 3)))
+        )
+        if data.get("id"):
+            request.story_id = str(data["id"])
+        return request
+
+@dataclass
+class StoryResult:
+    request: StoryRequest
+    story_context: StoryContext
+    chapters: List[ChapterResult] = field(default_factory=list)
+
+    @property
+    def title(self) -> str:
+        return self.story_context.title
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.request.story_id,
+            "prompt": self.request.prompt,
+            "genre": self.request.genre,
+            "title": self.story_context.title,
+            "central_theme": self.story_context.central_theme,
+            "story_context": asdict(self.story_context),
+            "chapters": [
+                {
+                    "chapter": chapter.chapter,
+                    "scene_layout": chapter.scene_layout,
+                    "content": chapter.refined,
+                    "summary": chapter.summary.latest,
+                    "wall_seconds": round(chapter.timing.wall_seconds, 3),
+                    "saved_seconds": round(chapter.timing.saved_seconds, 3),
+                }
+                for chapter in self.chapters
+            ],
+        }
+
+    def pdf_chapters(self) -> List[str]:
+        """
+        Chapters in the "Chapter N: Title" layout create_pdf expects.
+        """
+        return [
+            format_pdf_chapter(chapter.chapter, chapter.refined, self.story_context.title)
+            for chapter in self.chapters
+        ]
+
+class StoryPipeline:
+    """
+    UI-free story generation: plot structure, then chapters through the
+    pipelined chapter generator. Shared by the Streamlit apps and the batch CLI.
+    With a checkpoint store, a story is resumed from its last completed stage
+    when it is generated again under the same story_id.
+    """
+    def __init__(
+        self,
+        llm_provider: AsyncLLMProvider,
+        prefetch_next_scenes: bool = True,
+        reconcile: str = "keep",
+        checkpoints: Optional[CheckpointStore] = None,
+        refine_mode: str = "rewrite",
+        draft_mode: str = "single"
+    ):
+        self.llm = llm_provider
+        self.checkpoints = checkpoints
+        self.plot_planner = PlotPlannerAgent(llm_provider)
+        self.scene_planner = ScenePlanningAgent(llm_provider)
+        self.chapter_writer = ChapterWritingAgent(llm_provider, mode=draft_mode)
+        self.chapter_refiner = ChapterRefinerAgent(llm_provider, mode=refine_mode)
+        self.summary_agent = ChapterSummaryAgent(llm_provider)
+        self.narrative_tracker = NarrativeTrackingAgent(llm_provider)
+        self.chapter_generator = PipelinedChapterGenerator(
+            self.scene_planner,
+            self.chapter_writer,
+            self.chapter_refiner,
+            self.summary_agent,
+            self.narrative_tracker,
+            prefetch_next_scenes=prefetch_next_scenes,
+            reconcile=reconcile,
+            checkpoints=checkpoints
+        )
+
+    def achapters(
+        self,
+        story_context: StoryContext,
+        num_chapters: int,
+        previous_summary: Optional[SummaryMemory] = None,
+        start_chapter: int = 1,
+        story_id: Optional[str] = None,
+        retrieval: Optional[RetrievalIndex] = None,
+        on_stage: Optional[Callable[[int, str, Any], None]] = None
+    ) -> AsyncIterator[ChapterResult]:
+        return self.chapter_generator.agenerate(
+            story_context, num_chapters, previous_summary, start_chapter, story_id, retrieval, on_stage
+        )
+
+    async def agenerate(
+        self,
+        request: StoryRequest,
+        on_chapter: Optional[Callable[[ChapterResult], None]] = None
+    ) -> StoryResult:
+        """
+        A checkpointed story continues after its last completed chapter, with
+        the context, summary and chapter count it was saved with.
+        """
+        checkpoint = self.checkpoints.load_story(request.story_id) if self.checkpoints else None
+        if checkpoint is not None:
+            state = checkpoint.resume_state()
+            story_context = state["story_context"]
+            previous_summary = state["previous_summary"]
+            start_chapter = state["next_chapter"]
+            num_chapters = checkpoint.num_chapters
+            result = StoryResult(request, story_context, completed_chapters(checkpoint))
+        else:
+            with metric_tags(story_id=request.story_id):
+                story_context = await self.plot_planner.agenerate_story_structure(request.prompt, request.genre)
+            if self.checkpoints:
+                self.checkpoints.save_story(
+                    request.story_id,
+                    request.prompt,
+                    request.genre,
+                    request.num_chapters,
+                    story_context,
+                    mode="batch"
+                )
+            previous_summary = None
+            start_chapter = 1
+            num_chapters = request.num_chapters
+            result = StoryResult(request, story_context)
+
+        async for chapter in self.achapters(
+            story_context, num_chapters, previous_summary, start_chapter=start_chapter, story_id=request.story_id
+        ):
+            result.chapters.append(chapter)
+            result.story_context = chapter.story_context
+            if on_chapter:
+                on_chapter(chapter)
+
+        return result
+
+    def generate(
+        self,
+        request: StoryRequest,
+        on_chapter: Optional[Callable[[ChapterResult], None]] = None
+    ) -> StoryResult:
+        return asyncio.run(self.agenerate(request, on_chapter))
+
+def completed_chapters(checkpoint: StoryCheckpoint) -> List[ChapterResult]:
+    """
+    The checkpoint's completed chapters as results, without timings.
+    """
+    return [
+        ChapterResult(
+            chapter=node.chapter,
+            scene_layout=node.scene_layout,
+            draft=checkpoint.chapters.get(node.chapter, {}).get("draft", node.text),
+            refined=node.text,
+            summary=SummaryMemory.coerce(node.summary),
+            story_context=node.story_context,
+            timing=ChapterTiming(node.chapter)
+        )
+        for node in checkpoint.branch().nodes()
+    ]
+
+def format_pdf_chapter(number: int, text: str, fallback_title: str = "") -> str:
+    """
+    Normalise a generated chapter to "Chapter N: Title" followed by its content,
+    reusing the model's own heading when it wrote one.
+    """
+    first_line, _, rest = text.strip().partition("\n")
+    heading = first_line.strip().strip("#*").strip()
+
+    match = re.match(r"chapter\s+\w+\s*[:\-–—]\s*(.+)", heading, re.IGNORECASE)
+    if match:
+        return f"Chapter {number}: {match.group(1).strip()}\n{rest.strip()}"
+    if heading and len(heading) <= 80 and not heading.endswith((".", "!", "?", '"')):
+        return f"Chapter {number}: {heading}\n{rest.strip()}"
+    return f"Chapter {number}: {fallback_title or 'Untitled'}\n{text.strip()}"
@@ -0,0 +1,136 @@
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field, asdict
+import hashlib
+import json
+import re
+
+from utils.structured_output import StructuredOutputError, parse_json
+
+# Chapters per checked window, and how far consecutive windows move; overlapping
+# windows let every chapter boundary be checked
+WINDOW_SIZE = 2
+WINDOW_STRIDE = 1
+# Bump when the window prompt changes, so cached findings are not reused
+PROMPT_VERSION = 1
+
+SEVERITIES = ["low", "medium", "high"]
+
+@dataclass(frozen=True)
+class CoherenceIssue:
+    """
+    One inconsistency, located at a paragraph of a chapter (both 1-based).
+    """
+    chapter: int
+    paragraph: int
+    kind: str
+    severity: str
+    description: str
+    suggestion: str = ""
+    related_chapter: Optional[int] = None
+
+@dataclass
+class CoherenceReport:
+    issues: List[CoherenceIssue] = field(default_factory=list)
+    summary: str = ""
+    windows_checked: int = 0
+    windows_cached: int = 0
+    failed_windows: List[Tuple[int, ...]] = field(default_factory=list)
+
+    @property
+    def needs_revision(self) -> bool:
+        return any(issue.severity in ("medium", "high") for issue in self.issues)
+
+    def issues_in(self, chapter: int) -> List[CoherenceIssue]:
+        return [issue for issue in self.issues if issue.chapter == chapter]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "coherence_report": self.summary,
+            "needs_revision": self.needs_revision,
+            "issues": [asdict(issue) for issue in self.issues],
+            "windows_checked": self.windows_checked,
+            "windows_cached": self.windows_cached,
+            "failed_windows": [list(window) for window in self.failed_windows]
+        }
+
+def coherence_windows(num_chapters: int, size: int = WINDOW_SIZE, stride: int = WINDOW_STRIDE) -> List[Tuple[int, ...]]:
+    """
+    Overlapping runs of 1-based chapter numbers covering every chapter.
+    """
+    if num_chapters <= size:
+        return [tuple(range(1, num_chapters + 1))] if num_chapters else []
+    windows = []
+    for start in range(1, num_chapters - size + 2, stride):
+        windows.append(tuple(range(start, start + size)))
+    if windows[-1][-1] < num_chapters:
+        windows.append(tuple(range(num_chapters - size + 1, num_chapters + 1)))
+    return windows
+
+def window_key(premise: str, window: Tuple[int, ...], chapters: List[str]) -> str:
+    """
+    Cache key of a window: its chapter numbers and the hash of each chapter's
+    text, so editing a chapter invalidates only the windows that contain it.
+    """
+    chapter_hashes = [_hash(chapters[number - 1]) for number in window]
+    return _hash(json.dumps([PROMPT_VERSION, _hash(premise), list(window), chapter_hashes]))
+
+def split_paragraphs(text: str) -> List[str]:
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n|\n", text) if paragraph.strip()]
+
+def numbered_chapter(number: int, text: str) -> str:
+    """
+    Chapter text with every paragraph tagged [chapter.paragraph], for the
+    model to point issues at.
+    """
+    paragraphs = split_paragraphs(text)
+    return "\n".join(f"[{number}.{index}] {paragraph}" for index, paragraph in enumerate(paragraphs, start=1))
+
+def parse_issues(response: str, window: Tuple[int, ...], chapters: List[str]) -> List[CoherenceIssue]:
+    """
+    Issues from a window check response. Raises StructuredOutputError when the
+    response holds no JSON object; issues pointing outside the window are dropped.
+    """
+    data, _ = parse_json(response)
+    if not isinstance(data, dict):
+        raise StructuredOutputError("Coherence response is not a JSON object", response)
+
+    issues = []
+    for item in data.get("issues", []):
+        if not isinstance(item, dict):
+            continue
+        try:
+            chapter = int(item.get("chapter"))
+            paragraph = int(item.get("paragraph") or 1)
+        except (TypeError, ValueError):
+            continue
+        if chapter not in window:
+            continue
+        related = item.get("related_chapter")
+        severity = str(item.get("severity", "medium")).lower()
+        issues.append(CoherenceIssue(
+            chapter=chapter,
+            paragraph=max(1, min(paragraph, len(split_paragraphs(chapters[chapter - 1])) or 1)),
+            kind=str(item.get("type", "continuity")).lower(),
+            severity=severity if severity in SEVERITIES else "medium",
+            description=str(item.get("description", "")).strip(),
+            suggestion=str(item.get("suggestion", "")).strip(),
+            related_chapter=related if isinstance(related, int) and related != chapter else None
+        ))
+    return [issue for issue in issues if issue.description]
+
+def merge_issues(findings: List[List[CoherenceIssue]]) -> List[CoherenceIssue]:
+    """
+    Reduce step: overlapping windows report the same issue more than once,
+    keep the most severe report of each and order them by location.
+    """
+    merged: Dict[tuple, CoherenceIssue] = {}
+    for issues in findings:
+        for issue in issues:
+            key = (issue.chapter, issue.paragraph, issue.kind)
+            kept = merged.get(key)
+            if kept is None or SEVERITIES.index(issue.severity) > SEVERITIES.index(kept.severity):
+                merged[key] = issue
+    return sorted(merged.values(), key=lambda issue: (issue.chapter, issue.paragraph, -SEVERITIES.index(issue.severity)))
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
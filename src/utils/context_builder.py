@@ -0,0 +1,150 @@
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+import threading
+
+from models.story_context import StoryContext
+from utils.tokens import estimate_tokens, CHARS_PER_TOKEN
+
+# Tokens the story context may take up in a prompt, per model. Kept well under
+# the Groq per-minute token quotas, which bind long before the context window.
+CONTEXT_BUDGETS = {
+    "llama-3.1-8b-instant": 1500,
+    "llama-3.3-70b-versatile": 3000,
+}
+DEFAULT_CONTEXT_BUDGET = 1500
+
+# Most recent threads and tensions that survive any trimming
+MIN_KEPT_ITEMS = 2
+
+@dataclass
+class _MemoEntry:
+    story_context: StoryContext
+    injection: str
+    tokens: int
+    # Trimmed serializations by budget, for budgets the full one overflows
+    trimmed: Dict[int, str] = field(default_factory=dict)
+
+class ContextBuilder:
+    """
+    Serializes a StoryContext for injection into agent prompts.
+
+    Output is compact JSON held to a per-model token budget: when a long story
+    would overflow it, the oldest unresolved tensions go first, then the
+    stalest plot threads, then the start of the previous summary. Results are
+    memoized per context version, so agents working on the same chapter share
+    one serialization.
+    """
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, max_entries: int = 64):
+        self.budgets = dict(CONTEXT_BUDGETS if budgets is None else budgets)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memo: "OrderedDict[tuple, _MemoEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def budget_for(self, model: Optional[str]) -> int:
+        return self.budgets.get(model, DEFAULT_CONTEXT_BUDGET)
+
+    def build(
+        self,
+        story_context: StoryContext,
+        chapter_title: str,
+        previous_chapter_summary: Optional[Any] = None,
+        model: Optional[str] = None
+    ) -> str:
+        if isinstance(story_context, dict):
+            story_context = StoryContext(**story_context)
+
+        budget = self.budget_for(model)
+        # Snapshots are immutable, so an id and version name one serialization;
+        # the entry holds its snapshot, so the id cannot be reused while it is cached
+        key = (id(story_context), story_context.version, chapter_title, previous_chapter_summary)
+        with self._lock:
+            entry = self._memo.get(key)
+            if entry is not None and entry.story_context is story_context:
+                self._memo.move_to_end(key)
+                if entry.tokens <= budget or budget in entry.trimmed:
+                    self.hits += 1
+                    return entry.injection if entry.tokens <= budget else entry.trimmed[budget]
+            else:
+                entry = None
+
+        if entry is None:
+            context_details = _context_details(story_context, chapter_title, previous_chapter_summary)
+            injection = _dumps(context_details)
+            entry = _MemoEntry(story_context, injection, estimate_tokens(injection))
+        if entry.tokens > budget:
+            context_details = _context_details(story_context, chapter_title, previous_chapter_summary)
+            entry.trimmed[budget] = _trim(context_details, budget)
+
+        with self._lock:
+            self.misses += 1
+            self._memo[key] = entry
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return entry.injection if entry.tokens <= budget else entry.trimmed[budget]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._memo)}
+
+# One builder for every agent, so they share serializations of the same context
+shared_context_builder = ContextBuilder()
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+def _context_details(
+    story_context: StoryContext,
+    chapter_title: str,
+    previous_chapter_summary: Optional[Any]
+) -> Dict[str, Any]:
+    context_details = {
+        "Story Title": story_context.title,
+        "Genre": story_context.genre,
+        "Central Theme": story_context.central_theme,
+        "Chapter Title": chapter_title,
+        "Protagonist Details": story_context.protagonist,
+        "Active Plot Threads": list(story_context.active_plot_threads),
+        "Unresolved Tensions": list(story_context.unresolved_tensions)
+    }
+    if previous_chapter_summary:
+        context_details["Previous Chapter Summary"] = str(previous_chapter_summary)
+    return context_details
+
+def _trim(context_details: Dict[str, Any], budget: int) -> str:
+    # Work in characters, summing per-item token estimates would overcount
+    overflow = len(_dumps(context_details)) - budget * CHARS_PER_TOKEN
+    overflow = _trim_oldest(context_details, "Unresolved Tensions", "Older Tensions Omitted", overflow)
+    if overflow > 0:
+        overflow = _trim_oldest(context_details, "Active Plot Threads", "Older Plot Threads Omitted", overflow)
+    if overflow > 0 and context_details.get("Previous Chapter Summary"):
+        _trim_summary(context_details, overflow)
+    return _dumps(context_details)
+
+def _trim_oldest(context_details: Dict[str, Any], field: str, note: str, overflow: int) -> int:
+    """
+    Drop items from the front of a list (the oldest) until the overflow, in
+    characters, is covered or only the most recent MIN_KEPT_ITEMS remain.
+    Returns the overflow left.
+    """
+    items: List[Any] = context_details[field]
+    dropped = 0
+    while overflow > 0 and len(items) - dropped > MIN_KEPT_ITEMS:
+        # Each item also costs a separator
+        overflow -= len(_dumps(items[dropped])) + 1
+        dropped += 1
+    if dropped:
+        context_details[field] = items[dropped:]
+        context_details[note] = dropped
+        overflow += len(_dumps({note: dropped}))
+    return overflow
+
+def _trim_summary(context_details: Dict[str, Any], overflow: int):
+    # The end of the summary is the most recent chapter, keep that
+    summary = context_details["Previous Chapter Summary"]
+    keep = max(0, len(summary) - overflow - 1)
+    context_details["Previous Chapter Summary"] = "…" + summary[len(summary) - keep:] if keep else ""
@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+import threading
+
+from models.schemas import EditScript
+
+EDIT_OPS = ("replace", "delete", "merge")
+# A script deleting more than this share of the draft's paragraphs is more
+# likely a confused model than an edit, so the chapter is rewritten instead
+MAX_DELETED_SHARE = 0.3
+
+class EditScriptError(ValueError):
+    """
+    Raised when an edit script cannot be applied to its draft.
+    """
+    def __init__(self, message: str, response: str = "", errors: Optional[List[str]] = None):
+        super().__init__(message)
+        self.response = response
+        self.errors = errors or []
+
+@dataclass
+class RefinementReport:
+    """
+    How a chapter was refined: "edits" applied an edit script, "rewrite"
+    regenerated it, "fallback" rewrote it after an unusable edit script.
+    Token counts are local estimates of the refiner's output.
+    """
+    chapter: int
+    mode: str
+    edits: int = 0
+    output_tokens: int = 0
+    # What regenerating the whole refined chapter would have output
+    rewrite_tokens: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.rewrite_tokens - self.output_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["tokens_saved"] = self.tokens_saved
+        return data
+
+class RefinementLog:
+    """
+    Latest RefinementReport per chapter of the most recently refined stories.
+    Refiners built by pipelines, jobs and sessions all record here, so a
+    story's reports can be read wherever it was refined.
+    """
+    def __init__(self, max_stories: int = 64):
+        self.max_stories = max_stories
+        self._stories: "OrderedDict[Optional[str], Dict[int, RefinementReport]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, story_id: Optional[str], report: RefinementReport):
+        with self._lock:
+            self._stories.setdefault(story_id, {})[report.chapter] = report
+            self._stories.move_to_end(story_id)
+            while len(self._stories) > self.max_stories:
+                self._stories.popitem(last=False)
+
+    def reports(self, story_id: Optional[str]) -> List[RefinementReport]:
+        """
+        The story's reports in chapter order.
+        """
+        with self._lock:
+            chapters = dict(self._stories.get(story_id, {}))
+        return [chapters[chapter] for chapter in sorted(chapters)]
+
+    def discard(self, story_id: Optional[str]):
+        with self._lock:
+            self._stories.pop(story_id, None)
+
+# One log for every refiner in the process
+shared_refinement_log = RefinementLog()
+
+def numbered_paragraphs(paragraphs: List[str]) -> str:
+    """
+    Draft with every paragraph tagged [n], for edits to point at.
+    """
+    return "\n\n".join(f"[{index}] {paragraph}" for index, paragraph in enumerate(paragraphs, start=1))
+
+def apply_edits(paragraphs: List[str], script: EditScript) -> str:
+    """
+    The draft with the script's edits applied, paragraphs separated by blank
+    lines. Every edit is checked before any is applied; raises
+    EditScriptError listing all problems.
+    """
+    errors: List[str] = []
+    touched: Dict[int, int] = {}
+    deleted = 0
+    for number, edit in enumerate(script.edits, start=1):
+        where = f"edit {number} ({edit.op})"
+        if edit.op not in EDIT_OPS:
+            errors.append(f"{where}: op must be one of {', '.join(EDIT_OPS)}")
+            continue
+        indexes = list(edit.paragraphs)
+        if not indexes:
+            errors.append(f"{where}: names no paragraphs")
+            continue
+        outside = [index for index in indexes if not 1 <= index <= len(paragraphs)]
+        if outside:
+            errors.append(f"{where}: paragraphs {outside} do not exist, the draft has {len(paragraphs)}")
+            continue
+        if edit.op == "replace" and len(indexes) != 1:
+            errors.append(f"{where}: replaces exactly one paragraph")
+        if edit.op == "merge" and (len(indexes) < 2 or sorted(indexes) != list(range(min(indexes), max(indexes) + 1))):
+            errors.append(f"{where}: merges two or more consecutive paragraphs")
+        if edit.op != "delete" and not edit.text.strip():
+            errors.append(f"{where}: needs the new text")
+        for index in indexes:
+            if index in touched:
+                errors.append(f"{where}: paragraph {index} is already changed by edit {touched[index]}")
+            touched[index] = number
+        if edit.op == "delete":
+            deleted += len(indexes)
+    if paragraphs and deleted / len(paragraphs) > MAX_DELETED_SHARE:
+        errors.append(f"deletes {deleted} of {len(paragraphs)} paragraphs")
+    if errors:
+        raise EditScriptError(f"Edit script cannot be applied: {'; '.join(errors)}", errors=errors)
+
+    # Replacements and merges land where their first paragraph was
+    replacements = {
+        min(edit.paragraphs): edit.text.strip()
+        for edit in script.edits
+        if edit.op in ("replace", "merge")
+    }
+    refined = []
+    for index, paragraph in enumerate(paragraphs, start=1):
+        if index in replacements:
+            refined.append(replacements[index])
+        elif index not in touched:
+            refined.append(paragraph)
+    return "\n\n".join(refined)
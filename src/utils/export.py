@@ -0,0 +1,403 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+import html
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+
+# The PDF modules (fpdf, fontTools) are imported on first use, so the apps
+# only pay for them once something is exported
+
+# Format name -> (file extension, MIME type)
+EXPORT_FORMATS: Dict[str, Tuple[str, str]] = {
+    "pdf": ("pdf", "application/pdf"),
+    "epub": ("epub", "application/epub+zip"),
+    "markdown": ("md", "text/markdown"),
+}
+
+@dataclass(frozen=True)
+class Book:
+    """
+    What every export format is built from; chapters are (number, title, content).
+    """
+    title: str
+    theme: str
+    chapters: Tuple[Tuple[int, str, str], ...]
+
+    @classmethod
+    def from_generated(cls, title: Optional[str], theme: Optional[str], generated_chapters: List[str]) -> "Book":
+        from utils.get_pdf import book_chapters
+        return cls(title or "Untitled", theme or "", tuple(book_chapters(generated_chapters)))
+
+class ExportJob:
+    """
+    One book being exported in the background. Poll status and progress from
+    the UI thread; the files can be read once status is "done".
+    """
+    def __init__(self, job_id: str, book: Book, formats: List[str], paths: Dict[str, str]):
+        self.job_id = job_id
+        self.title = book.title
+        self.formats = formats
+        self.paths = paths
+        self.total = len(book.chapters)
+        self.completed = 0
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._finished = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def progress(self) -> float:
+        """
+        Fraction of the work done; the merge after the last chapter counts as one step.
+        """
+        return (self.completed + (self.status == "done")) / (self.total + 1)
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished_at or time.time()) - self.submitted_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def read(self, export_format: str) -> bytes:
+        with open(self.paths[export_format], "rb") as f:
+            return f.read()
+
+    def file_name(self, export_format: str) -> str:
+        slug = re.sub(r"[^\w\-]+", "_", self.title).strip("_") or "story"
+        return f"{slug}.{EXPORT_FORMATS[export_format][0]}"
+
+    def mime_type(self, export_format: str) -> str:
+        return EXPORT_FORMATS[export_format][1]
+
+    def discard(self):
+        """
+        Delete the exported files, e.g. when a newer export replaces this one.
+        """
+        for path in self.paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _finish(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self._finished.set()
+
+class ExportManager:
+    """
+    Exports books off the Streamlit script thread. Each chapter is sent to a
+    worker process once and laid out there in every requested format; a
+    coordinator thread per job merges the parts into the output files in
+    chapter order as they come back, so memory holds only the chapters that
+    finished ahead of an earlier one.
+
+    PDF fragments go through the PDF exporter's cache, so exporting again
+    after a chapter is added only lays out the new chapter.
+    """
+    def __init__(
+        self,
+        output_dir: str = ".cache/exports",
+        workers: Optional[int] = None,
+        max_jobs: int = 2,
+        pdf_exporter: Optional["PDFExporter"] = None
+    ):
+        from utils.pdf_writer import shared_pdf_exporter
+        self.output_dir = output_dir
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.pdf_exporter = pdf_exporter or shared_pdf_exporter()
+        self._coordinators = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="export")
+        self._processes = self._new_process_pool()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        book: Book,
+        formats: List[str],
+        output_dir: Optional[str] = None,
+        basename: Optional[str] = None
+    ) -> ExportJob:
+        """
+        Start exporting book; returns at once. Files are written to
+        output_dir/basename.<ext>, by default under the manager's directory.
+        """
+        unknown = [export_format for export_format in formats if export_format not in EXPORT_FORMATS]
+        if unknown or not formats:
+            raise ValueError(f"Unknown export formats: {unknown}, expected some of {list(EXPORT_FORMATS)}")
+
+        job_id = uuid.uuid4().hex
+        output_dir = output_dir or self.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        paths = {
+            export_format: os.path.join(output_dir, f"{basename or job_id}.{EXPORT_FORMATS[export_format][0]}")
+            for export_format in formats
+        }
+        job = ExportJob(job_id, book, list(formats), paths)
+        self._coordinators.submit(self._run, job, book)
+        return job
+
+    def shutdown(self, wait: bool = True):
+        self._coordinators.shutdown(wait=wait)
+        self._processes.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _new_process_pool(self) -> ProcessPoolExecutor:
+        # Forking a process that runs the Streamlit server's threads is unsafe
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _run(self, job: ExportJob, book: Book):
+        job.status = "running"
+        writers = {}
+        futures: Dict[Future, int] = {}
+        try:
+            with self._lock:
+                processes = self._processes
+            writers = {export_format: self._open_writer(export_format, job, book, processes) for export_format in job.formats}
+            font_paths = None
+            if self.pdf_exporter is not None:
+                font_paths = (self.pdf_exporter.fonts.regular.path, self.pdf_exporter.fonts.bold.path)
+
+            # Chapters whose every part is cached need no worker
+            ready: Dict[int, Dict[str, Any]] = {}
+            cached: Dict[int, Dict[str, Any]] = {}
+            for index, chapter in enumerate(book.chapters):
+                parts, pending = self._cached_parts(chapter, writers)
+                if pending:
+                    cached[index] = parts
+                    layout = self.pdf_exporter.layout if self.pdf_exporter is not None else None
+                    futures[processes.submit(render_chapter_parts, chapter, pending, font_paths, layout)] = index
+                else:
+                    ready[index] = parts
+                    job.completed += 1
+
+            next_index = self._merge_ready(book, writers, ready, 0)
+            for future in as_completed(futures):
+                index = futures[future]
+                parts = future.result()
+                if "pdf" in parts and self.pdf_exporter is not None:
+                    self.pdf_exporter.cache.put(self.pdf_exporter.fragment_key(*book.chapters[index]), parts["pdf"])
+                ready[index] = {**cached.pop(index), **parts}
+                job.completed += 1
+                next_index = self._merge_ready(book, writers, ready, next_index)
+
+            for writer in writers.values():
+                writer.close()
+            job._finish("done")
+        except Exception as e:
+            for future in futures:
+                future.cancel()
+            for writer in writers.values():
+                writer.abort()
+            job.discard()
+            if isinstance(e, BrokenProcessPool):
+                with self._lock:
+                    if self._processes is processes:
+                        self._processes = self._new_process_pool()
+            job._finish("failed", f"{type(e).__name__}: {e}")
+
+    def _open_writer(self, export_format: str, job: ExportJob, book: Book, processes: ProcessPoolExecutor):
+        path = job.paths[export_format]
+        if export_format == "pdf":
+            if self.pdf_exporter is None:
+                from utils.get_pdf import create_latin1_pdf
+                return _Latin1PDFMerge(processes.submit(create_latin1_pdf, path, book.title, book.theme, _chapter_texts(book)))
+            return _PDFMerge(self.pdf_exporter.writer(path), book)
+        if export_format == "epub":
+            return _EPUBMerge(path, book)
+        return _MarkdownMerge(path, book)
+
+    def _cached_parts(self, chapter: Tuple[int, str, str], writers: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Parts already at hand for a chapter, and the formats a worker still has to render.
+        """
+        parts: Dict[str, Any] = {}
+        pending = []
+        for export_format, writer in writers.items():
+            if not writer.needs_parts:
+                continue
+            if export_format == "pdf":
+                fragment = self.pdf_exporter.cache.get(self.pdf_exporter.fragment_key(*chapter))
+                if fragment is not None:
+                    parts["pdf"] = fragment
+                    continue
+            pending.append(export_format)
+        return parts, pending
+
+    def _merge_ready(self, book: Book, writers: Dict[str, Any], ready: Dict[int, Dict[str, Any]], next_index: int) -> int:
+        while next_index in ready:
+            parts = ready.pop(next_index)
+            number, title, _ = book.chapters[next_index]
+            for export_format, writer in writers.items():
+                if writer.needs_parts:
+                    writer.add(number, title, parts[export_format])
+            next_index += 1
+        return next_index
+
+_worker_fonts: Dict[Tuple[str, str], "FontSet"] = {}
+
+def render_chapter_parts(
+    chapter: Tuple[int, str, str],
+    formats: List[str],
+    font_paths: Optional[Tuple[str, str]] = None,
+    layout: Optional["PageLayout"] = None
+) -> Dict[str, Any]:
+    """
+    Runs in a worker process: one chapter in each of formats. Fonts are
+    loaded once per worker; glyph ids come from the font files, so the PDF
+    fragments fit the parent's writer.
+    """
+    number, title, content = chapter
+    parts: Dict[str, Any] = {}
+    if "pdf" in formats:
+        from utils.pdf_writer import EmbeddedFont, FontSet, PageLayout, render_chapter
+        if font_paths not in _worker_fonts:
+            _worker_fonts[font_paths] = FontSet(EmbeddedFont(font_paths[0]), EmbeddedFont(font_paths[1]))
+        parts["pdf"] = render_chapter(number, title, content, _worker_fonts[font_paths], layout or PageLayout())
+    if "epub" in formats:
+        parts["epub"] = epub_chapter(number, title, content)
+    if "markdown" in formats:
+        parts["markdown"] = markdown_chapter(number, title, content)
+    return parts
+
+def chapter_heading(number: int, title: str) -> str:
+    return f"Chapter {number}: {title}" if title else f"Chapter {number}"
+
+def markdown_chapter(number: int, title: str, content: str) -> str:
+    from utils.pdf_writer import book_paragraphs
+    return f"## {chapter_heading(number, title)}\n\n" + "\n\n".join(book_paragraphs(content)) + "\n\n"
+
+def epub_chapter(number: int, title: str, content: str) -> str:
+    from utils.pdf_writer import book_paragraphs
+    body = f"<h1>{html.escape(chapter_heading(number, title))}</h1>\n"
+    body += "\n".join(f"<p>{html.escape(paragraph)}</p>" for paragraph in book_paragraphs(content))
+    return _xhtml(chapter_heading(number, title), body)
+
+class _PDFMerge:
+    needs_parts = True
+
+    def __init__(self, writer: "StreamingPDFWriter", book: Book):
+        from utils.pdf_writer import render_title_page
+        self.writer = writer
+        self.writer.add_fragment(render_title_page(book.title, book.theme, writer.fonts, writer.layout))
+
+    def add(self, number: int, title: str, fragment: "ChapterFragment"):
+        self.writer.add_fragment(fragment)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+class _Latin1PDFMerge:
+    """
+    Without a Unicode font the whole book goes to the fpdf writer in one worker task.
+    """
+    needs_parts = False
+
+    def __init__(self, future: Future):
+        self.future = future
+
+    def close(self):
+        self.future.result()
+
+    def abort(self):
+        self.future.cancel()
+
+class _MarkdownMerge:
+    needs_parts = True
+
+    def __init__(self, path: str, book: Book):
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write(f"# {book.title}\n\n")
+        if book.theme:
+            self.file.write(f"*{book.theme}*\n\n")
+
+    def add(self, number: int, title: str, text: str):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+
+class _EPUBMerge:
+    """
+    EPUB 3: chapter documents are zipped as they arrive, the package document
+    and navigation once all chapters are in.
+    """
+    needs_parts = True
+
+    def __init__(self, path: str, book: Book):
+        self.book = book
+        self.items: List[Tuple[str, str]] = []
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        # The mimetype entry must come first and be stored uncompressed
+        self.zip.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr("META-INF/container.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+            '</container>\n'
+        ))
+        body = f'<h1 class="title">{html.escape(book.title)}</h1>\n<p class="theme">{html.escape(book.theme)}</p>'
+        self.zip.writestr("OEBPS/title.xhtml", _xhtml(book.title, body))
+
+    def add(self, number: int, title: str, document: str):
+        name = f"chapter-{len(self.items) + 1:04d}.xhtml"
+        self.zip.writestr(f"OEBPS/{name}", document)
+        self.items.append((name, chapter_heading(number, title)))
+
+    def close(self):
+        title = html.escape(self.book.title)
+        links = "\n".join(f'<li><a href="{name}">{html.escape(label)}</a></li>' for name, label in self.items)
+        self.zip.writestr("OEBPS/nav.xhtml", _xhtml(
+            self.book.title,
+            f'<nav epub:type="toc" id="toc"><h1>{title}</h1>\n<ol>\n{links}\n</ol></nav>'
+        ))
+        manifest = "\n".join(
+            f'<item id="c{index}" href="{name}" media-type="application/xhtml+xml"/>'
+            for index, (name, _) in enumerate(self.items, start=1)
+        )
+        spine = "\n".join(f'<itemref idref="c{index}"/>' for index in range(1, len(self.items) + 1))
+        modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.zip.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            f'<dc:identifier id="book-id">urn:uuid:{uuid.uuid4()}</dc:identifier>\n'
+            f'<dc:title>{title}</dc:title>\n<dc:language>en</dc:language>\n'
+            f'<meta property="dcterms:modified">{modified}</meta>\n'
+            '</metadata>\n<manifest>\n'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+            '<item id="title" href="title.xhtml" media-type="application/xhtml+xml"/>\n'
+            f'{manifest}\n</manifest>\n<spine>\n<itemref idref="title"/>\n{spine}\n</spine>\n</package>\n'
+        ))
+        self.zip.close()
+
+    def abort(self):
+        self.zip.close()
+
+def _chapter_texts(book: Book) -> List[str]:
+    # The "Chapter N: Title" layout create_latin1_pdf parses
+    return [f"Chapter {number}: {title or 'Untitled'}\n{content}" for number, title, content in book.chapters]
+
+def _xhtml(title: str, body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">\n'
+        f'<head><meta charset="UTF-8"/><title>{html.escape(title)}</title></head>\n'
+        f'<body>\n{body}\n</body>\n</html>\n'
+    )
@@ -1,6 +1,16 @@
 from fpdf import FPDF
 import re
 
+from utils.pdf_writer import book_paragraphs, shared_pdf_exporter
+
+# Typographic punctuation models often write, kept readable by the Latin-1 fallback
+LATIN1_REPLACEMENTS = str.maketrans({
+    "\u2018": "'", "\u2019": "'", "\u201a": ",", "\u201b": "'",
+    "\u201c": '"', "\u201d": '"', "\u201e": '"', "\u201f": '"',
+    "\u2013": "-", "\u2014": "--", "\u2015": "--", "\u2212": "-",
+    "\u2026": "...", "\u2032": "'", "\u2033": '"',
+})
+
 class CustomPDF(FPDF):
     def header(self):
         # Empty header
@@ -26,7 +36,40 @@ def parse_chapter(chapter_text):
         }
     return None
 
+def book_chapters(generated_chapters):
+    """
+    (number, title, content) for every chapter. Chapters without a
+    "Chapter N: Title" first line keep their place, untitled.
+    """
+    chapters = []
+    for index, chapter in enumerate(generated_chapters, start=1):
+        parsed_chapter = parse_chapter(chapter)
+        if parsed_chapter:
+            number = int(parsed_chapter["chapter_number"].split()[1])
+            chapters.append((number, parsed_chapter["chapter_title"], parsed_chapter["content"]))
+        else:
+            chapters.append((index, "", chapter.strip()))
+    return chapters
+
 def create_pdf(output_path, story_title, story_theme, generated_chapters):
+    """
+    Write the book to output_path, a file path or binary stream, with an
+    embedded Unicode font. Without fontTools or a usable font it warns and
+    falls back to the built-in Times font, which only covers Latin-1.
+    """
+    exporter = shared_pdf_exporter()
+    if exporter is None:
+        return create_latin1_pdf(output_path, story_title, story_theme, generated_chapters)
+    exporter.export(output_path, story_title, story_theme, book_chapters(generated_chapters))
+
+def to_latin1(text):
+    """
+    Text the built-in Times font can draw: typographic punctuation made plain,
+    anything else outside Latin-1 dropped.
+    """
+    return text.translate(LATIN1_REPLACEMENTS).encode('latin-1', errors='ignore').decode('latin-1')
+
+def create_latin1_pdf(output_path, story_title, story_theme, generated_chapters):
 
     pdf = CustomPDF()
     
@@ -40,7 +83,7 @@ def create_pdf(output_path, story_title, story_theme, generated_chapters):
     pdf.set_font("Times", 'B', size=45)
     pdf.set_text_color(100, 0, 0)
     pdf.set_y(title_y)
-    story_title = story_title.encode('latin-1', errors='ignore').decode('latin-1')
+    story_title = to_latin1(story_title)
     pdf.cell(0, 10, txt=story_title, ln=1, align='C')
 
     pdf.ln(5)
@@ -48,34 +91,31 @@ def create_pdf(output_path, story_title, story_theme, generated_chapters):
     # Add theme with smaller font, slightly below title
     pdf.set_font("Times", size=14)
     pdf.set_text_color(0, 0, 0)
-    story_theme = story_theme.encode('latin-1', errors='ignore').decode('latin-1')
+    story_theme = to_latin1(story_theme)
     pdf.cell(0, 10, txt=story_theme, ln=1, align='C')
     
-    # Process chapters
-    for chapter in generated_chapters:
-        parsed_chapter = parse_chapter(chapter)
-        if parsed_chapter:
-            pdf.add_page()
-            
-            # Add chapter number centered at top with larger font
-            pdf.set_font("Times", 'B', size=25)
-            pdf.set_text_color(0, 0, 0)
-            chapter_number = parsed_chapter["chapter_number"].encode('latin-1', errors='ignore').decode('latin-1')
-            pdf.cell(0, 10, txt=chapter_number, ln=1, align='C')
-            
-            # Add chapter title centered below chapter number
+    # Process chapters, untitled ones under their number alone, as create_pdf does
+    for number, chapter_title, content in book_chapters(generated_chapters):
+        pdf.add_page()
+
+        # Add chapter number centered at top with larger font
+        pdf.set_font("Times", 'B', size=25)
+        pdf.set_text_color(0, 0, 0)
+        pdf.cell(0, 10, txt=f"Chapter {number}", ln=1, align='C')
+
+        # Add chapter title centered below chapter number
+        if chapter_title:
             pdf.set_font("Times", 'B', size=24)
             pdf.set_text_color(100, 0, 0)
-            chapter_title = parsed_chapter["chapter_title"].encode('latin-1', errors='ignore').decode('latin-1')
-            pdf.cell(0, 10, txt=chapter_title, ln=1, align='C')
-            
-            # Add some space before content
-            pdf.ln(10)
-            
-            # Add chapter content
-            pdf.set_font("Times", size=12)
-            pdf.set_text_color(0, 0, 0)
-            content = parsed_chapter["content"].encode('latin-1', errors='ignore').decode('latin-1')
-            pdf.multi_cell(0, 10, txt=content)
-    
+            pdf.cell(0, 10, txt=to_latin1(chapter_title), ln=1, align='C')
+
+        # Add some space before content
+        pdf.ln(10)
+
+        # Add chapter content, one paragraph per line as in the other exports
+        pdf.set_font("Times", size=12)
+        pdf.set_text_color(0, 0, 0)
+        for paragraph in book_paragraphs(content):
+            pdf.multi_cell(0, 10, txt=to_latin1(paragraph))
+
     pdf.output(output_path)
\ No newline at end of file
@@ -1,25 +1,376 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Tuple, Type, TypeVar
+import asyncio
 import groq
 
+from utils.llm_cache import LLMCache
+from utils.rate_limiter import RequestScheduler
+from utils.metrics import CallRecord, MetricsCollector, current_tags, tracking
+from utils.model_router import ModelRouter, Route
+from utils.structured_output import StructuredOutputError, parse_structured, reask_messages
+from utils.tokens import estimate_message_tokens, estimate_tokens
+
+T = TypeVar("T")
+
+# Groq's JSON mode: the completion is always one JSON object
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+class LLMProviderError(Exception):
+    """
+    Raised when a completion still fails after the scheduler's retries.
+    """
+
 class LLMProvider:
-    def __init__(self, api_key: str):
-        self.client = groq.Groq(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        cache: Optional[LLMCache] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        metrics: Optional[MetricsCollector] = None,
+        client: Optional[Any] = None,
+        router: Optional[ModelRouter] = None
+    ):
+        # Retries are owned by the scheduler so they respect the rate limits
+        self.client = client or groq.Groq(api_key=api_key, max_retries=0)
+        self.cache = cache
+        self.scheduler = scheduler or RequestScheduler()
+        self.metrics = metrics or MetricsCollector()
+        # Model, max_tokens and temperature of calls that leave them unset
+        self.router = router or ModelRouter()
     
     def generate_completion(
         self, 
         messages: List[Dict[str, str]], 
-        model: str = "llama-3.1-8b-instant",
-        temperature: float = 0.9,
-        max_tokens: int = 8000
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, str]] = None
     ) -> str:
+        route = self.router.route(model, temperature, max_tokens)
+        model, temperature, max_tokens = route.model, route.temperature, route.max_tokens
+        record = self.metrics.start(model, fallback_from=route.fallback_from)
+        cache_key, cached = self._cache_lookup(messages, model, temperature, max_tokens, response_format)
+        if cached is not None:
+            self.metrics.finish(record, cache_hit=True)
+            return cached
+
+        try:
+            with tracking(record):
+                completion = self.scheduler.call(
+                    model,
+                    estimate_message_tokens(messages) + max_tokens,
+                    lambda: self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **_response_format_kwargs(response_format)
+                    ),
+                    used_tokens=_used_tokens
+                )
+        except Exception as e:
+            self._finish(route, record, error=e)
+            raise LLMProviderError(f"LLM generation with {model} failed: {e}") from e
+        prompt_tokens, completion_tokens = _usage_counts(
+            getattr(completion, "usage", None), messages, completion.choices[0].message.content
+        )
+        self._finish(route, record, prompt_tokens, completion_tokens)
+        return self._cache_store(cache_key, completion)
+
+    def stream_completion(
+        self, 
+        messages: List[Dict[str, str]], 
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Yield the completion as text deltas while the model generates it.
+        Retries only happen before the first delta; a cache hit is yielded whole.
+        """
+        route = self.router.route(model, temperature, max_tokens)
+        model, temperature, max_tokens = route.model, route.temperature, route.max_tokens
+        record = self.metrics.start(model, stream=True, fallback_from=route.fallback_from)
+        cache_key, cached = self._cache_lookup(messages, model, temperature, max_tokens)
+        if cached is not None:
+            self.metrics.finish(record, cache_hit=True)
+            yield cached
+            return
+
+        reserved = self.scheduler.clamp_tokens(model, estimate_message_tokens(messages) + max_tokens)
+        # The story keeps its concurrency slot until the stream is read
+        story_id = current_tags().get("story_id")
         try:
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            return completion.choices[0].message.content
+            with tracking(record):
+                stream = self.scheduler.call(
+                    model,
+                    reserved,
+                    lambda: self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True
+                    ),
+                    used_tokens=lambda _: reserved,
+                    hold_slot=True
+                )
         except Exception as e:
-            print(f"LLM Generation Error: {e}")
-            return ""
\ No newline at end of file
+            self._finish(route, record, error=e)
+            raise LLMProviderError(f"LLM generation with {model} failed: {e}") from e
+
+        parts = []
+        usage = None
+        error = None
+        try:
+            for chunk in stream:
+                usage = _stream_usage(chunk) or usage
+                delta = _stream_delta(chunk)
+                if delta:
+                    record.first_token()
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            error = e
+            raise LLMProviderError(f"LLM stream from {model} failed: {e}") from e
+        finally:
+            used = getattr(usage, "total_tokens", None) or reserved
+            self.scheduler.settle(model, reserved, used)
+            self.scheduler.release(story_id)
+            prompt_tokens, completion_tokens = _usage_counts(usage, messages, "".join(parts))
+            self._finish(route, record, prompt_tokens, completion_tokens, error=error)
+
+        self._cache_store_text(cache_key, "".join(parts), used)
+
+    def generate_structured(
+        self,
+        messages: List[Dict[str, str]],
+        schema: Type[T],
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        reasks: int = 1
+    ) -> T:
+        """
+        Completion in JSON mode, validated against a dataclass schema. Broken
+        JSON is repaired locally first; only output that still fails is sent
+        back to the model with the errors, at most reasks times.
+        Raises StructuredOutputError.
+        """
+        response = self.generate_completion(messages, model, temperature, max_tokens, JSON_RESPONSE_FORMAT)
+        for attempt in range(reasks + 1):
+            try:
+                return parse_structured(response, schema)[0]
+            except StructuredOutputError as e:
+                if attempt == reasks:
+                    raise
+                response = self.generate_completion(
+                    reask_messages(schema, response, e.errors), model, 0, max_tokens, JSON_RESPONSE_FORMAT
+                )
+
+    def _finish(self, route: Route, record: CallRecord, *args, **kwargs):
+        self.metrics.finish(record, *args, **kwargs)
+        self.router.observe(route, record)
+
+    def _cache_lookup(self, messages, model, temperature, max_tokens, response_format=None):
+        if self.cache is None or not self.cache.cacheable(temperature):
+            return None, None
+        cache_key = self.cache.make_key(model, messages, temperature, max_tokens, response_format)
+        return cache_key, self.cache.get(cache_key)
+
+    def _cache_store(self, cache_key: Optional[str], completion) -> str:
+        return self._cache_store_text(cache_key, completion.choices[0].message.content, _used_tokens(completion))
+
+    def _cache_store_text(self, cache_key: Optional[str], content: str, tokens: int) -> str:
+        if cache_key and content:
+            self.cache.set(cache_key, content, tokens)
+        return content
+
+class AsyncLLMProvider(LLMProvider):
+    """
+    Provider that also exposes coroutine variants of every call, so independent
+    requests can share one event loop instead of waiting on each other.
+    The blocking generate_completion keeps working for existing callers.
+    """
+    def __init__(
+        self,
+        api_key: str,
+        max_concurrency: int = 8,
+        cache: Optional[LLMCache] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        metrics: Optional[MetricsCollector] = None,
+        client: Optional[Any] = None,
+        async_client: Optional[Any] = None,
+        router: Optional[ModelRouter] = None
+    ):
+        super().__init__(api_key, cache=cache, scheduler=scheduler, metrics=metrics, client=client, router=router)
+        self.async_client = async_client or groq.AsyncGroq(api_key=api_key, max_retries=0)
+        self.max_concurrency = max_concurrency
+
+    async def agenerate_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        response_format: Optional[Dict[str, str]] = None
+    ) -> str:
+        route = self.router.route(model, temperature, max_tokens)
+        model, temperature, max_tokens = route.model, route.temperature, route.max_tokens
+        record = self.metrics.start(model, fallback_from=route.fallback_from)
+        cache_key, cached = self._cache_lookup(messages, model, temperature, max_tokens, response_format)
+        if cached is not None:
+            self.metrics.finish(record, cache_hit=True)
+            return cached
+
+        try:
+            with tracking(record):
+                completion = await self.scheduler.acall(
+                    model,
+                    estimate_message_tokens(messages) + max_tokens,
+                    lambda: self.async_client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **_response_format_kwargs(response_format)
+                    ),
+                    used_tokens=_used_tokens
+                )
+        except Exception as e:
+            self._finish(route, record, error=e)
+            raise LLMProviderError(f"LLM generation with {model} failed: {e}") from e
+        prompt_tokens, completion_tokens = _usage_counts(
+            getattr(completion, "usage", None), messages, completion.choices[0].message.content
+        )
+        self._finish(route, record, prompt_tokens, completion_tokens)
+        return self._cache_store(cache_key, completion)
+
+    async def agenerate_structured(
+        self,
+        messages: List[Dict[str, str]],
+        schema: Type[T],
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        reasks: int = 1
+    ) -> T:
+        """
+        Async variant of generate_structured.
+        """
+        response = await self.agenerate_completion(messages, model, temperature, max_tokens, JSON_RESPONSE_FORMAT)
+        for attempt in range(reasks + 1):
+            try:
+                return parse_structured(response, schema)[0]
+            except StructuredOutputError as e:
+                if attempt == reasks:
+                    raise
+                response = await self.agenerate_completion(
+                    reask_messages(schema, response, e.errors), model, 0, max_tokens, JSON_RESPONSE_FORMAT
+                )
+
+    async def astream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """
+        Async variant of stream_completion.
+        """
+        route = self.router.route(model, temperature, max_tokens)
+        model, temperature, max_tokens = route.model, route.temperature, route.max_tokens
+        record = self.metrics.start(model, stream=True, fallback_from=route.fallback_from)
+        cache_key, cached = self._cache_lookup(messages, model, temperature, max_tokens)
+        if cached is not None:
+            self.metrics.finish(record, cache_hit=True)
+            yield cached
+            return
+
+        reserved = self.scheduler.clamp_tokens(model, estimate_message_tokens(messages) + max_tokens)
+        # The story keeps its concurrency slot until the stream is read
+        story_id = current_tags().get("story_id")
+        try:
+            with tracking(record):
+                stream = await self.scheduler.acall(
+                    model,
+                    reserved,
+                    lambda: self.async_client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True
+                    ),
+                    used_tokens=lambda _: reserved,
+                    hold_slot=True
+                )
+        except Exception as e:
+            self._finish(route, record, error=e)
+            raise LLMProviderError(f"LLM generation with {model} failed: {e}") from e
+
+        parts = []
+        usage = None
+        error = None
+        try:
+            async for chunk in stream:
+                usage = _stream_usage(chunk) or usage
+                delta = _stream_delta(chunk)
+                if delta:
+                    record.first_token()
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            error = e
+            raise LLMProviderError(f"LLM stream from {model} failed: {e}") from e
+        finally:
+            used = getattr(usage, "total_tokens", None) or reserved
+            self.scheduler.settle(model, reserved, used)
+            self.scheduler.release(story_id)
+            prompt_tokens, completion_tokens = _usage_counts(usage, messages, "".join(parts))
+            self._finish(route, record, prompt_tokens, completion_tokens, error=error)
+
+        self._cache_store_text(cache_key, "".join(parts), used)
+
+    async def agenerate_batch(self, requests: List[Dict[str, Any]]) -> List[str]:
+        """
+        Run several completions concurrently, at most max_concurrency in flight.
+        Each request is a dict of agenerate_completion keyword arguments;
+        results come back in the same order as the requests.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(request: Dict[str, Any]) -> str:
+            async with semaphore:
+                return await self.agenerate_completion(**request)
+
+        return await asyncio.gather(*(run(request) for request in requests))
+
+def _response_format_kwargs(response_format: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    # Left out entirely when unset, so plain requests stay as they were
+    return {"response_format": response_format} if response_format else {}
+
+def _used_tokens(completion) -> int:
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
+
+def _stream_delta(chunk) -> Optional[str]:
+    if not chunk.choices:
+        return None
+    return chunk.choices[0].delta.content
+
+def _stream_usage(chunk):
+    # Groq reports usage on the final chunk under x_groq
+    return getattr(getattr(chunk, "x_groq", None), "usage", None)
+
+def _usage_counts(usage, messages: List[Dict[str, str]], content: Optional[str]) -> Tuple[int, int]:
+    """
+    Prompt and completion tokens as reported by the API, estimated when it did not say.
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None:
+        prompt_tokens = estimate_message_tokens(messages)
+    if completion_tokens is None:
+        completion_tokens = estimate_tokens(content or "")
+    return prompt_tokens, completion_tokens
@@ -0,0 +1,404 @@
+from typing import Any, Dict, Iterator, List, Optional
+from dataclasses import dataclass, field, asdict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+# Dollars per million tokens (input, output)
+MODEL_PRICES = {
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+}
+
+# Running totals kept per (agent, method, model) for the Prometheus counters
+COUNTER_FIELDS = (
+    "calls", "prompt_tokens", "completion_tokens", "retries", "cache_hits", "errors", "fallbacks", "cost",
+    "latency", "time_to_first_token", "queue_wait"
+)
+
+# Tags (story_id, chapter, priority, speculation, agent, method, profile) of the code currently calling the LLM
+_tags: ContextVar[Dict[str, Any]] = ContextVar("metric_tags", default={})
+# Call being made right now, so the scheduler can count its retries and queueing
+_active_call: ContextVar[Optional["CallRecord"]] = ContextVar("active_call", default=None)
+
+@dataclass
+class CallRecord:
+    model: str
+    story_id: Optional[str] = None
+    chapter: Optional[int] = None
+    agent: str = ""
+    method: str = ""
+    stream: bool = False
+    priority: Optional[str] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    time_to_first_token: Optional[float] = None
+    latency: float = 0.0
+    retries: int = 0
+    # Seconds spent queued for the shared rate limits, over all attempts
+    queue_wait: float = 0.0
+    cache_hit: bool = False
+    error: Optional[str] = None
+    # Model the routing profile wanted, when an SLO breach sent the call to this one
+    fallback_from: Optional[str] = None
+    # Speculative run the call belongs to, see pipeline.speculation
+    speculation: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+    _started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def first_token(self):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self._started
+
+    @property
+    def tokens_per_second(self) -> float:
+        """
+        Completion tokens over generation time; for streams the wait for the
+        first token is left out.
+        """
+        generation = self.latency
+        if self.stream and self.time_to_first_token is not None and self.latency > self.time_to_first_token:
+            generation = self.latency - self.time_to_first_token
+        return self.completion_tokens / generation if generation > 0 else 0.0
+
+    @property
+    def cost(self) -> float:
+        input_price, output_price = MODEL_PRICES.get(self.model, (0.0, 0.0))
+        return (self.prompt_tokens * input_price + self.completion_tokens * output_price) / 1_000_000
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        del data["_started"]
+        data["tokens_per_second"] = round(self.tokens_per_second, 2)
+        data["cost"] = self.cost
+        return data
+
+class MetricsCollector:
+    """
+    Keeps a record of every LLM call, tagged with the agent, method, model and
+    story/chapter that made it, and reports them per story as a table, JSON or
+    Prometheus text format.
+
+    Only the latest max_records calls are kept; the Prometheus counters are
+    running totals that never go down. Calls are also counted in parent, e.g.
+    a process-wide collector that owns the Prometheus file.
+    """
+    def __init__(
+        self,
+        max_records: int = 10000,
+        parent: Optional["MetricsCollector"] = None,
+        max_speculations: int = 256
+    ):
+        self.parent = parent
+        self.max_speculations = max_speculations
+        self._records = deque(maxlen=max_records)
+        # Running totals per (agent, method, model), never evicted
+        self._counters: Dict[tuple, Dict[str, float]] = {}
+        # Tokens per speculation id, for the most recent speculative runs
+        self._speculation_tokens: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, model: str, stream: bool = False, fallback_from: Optional[str] = None) -> CallRecord:
+        tags = _tags.get()
+        return CallRecord(
+            model=model,
+            story_id=tags.get("story_id"),
+            chapter=tags.get("chapter"),
+            agent=tags.get("agent", ""),
+            method=tags.get("method", ""),
+            stream=stream,
+            priority=tags.get("priority"),
+            fallback_from=fallback_from,
+            speculation=tags.get("speculation")
+        )
+
+    def finish(
+        self,
+        record: CallRecord,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cache_hit: bool = False,
+        error: Optional[Exception] = None
+    ):
+        record.latency = time.perf_counter() - record._started
+        if record.time_to_first_token is None:
+            record.time_to_first_token = record.latency
+        record.prompt_tokens = prompt_tokens
+        record.completion_tokens = completion_tokens
+        record.cache_hit = cache_hit
+        if error is not None:
+            record.error = type(error).__name__
+        self.add(record)
+
+    def add(self, record: CallRecord):
+        """
+        Keep a finished call and count it here and in the parent.
+        """
+        key = (record.agent or "-", record.method or "-", record.model)
+        with self._lock:
+            self._records.append(record)
+            counters = self._counters.setdefault(key, dict.fromkeys(COUNTER_FIELDS, 0))
+            counters["calls"] += 1
+            counters["prompt_tokens"] += record.prompt_tokens
+            counters["completion_tokens"] += record.completion_tokens
+            counters["retries"] += record.retries
+            counters["cache_hits"] += int(record.cache_hit)
+            counters["errors"] += int(record.error is not None)
+            counters["fallbacks"] += int(record.fallback_from is not None)
+            counters["cost"] += record.cost
+            counters["latency"] += record.latency
+            counters["time_to_first_token"] += record.time_to_first_token or 0.0
+            counters["queue_wait"] += record.queue_wait
+            if record.speculation is not None:
+                tokens = self._speculation_tokens.get(record.speculation, 0)
+                self._speculation_tokens[record.speculation] = tokens + record.prompt_tokens + record.completion_tokens
+                self._speculation_tokens.move_to_end(record.speculation)
+                while len(self._speculation_tokens) > self.max_speculations:
+                    self._speculation_tokens.popitem(last=False)
+        if self.parent is not None:
+            self.parent.add(record)
+
+    def speculation_tokens(self, speculation_id: str) -> int:
+        """
+        Prompt and completion tokens of the calls a speculative run made so far.
+        """
+        with self._lock:
+            return self._speculation_tokens.get(speculation_id, 0)
+
+    def records(self, story_id: Optional[str] = None) -> List[CallRecord]:
+        with self._lock:
+            records = list(self._records)
+        if story_id is None:
+            return records
+        return [record for record in records if record.story_id == story_id]
+
+    def summary(self, story_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        One row per agent method and model, sorted by total latency.
+        """
+        rows: Dict[tuple, Dict[str, Any]] = {}
+        for record in self.records(story_id):
+            key = (record.agent or "-", record.method or "-", record.model)
+            row = rows.setdefault(key, {
+                "agent": key[0],
+                "method": key[1],
+                "model": key[2],
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "latency": 0.0,
+                "time_to_first_token": 0.0,
+                "generation_seconds": 0.0,
+                "retries": 0,
+                "queue_wait": 0.0,
+                "cache_hits": 0,
+                "errors": 0,
+                "fallbacks": 0,
+                "cost": 0.0,
+            })
+            row["calls"] += 1
+            row["prompt_tokens"] += record.prompt_tokens
+            row["completion_tokens"] += record.completion_tokens
+            row["latency"] += record.latency
+            row["time_to_first_token"] += record.time_to_first_token or 0.0
+            if record.completion_tokens and record.tokens_per_second:
+                row["generation_seconds"] += record.completion_tokens / record.tokens_per_second
+            row["retries"] += record.retries
+            row["queue_wait"] += record.queue_wait
+            row["cache_hits"] += int(record.cache_hit)
+            row["errors"] += int(record.error is not None)
+            row["fallbacks"] += int(record.fallback_from is not None)
+            row["cost"] += record.cost
+
+        report = []
+        for row in rows.values():
+            generation_seconds = row.pop("generation_seconds")
+            row["avg_latency"] = row["latency"] / row["calls"]
+            row["avg_time_to_first_token"] = row.pop("time_to_first_token") / row["calls"]
+            row["avg_queue_wait"] = row["queue_wait"] / row["calls"]
+            row["tokens_per_second"] = row["completion_tokens"] / generation_seconds if generation_seconds else 0.0
+            report.append(row)
+        return sorted(report, key=lambda row: row["latency"], reverse=True)
+
+    def totals(self, story_id: Optional[str] = None) -> Dict[str, Any]:
+        records = self.records(story_id)
+        return {
+            "calls": len(records),
+            "prompt_tokens": sum(record.prompt_tokens for record in records),
+            "completion_tokens": sum(record.completion_tokens for record in records),
+            "latency": sum(record.latency for record in records),
+            "retries": sum(record.retries for record in records),
+            "queue_wait": sum(record.queue_wait for record in records),
+            "cache_hits": sum(int(record.cache_hit) for record in records),
+            "fallbacks": sum(int(record.fallback_from is not None) for record in records),
+            "cost": sum(record.cost for record in records),
+        }
+
+    def to_json(self, story_id: Optional[str] = None) -> str:
+        return json.dumps({
+            "story_id": story_id,
+            "totals": self.totals(story_id),
+            "summary": self.summary(story_id),
+            "calls": [record.to_dict() for record in self.records(story_id)],
+        }, indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Counters per agent, method and model in the Prometheus text format,
+        from the running totals. Story ids are left out to keep label
+        cardinality bounded.
+        """
+        metrics = [
+            ("fic_llm_calls_total", "LLM calls made", "calls"),
+            ("fic_llm_prompt_tokens_total", "Prompt tokens sent", "prompt_tokens"),
+            ("fic_llm_completion_tokens_total", "Completion tokens received", "completion_tokens"),
+            ("fic_llm_retries_total", "Retried requests", "retries"),
+            ("fic_llm_cache_hits_total", "Calls answered from the response cache", "cache_hits"),
+            ("fic_llm_errors_total", "Calls that failed", "errors"),
+            ("fic_llm_fallbacks_total", "Calls routed to a fallback model after an SLO breach", "fallbacks"),
+            ("fic_llm_cost_dollars_total", "Estimated spend in dollars", "cost"),
+            ("fic_llm_latency_seconds_sum", "Total call latency", "latency"),
+            ("fic_llm_time_to_first_token_seconds_sum", "Total time to first token", "time_to_first_token"),
+            ("fic_llm_queue_wait_seconds_sum", "Total time queued for the shared rate limits", "queue_wait"),
+        ]
+        with self._lock:
+            counters = sorted((key, dict(values)) for key, values in self._counters.items())
+        lines = []
+        for name, help_text, field_name in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (agent, method, model), values in counters:
+                labels = ",".join(
+                    f'{label}="{_escape_label(value)}"'
+                    for label, value in (("agent", agent), ("method", method), ("model", model))
+                )
+                lines.append(f"{name}{{{labels}}} {values[field_name]:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str, story_id: Optional[str] = None):
+        _write_atomic(path, self.to_json(story_id))
+
+    def write_prometheus(self, path: str):
+        _write_atomic(path, self.to_prometheus())
+
+@contextmanager
+def metric_tags(**tags) -> Iterator[None]:
+    """
+    Tag every LLM call made inside the block, e.g. with story_id and chapter.
+    """
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+def current_tags() -> Dict[str, Any]:
+    return dict(_tags.get())
+
+@contextmanager
+def tracking(record: CallRecord) -> Iterator[CallRecord]:
+    token = _active_call.set(record)
+    try:
+        yield record
+    finally:
+        _active_call.reset(token)
+
+def note_retry():
+    """
+    Count a retry against the call in progress, if any is being tracked.
+    """
+    record = _active_call.get()
+    if record is not None:
+        record.retries += 1
+
+def note_queue_wait(seconds: float):
+    """
+    Add time spent waiting for the scheduler to the call in progress.
+    """
+    record = _active_call.get()
+    if record is not None:
+        record.queue_wait += seconds
+
+def instrumented(func):
+    """
+    Tag the LLM calls a method makes with its agent class and method name.
+    Works for plain and async methods and for methods returning (async) streams.
+
+    The profile tag names the method whose routing profile applies: the method
+    itself, or for an async variant such as agenerate_chapter the sync method
+    it mirrors, when the agent has one.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        name = func.__name__
+        tags = {**_tags.get(), "agent": type(self).__name__, "method": name, "profile": name}
+        token = _tags.set(tags)
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            _tags.reset(token)
+        # Async results make their calls later, under the sync method's profile
+        if (inspect.iscoroutine(result) or inspect.isasyncgen(result)) and name.startswith("a") \
+                and callable(getattr(type(self), name[1:], None)):
+            tags = {**tags, "profile": name[1:]}
+        if inspect.iscoroutine(result):
+            return _tagged_coroutine(result, tags)
+        if inspect.isgenerator(result):
+            return _tagged_generator(result, tags)
+        if inspect.isasyncgen(result):
+            return _tagged_async_generator(result, tags)
+        return result
+    return wrapper
+
+async def _tagged_coroutine(coroutine, tags: Dict[str, Any]):
+    token = _tags.set(tags)
+    try:
+        return await coroutine
+    finally:
+        _tags.reset(token)
+
+def _tagged_generator(generator, tags: Dict[str, Any]):
+    # Streams run lazily, so the tags are applied around every step
+    try:
+        while True:
+            token = _tags.set(tags)
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                _tags.reset(token)
+            yield item
+    finally:
+        generator.close()
+
+async def _tagged_async_generator(generator, tags: Dict[str, Any]):
+    try:
+        while True:
+            token = _tags.set(tags)
+            try:
+                item = await generator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _tags.reset(token)
+            yield item
+    finally:
+        await generator.aclose()
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _write_atomic(path: str, content: str):
+    # Scrapers must never see a half-written file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
@@ -0,0 +1,189 @@
+from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+from dataclasses import dataclass, replace
+import json
+import math
+import threading
+import time
+
+from utils.metrics import CallRecord, current_tags
+
+FAST_MODEL = "llama-3.1-8b-instant"
+LARGE_MODEL = "llama-3.3-70b-versatile"
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """
+    How one agent, or one agent method, calls the LLM. When the model's
+    rolling p95 latency goes over latency_slo seconds, or its error rate over
+    max_error_rate, calls go to the first fallback that is within both.
+    """
+    model: str = FAST_MODEL
+    max_tokens: int = 8000
+    temperature: float = 0.9
+    fallbacks: Tuple[str, ...] = ()
+    latency_slo: Optional[float] = None
+    max_error_rate: float = 0.25
+
+# Keyed by "Agent.method" or "Agent"; async methods share their sync method's
+# profile. Token limits are sized to what each prompt asks for, with headroom.
+DEFAULT_PROFILES: Dict[str, ModelProfile] = {
+    "default": ModelProfile(),
+    "PlotPlannerAgent": ModelProfile(LARGE_MODEL, max_tokens=2000, fallbacks=(FAST_MODEL,), latency_slo=30.0),
+    "ScenePlanningAgent": ModelProfile(LARGE_MODEL, max_tokens=2000, fallbacks=(FAST_MODEL,), latency_slo=20.0),
+    "ChapterWritingAgent": ModelProfile(FAST_MODEL, max_tokens=6000, latency_slo=60.0),
+    "ChapterRefinerAgent": ModelProfile(FAST_MODEL, max_tokens=6000, temperature=0.7, latency_slo=60.0),
+    "ChapterSummaryAgent": ModelProfile(FAST_MODEL, max_tokens=400, temperature=0.5),
+    # Roll-ups and the synopsis are made inside update_summary_memory
+    "ChapterSummaryAgent.update_summary_memory": ModelProfile(FAST_MODEL, max_tokens=800, temperature=0.5),
+    "NarrativeTrackingAgent": ModelProfile(FAST_MODEL, max_tokens=1500, temperature=0.3),
+    "NarrativeTrackingAgent.check_narrative_coherence": ModelProfile(FAST_MODEL, max_tokens=1500, temperature=0.2),
+}
+
+@dataclass(frozen=True)
+class Route:
+    model: str
+    temperature: float
+    max_tokens: int
+    stage: str
+    # The profile's model when an SLO breach sent the call elsewhere
+    fallback_from: Optional[str] = None
+
+@dataclass
+class _Observation:
+    timestamp: float
+    latency: float
+    error: bool
+
+class ModelRouter:
+    """
+    Picks model, max_tokens and temperature for each LLM call from the
+    profile of the agent method making it, as tagged by @instrumented.
+    Explicit arguments win over the profile, and an explicit model is never
+    rerouted.
+
+    Latency and errors are kept per stage and model over a rolling window of
+    recent calls (cache hits excluded). A model that has been routed away from
+    gets no new samples, so its old ones age out after window_seconds and it
+    is tried again.
+    """
+    def __init__(
+        self,
+        profiles: Optional[Dict[str, ModelProfile]] = None,
+        window: int = 50,
+        window_seconds: float = 300.0,
+        min_samples: int = 5
+    ):
+        self.profiles = dict(DEFAULT_PROFILES if profiles is None else profiles)
+        self.profiles.setdefault("default", ModelProfile())
+        self.window = window
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self._observations: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, path: str, **kwargs) -> "ModelRouter":
+        """
+        Router with the profiles in a JSON file laid over the defaults, e.g.
+        {"ChapterWritingAgent": {"max_tokens": 5000, "fallbacks": ["..."]}}.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+        profiles = dict(DEFAULT_PROFILES)
+        for key, values in overrides.items():
+            if "fallbacks" in values:
+                values = {**values, "fallbacks": tuple(values["fallbacks"])}
+            profiles[key] = replace(profiles.get(key, profiles["default"]), **values)
+        return cls(profiles, **kwargs)
+
+    def profile_for(self, agent: str, method: str) -> Tuple[str, ModelProfile]:
+        """
+        The most specific profile for an agent method, and its key. Async
+        variants are looked up under the sync method @instrumented tags them with.
+        """
+        keys = [f"{agent}.{method}", agent, "default"]
+        for key in keys:
+            if key in self.profiles:
+                return key, self.profiles[key]
+        return "default", self.profiles["default"]
+
+    def route(
+        self,
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ) -> Route:
+        tags = current_tags()
+        stage, profile = self.profile_for(tags.get("agent", ""), tags.get("profile", tags.get("method", "")))
+        temperature = profile.temperature if temperature is None else temperature
+        max_tokens = profile.max_tokens if max_tokens is None else max_tokens
+        if model is not None:
+            return Route(model, temperature, max_tokens, stage)
+
+        chosen = profile.model
+        if self._breached(stage, profile.model, profile):
+            candidates = [fallback for fallback in profile.fallbacks if not self._breached(stage, fallback, profile)]
+            if candidates:
+                chosen = candidates[0]
+        return Route(chosen, temperature, max_tokens, stage, profile.model if chosen != profile.model else None)
+
+    def observe(self, route: Route, record: CallRecord):
+        if record.cache_hit:
+            return
+        with self._lock:
+            observations = self._observations.setdefault((route.stage, route.model), deque(maxlen=self.window))
+            observations.append(_Observation(time.time(), record.latency, record.error is not None))
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Rolling p95 latency and error rate for every stage and model seen.
+        """
+        with self._lock:
+            keys = list(self._observations)
+        rows = []
+        for stage, model in keys:
+            observations = self._recent(stage, model)
+            p95, error_rate = _p95_and_error_rate(observations)
+            rows.append({
+                "stage": stage,
+                "model": model,
+                "samples": len(observations),
+                "p95_latency": p95,
+                "error_rate": error_rate
+            })
+        return rows
+
+    def _breached(self, stage: str, model: str, profile: ModelProfile) -> bool:
+        observations = self._recent(stage, model)
+        if len(observations) < self.min_samples:
+            return False
+        p95, error_rate = _p95_and_error_rate(observations)
+        if error_rate > profile.max_error_rate:
+            return True
+        return profile.latency_slo is not None and p95 is not None and p95 > profile.latency_slo
+
+    def _recent(self, stage: str, model: str) -> List[_Observation]:
+        cutoff = time.time() - self.window_seconds
+        with self._lock:
+            observations = self._observations.get((stage, model))
+            if not observations:
+                return []
+            while observations and observations[0].timestamp < cutoff:
+                observations.popleft()
+            return list(observations)
+
+def _p95_and_error_rate(observations: List[_Observation]) -> Tuple[Optional[float], float]:
+    if not observations:
+        return None, 0.0
+    error_rate = sum(observation.error for observation in observations) / len(observations)
+    latencies = sorted(observation.latency for observation in observations if not observation.error)
+    if not latencies:
+        return None, error_rate
+    return latencies[max(0, math.ceil(0.95 * len(latencies)) - 1)], error_rate
+
+def load_router(path: Optional[str] = None, **kwargs) -> ModelRouter:
+    """
+    Router with the profile overrides at path, or the defaults when there is none.
+    """
+    return ModelRouter.from_json(path, **kwargs) if path else ModelRouter(**kwargs)
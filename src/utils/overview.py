@@ -1,4 +1,7 @@
 import streamlit as st
+from functools import partial
+
+from utils.export import EXPORT_FORMATS, Book
 
 def story_overview(story_data):
 
@@ -33,3 +36,108 @@ def story_overview(story_data):
     with st.expander("⚠️ Unresolved Tensions"):
         for tension in story_data["unresolved_tensions"]:
             st.markdown(f"- {tension}")
+
+def cache_overview(cache_stats):
+
+    with st.sidebar.expander("🗄️ Response Cache"):
+        st.metric("Hit Rate", f"{cache_stats['hit_rate']:.0%}")
+        st.write(f"Hits: {cache_stats['hits']} (memory {cache_stats['memory_hits']}, disk {cache_stats['disk_hits']})")
+        st.write(f"Misses: {cache_stats['misses']}")
+        st.write(f"Tokens saved: {cache_stats['tokens_saved']}")
+
+def scheduler_overview(scheduler_stats):
+
+    with st.sidebar.expander("⏳ Request Queue"):
+        if not scheduler_stats:
+            st.write("No LLM calls queued yet")
+        for row in scheduler_stats:
+            st.markdown(f"**{row['model']}**")
+            st.write(
+                f"Queued: {row['queue_depth']} ("
+                + ", ".join(f"{priority} {count}" for priority, count in row['queued_by_priority'].items())
+                + f") from {row['stories_waiting']} stories"
+            )
+            st.caption(
+                f"{row['admitted']} calls admitted, waited {row['avg_wait']:.1f}s avg, "
+                f"{row['p95_wait']:.1f}s p95, {row['max_wait']:.1f}s max"
+            )
+
+def speculation_overview(speculation_stats):
+
+    with st.sidebar.expander("🔮 Speculation"):
+        st.metric("Hit Rate", f"{speculation_stats['hit_rate']:.0%}")
+        st.write(f"Hits: {speculation_stats['hits']}, misses: {speculation_stats['misses']}")
+        st.write(f"Tokens used: {speculation_stats['used_tokens']}, wasted: {speculation_stats['wasted_tokens']}")
+        st.write(f"Waiting saved: {speculation_stats['seconds_saved']:.1f}s")
+
+def refinement_overview(reports):
+
+    if not reports:
+        return
+    with st.sidebar.expander("✂️ Refinement"):
+        st.metric("Output Tokens Saved", sum(report.tokens_saved for report in reports))
+        for report in reports:
+            st.caption(
+                f"Chapter {report.chapter}: {report.mode}, {report.edits} edits, "
+                f"{report.output_tokens} tokens out, {report.tokens_saved} saved"
+            )
+
+def metrics_overview(metrics, story_id=None):
+
+    totals = metrics.totals(story_id)
+    with st.sidebar.expander("📊 LLM Usage"):
+        st.metric("Estimated Cost", f"${totals['cost']:.4f}")
+        st.write(f"Calls: {totals['calls']} (cache hits {totals['cache_hits']}, retries {totals['retries']})")
+        st.write(f"Tokens: {totals['prompt_tokens']} prompt, {totals['completion_tokens']} completion")
+        st.write(f"LLM time: {totals['latency']:.1f}s (queued {totals['queue_wait']:.1f}s)")
+        for row in metrics.summary(story_id):
+            st.markdown(f"**{row['agent']}.{row['method']}** · {row['model']}")
+            st.caption(
+                f"{row['calls']} calls, {row['prompt_tokens'] + row['completion_tokens']} tokens, "
+                f"{row['avg_latency']:.1f}s avg, {row['avg_time_to_first_token']:.1f}s to first token, "
+                f"{row['tokens_per_second']:.0f} tok/s, ${row['cost']:.4f}"
+            )
+        st.download_button(
+            "Download JSON",
+            metrics.to_json(story_id),
+            file_name=f"metrics-{story_id or 'session'}.json",
+            mime="application/json"
+        )
+
+def export_overview(export_manager, title, theme, chapters):
+    """
+    Export the chapters so far in the background; progress is polled by a
+    fragment so the rest of the page stays responsive.
+    """
+    with st.expander("📦 Export"):
+        formats = st.multiselect("Formats", list(EXPORT_FORMATS), default=["pdf"], key="export_formats")
+        if "pdf" in formats and export_manager.pdf_exporter is None:
+            from utils.pdf_writer import latin1_fallback_reason
+            st.warning(latin1_fallback_reason())
+        if st.button("Export", disabled=not chapters or not formats):
+            previous = st.session_state.get("export_job")
+            if previous is not None and previous.done:
+                previous.discard()
+            st.session_state.export_job = export_manager.submit(Book.from_generated(title, theme, chapters), formats)
+
+        job = st.session_state.get("export_job")
+        if job is not None:
+            st.fragment(export_progress, run_every=None if job.done else 1.0)(job)
+
+def export_progress(job):
+    if not job.done:
+        st.progress(job.progress, text=f"Exporting... {job.completed}/{job.total} chapters")
+    elif job.status == "failed":
+        st.error(f"Export failed: {job.error}")
+    else:
+        st.caption(f"Exported {job.total} chapters in {job.seconds:.1f}s")
+        for export_format in job.formats:
+            st.download_button(
+                f"Download {export_format.upper()}",
+                # Read on click, not on every rerun
+                partial(job.read, export_format),
+                file_name=job.file_name(export_format),
+                mime=job.mime_type(export_format),
+                key=f"download_{job.job_id}_{export_format}",
+                on_click="ignore"
+            )
@@ -0,0 +1,572 @@
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple, Union
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
+import io
+import logging
+import os
+import threading
+import zlib
+
+try:
+    from fontTools.ttLib import TTFont
+    from fontTools import subset as font_subset
+except ImportError:  # get_pdf.create_pdf falls back to the Latin-1 fpdf writer
+    TTFont = None
+    font_subset = None
+
+logger = logging.getLogger(__name__)
+
+# Searched in order for a regular and bold TTF with wide Unicode coverage;
+# PDF_FONT_PATH and PDF_BOLD_FONT_PATH take precedence
+FONT_CANDIDATES = [
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSerif-Bold.ttf"),
+    ("/usr/share/fonts/dejavu/DejaVuSerif.ttf", "/usr/share/fonts/dejavu/DejaVuSerif-Bold.ttf"),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("/Library/Fonts/DejaVuSerif.ttf", "/Library/Fonts/DejaVuSerif-Bold.ttf"),
+    ("C:\\Windows\\Fonts\\DejaVuSerif.ttf", "C:\\Windows\\Fonts\\DejaVuSerif-Bold.ttf"),
+]
+
+# Bump when the layout changes, so cached fragments are not reused
+LAYOUT_VERSION = 1
+
+@dataclass(frozen=True)
+class PageLayout:
+    """
+    A4 in points, matching the sizes and colours of the original fpdf export.
+    """
+    width: float = 595.28
+    height: float = 841.89
+    margin: float = 56.7
+    body_size: float = 12
+    body_leading: float = 17
+    paragraph_gap: float = 6
+    title_size: float = 45
+    theme_size: float = 14
+    chapter_number_size: float = 25
+    chapter_title_size: float = 24
+    accent: Tuple[float, float, float] = (100 / 255, 0.0, 0.0)
+
+class EmbeddedFont:
+    """
+    A TrueType font written into the PDF as a CIDFontType2 with Identity-H
+    encoding: text is drawn as 2-byte glyph ids, so any character the font
+    covers comes out intact. Only the glyphs a document uses are embedded.
+    """
+    def __init__(self, path: str):
+        if TTFont is None:
+            raise RuntimeError("fontTools is required for Unicode PDF export")
+        self.path = path
+        font = TTFont(path, lazy=True)
+        self.name = "".join(ch for ch in font["name"].getDebugName(6) or os.path.basename(path) if ch.isalnum() or ch in "-_")
+        self.units_per_em = font["head"].unitsPerEm
+        self.bbox = [_scale(value, self.units_per_em) for value in (font["head"].xMin, font["head"].yMin, font["head"].xMax, font["head"].yMax)]
+        self.ascent = _scale(font["hhea"].ascent, self.units_per_em)
+        self.descent = _scale(font["hhea"].descent, self.units_per_em)
+        cap_height = getattr(font["OS/2"], "sCapHeight", 0) if "OS/2" in font else 0
+        self.cap_height = _scale(cap_height, self.units_per_em) if cap_height else self.ascent
+        glyph_ids = {name: index for index, name in enumerate(font.getGlyphOrder())}
+        metrics = font["hmtx"].metrics
+        self._glyphs: Dict[int, int] = {
+            codepoint: glyph_ids[name] for codepoint, name in font.getBestCmap().items()
+        }
+        self._advances: Dict[int, int] = {glyph_ids[name]: advance for name, (advance, _) in metrics.items()}
+        self._chars: Dict[str, Tuple[int, int, str]] = {}
+        self._word_units: Dict[str, int] = {}
+        with open(path, "rb") as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        font.close()
+
+    def glyph(self, char: str) -> int:
+        return self._char_metrics(char)[0]
+
+    def advance(self, glyph: int) -> int:
+        """
+        Width of a glyph in PDF text space units (1000 per em).
+        """
+        return _scale(self._advances.get(glyph, 0), self.units_per_em)
+
+    def width(self, text: str, size: float) -> float:
+        units = self._word_units.get(text)
+        if units is None:
+            units = sum(self._char_metrics(char)[1] for char in text)
+            # Words repeat a lot in prose; keep the memo bounded for long books
+            if len(self._word_units) > 100_000:
+                self._word_units.clear()
+            self._word_units[text] = units
+        return units * size / 1000
+
+    def encode(self, text: str, used: Dict[int, str]) -> str:
+        """
+        Hex glyph string for a Tj operator; records the glyphs in used.
+        """
+        codes = []
+        for char in text:
+            glyph, _, code = self._char_metrics(char)
+            if glyph not in used:
+                used[glyph] = char
+            codes.append(code)
+        return "".join(codes)
+
+    def _char_metrics(self, char: str) -> Tuple[int, int, str]:
+        metrics = self._chars.get(char)
+        if metrics is None:
+            glyph = self._glyphs.get(ord(char), 0)
+            metrics = (glyph, self.advance(glyph), f"{glyph:04X}")
+            self._chars[char] = metrics
+        return metrics
+
+    def font_program(self, glyphs: Set[int]) -> bytes:
+        """
+        The font file cut down to the given glyphs, with glyph ids unchanged.
+        """
+        if font_subset is not None:
+            try:
+                options = font_subset.Options()
+                options.retain_gids = True
+                options.notdef_outline = True
+                options.name_IDs = ["*"]
+                options.drop_tables += ["GSUB", "GPOS", "GDEF", "kern", "FFTM"]
+                font = TTFont(self.path)
+                subsetter = font_subset.Subsetter(options)
+                subsetter.populate(gids=sorted(glyphs | {0}))
+                subsetter.subset(font)
+                buffer = io.BytesIO()
+                font.save(buffer)
+                return buffer.getvalue()
+            except Exception as e:
+                logger.warning("Font subsetting failed, embedding the whole font: %s", e)
+        with open(self.path, "rb") as f:
+            return f.read()
+
+@dataclass
+class FontSet:
+    regular: EmbeddedFont
+    bold: EmbeddedFont
+
+    def by_key(self) -> Dict[str, EmbeddedFont]:
+        return {"F1": self.regular, "F2": self.bold}
+
+    @property
+    def digest(self) -> str:
+        return self.regular.digest + self.bold.digest
+
+# Configured font paths already reported missing
+_reported_fonts: Set[Tuple[str, str]] = set()
+
+def find_fonts() -> Optional[FontSet]:
+    """
+    The first regular and bold font pair found on this machine, or None when
+    there is none or fontTools is missing.
+    """
+    if TTFont is None:
+        return None
+    candidates = list(FONT_CANDIDATES)
+    if os.getenv("PDF_FONT_PATH"):
+        regular = os.environ["PDF_FONT_PATH"]
+        bold = os.getenv("PDF_BOLD_FONT_PATH", regular)
+        if not (os.path.exists(regular) and os.path.exists(bold)) and (regular, bold) not in _reported_fonts:
+            _reported_fonts.add((regular, bold))
+            logger.warning("PDF_FONT_PATH font %s or %s not found, trying the default locations", regular, bold)
+        candidates.insert(0, (regular, bold))
+    for regular, bold in candidates:
+        if os.path.exists(regular) and os.path.exists(bold):
+            return FontSet(EmbeddedFont(regular), EmbeddedFont(bold))
+    return None
+
+@dataclass
+class ChapterFragment:
+    """
+    A laid out chapter: one compressed content stream per page, and the
+    glyphs each font needs for them. Chapters start on a new page, so a
+    fragment never depends on the chapters before it.
+    """
+    pages: List[bytes]
+    glyphs: Dict[str, Dict[int, str]] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return sum(len(page) for page in self.pages)
+
+class FragmentCache:
+    """
+    LRU of rendered fragments by content hash, bounded in bytes.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._fragments: "OrderedDict[str, ChapterFragment]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[ChapterFragment]:
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key: str, fragment: ChapterFragment):
+        with self._lock:
+            if key in self._fragments:
+                self._bytes -= self._fragments.pop(key).size
+            self._fragments[key] = fragment
+            self._bytes += fragment.size
+            while self._bytes > self.max_bytes and len(self._fragments) > 1:
+                _, evicted = self._fragments.popitem(last=False)
+                self._bytes -= evicted.size
+
+class _PageComposer:
+    """
+    Lays text out top to bottom, starting new pages as they fill.
+    """
+    def __init__(self, fonts: FontSet, layout: PageLayout):
+        self.fonts = fonts.by_key()
+        self.layout = layout
+        self.pages: List[bytes] = []
+        self.glyphs: Dict[str, Dict[int, str]] = {key: {} for key in self.fonts}
+        self._ops: List[str] = []
+        self.y = layout.margin
+
+    @property
+    def text_width(self) -> float:
+        return self.layout.width - 2 * self.layout.margin
+
+    def new_page(self):
+        self.finish_page()
+        self.y = self.layout.margin
+
+    def finish_page(self):
+        if self._ops:
+            self.pages.append(zlib.compress("\n".join(self._ops).encode("ascii")))
+            self._ops = []
+
+    def move_to(self, y: float):
+        self.y = y
+
+    def space(self, points: float):
+        self.y += points
+
+    def paragraph(
+        self,
+        text: str,
+        font_key: str,
+        size: float,
+        leading: float,
+        align: str = "left",
+        color: Tuple[float, float, float] = (0.0, 0.0, 0.0)
+    ):
+        font = self.fonts[font_key]
+        for line in _wrap(font, text, size, self.text_width):
+            if self.y + leading > self.layout.height - self.layout.margin:
+                self.new_page()
+            baseline = self.layout.height - self.y - size
+            x = self.layout.margin
+            if align == "center":
+                x += (self.text_width - font.width(line, size)) / 2
+            self._ops.append(
+                f"BT {color[0]:.3f} {color[1]:.3f} {color[2]:.3f} rg /{font_key} {size:g} Tf "
+                f"{x:.2f} {baseline:.2f} Td <{font.encode(line, self.glyphs[font_key])}> Tj ET"
+            )
+            self.y += leading
+
+def render_chapter(number: int, title: str, content: str, fonts: FontSet, layout: PageLayout = PageLayout()) -> ChapterFragment:
+    composer = _PageComposer(fonts, layout)
+    composer.paragraph(f"Chapter {number}", "F2", layout.chapter_number_size, layout.chapter_number_size * 1.2, "center")
+    if title:
+        composer.paragraph(title, "F2", layout.chapter_title_size, layout.chapter_title_size * 1.2, "center", layout.accent)
+    composer.space(layout.body_leading)
+    for paragraph in book_paragraphs(content):
+        composer.paragraph(paragraph, "F1", layout.body_size, layout.body_leading)
+        composer.space(layout.paragraph_gap)
+    composer.finish_page()
+    return ChapterFragment(composer.pages, composer.glyphs)
+
+def render_title_page(title: str, theme: str, fonts: FontSet, layout: PageLayout = PageLayout()) -> ChapterFragment:
+    composer = _PageComposer(fonts, layout)
+    composer.move_to(layout.height * 0.45 - layout.title_size)
+    composer.paragraph(title, "F2", layout.title_size, layout.title_size * 1.15, "center", layout.accent)
+    composer.space(layout.theme_size)
+    composer.paragraph(theme, "F1", layout.theme_size, layout.theme_size * 1.4, "center")
+    composer.finish_page()
+    return ChapterFragment(composer.pages, composer.glyphs)
+
+class StreamingPDFWriter:
+    """
+    Writes a PDF page by page as chapters are added. Each page's content is
+    written to the target right away; only object offsets, page ids and the
+    glyphs in use stay in memory, and the fonts, page tree and cross-reference
+    table are written on close. Memory therefore stays flat however long the
+    book gets.
+    """
+    def __init__(
+        self,
+        target: Union[str, BinaryIO],
+        fonts: FontSet,
+        cache: Optional[FragmentCache] = None,
+        layout: PageLayout = PageLayout()
+    ):
+        self.fonts = fonts
+        self.cache = cache
+        self.layout = layout
+        self._owns_stream = isinstance(target, str)
+        self._stream: BinaryIO = open(target, "wb") if self._owns_stream else target
+        self._position = 0
+        self._offsets: Dict[int, int] = {}
+        self._page_ids: List[int] = []
+        self._glyphs: Dict[str, Dict[int, str]] = {key: {} for key in fonts.by_key()}
+        self._next_id = 1
+        self._closed = False
+        # Catalog, page tree and fonts are written last but referenced by every page
+        self._catalog_id = self._reserve()
+        self._pages_id = self._reserve()
+        self._font_ids = {key: self._reserve() for key in fonts.by_key()}
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self) -> "StreamingPDFWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_ids)
+
+    def add_title_page(self, title: str, theme: str):
+        self.add_fragment(render_title_page(title, theme, self.fonts, self.layout))
+
+    def add_chapter(self, number: int, title: str, content: str):
+        key = None
+        fragment = None
+        if self.cache is not None:
+            key = _fragment_key(number, title, content, self.fonts, self.layout)
+            fragment = self.cache.get(key)
+        if fragment is None:
+            fragment = render_chapter(number, title, content, self.fonts, self.layout)
+            if self.cache is not None:
+                self.cache.put(key, fragment)
+        self.add_fragment(fragment)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for key, font in self.fonts.by_key().items():
+            self._write_font(self._font_ids[key], font, self._glyphs[key])
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(self._pages_id, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>")
+        self._write_object(self._catalog_id, f"<< /Type /Catalog /Pages {self._pages_id} 0 R >>")
+
+        xref_position = self._position
+        lines = [f"xref\n0 {self._next_id}\n", "0000000000 65535 f \n"]
+        for object_id in range(1, self._next_id):
+            lines.append(f"{self._offsets[object_id]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {self._next_id} /Root {self._catalog_id} 0 R >>\nstartxref\n{xref_position}\n%%EOF\n")
+        self._write("".join(lines).encode("ascii"))
+        self._stream.flush()
+        if self._owns_stream:
+            self._stream.close()
+
+    def abort(self):
+        """
+        Stop without finishing the file; a stream the writer opened is closed.
+        """
+        self._closed = True
+        if self._owns_stream:
+            self._stream.close()
+
+    def add_fragment(self, fragment: ChapterFragment):
+        """
+        Append pages laid out elsewhere, e.g. by render_chapter in a worker process.
+        """
+        if self._closed:
+            raise ValueError("The PDF is already closed")
+        for key, glyphs in fragment.glyphs.items():
+            self._glyphs[key].update(glyphs)
+        fonts = " ".join(f"/{key} {font_id} 0 R" for key, font_id in self._font_ids.items())
+        for content in fragment.pages:
+            content_id = self._reserve()
+            self._write_stream(content_id, content, "/Filter /FlateDecode")
+            page_id = self._reserve()
+            self._write_object(
+                page_id,
+                f"<< /Type /Page /Parent {self._pages_id} 0 R /MediaBox [0 0 {self.layout.width:g} {self.layout.height:g}] "
+                f"/Resources << /Font << {fonts} >> >> /Contents {content_id} 0 R >>"
+            )
+            self._page_ids.append(page_id)
+
+    def _write_font(self, font_id: int, font: EmbeddedFont, glyphs: Dict[int, str]):
+        descendant_id = self._reserve()
+        descriptor_id = self._reserve()
+        program_id = self._reserve()
+        to_unicode_id = self._reserve()
+
+        self._write_object(
+            font_id,
+            f"<< /Type /Font /Subtype /Type0 /BaseFont /{font.name} /Encoding /Identity-H "
+            f"/DescendantFonts [{descendant_id} 0 R] /ToUnicode {to_unicode_id} 0 R >>"
+        )
+        widths = " ".join(f"{glyph} [{font.advance(glyph)}]" for glyph in sorted(glyphs))
+        self._write_object(
+            descendant_id,
+            f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{font.name} "
+            f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+            f"/FontDescriptor {descriptor_id} 0 R /CIDToGIDMap /Identity /DW 1000 /W [{widths}] >>"
+        )
+        self._write_object(
+            descriptor_id,
+            f"<< /Type /FontDescriptor /FontName /{font.name} /Flags 32 /FontBBox [{' '.join(map(str, font.bbox))}] "
+            f"/ItalicAngle 0 /Ascent {font.ascent} /Descent {font.descent} /CapHeight {font.cap_height} "
+            f"/StemV 80 /FontFile2 {program_id} 0 R >>"
+        )
+        program = font.font_program(set(glyphs))
+        self._write_stream(program_id, zlib.compress(program), f"/Filter /FlateDecode /Length1 {len(program)}")
+        self._write_stream(to_unicode_id, zlib.compress(_to_unicode_cmap(glyphs)), "/Filter /FlateDecode")
+
+    def _reserve(self) -> int:
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def _write_object(self, object_id: int, body: str):
+        self._offsets[object_id] = self._position
+        self._write(f"{object_id} 0 obj\n{body}\nendobj\n".encode("ascii"))
+
+    def _write_stream(self, object_id: int, data: bytes, entries: str):
+        self._offsets[object_id] = self._position
+        self._write(f"{object_id} 0 obj\n<< /Length {len(data)} {entries} >>\nstream\n".encode("ascii"))
+        self._write(data)
+        self._write(b"\nendstream\nendobj\n")
+
+    def _write(self, data: bytes):
+        self._stream.write(data)
+        self._position += len(data)
+
+class PDFExporter:
+    """
+    Fonts and fragment cache shared by every export in the process, so
+    exporting a book again after chapter N is added only lays out chapter N.
+    """
+    def __init__(self, fonts: FontSet, cache: Optional[FragmentCache] = None, layout: PageLayout = PageLayout()):
+        self.fonts = fonts
+        self.cache = cache or FragmentCache()
+        self.layout = layout
+
+    def fragment_key(self, number: int, title: str, content: str) -> str:
+        return _fragment_key(number, title, content, self.fonts, self.layout)
+
+    def writer(self, target: Union[str, BinaryIO]) -> StreamingPDFWriter:
+        return StreamingPDFWriter(target, self.fonts, self.cache, self.layout)
+
+    def export(self, target: Union[str, BinaryIO], title: str, theme: str, chapters: List[Tuple[int, str, str]]):
+        """
+        Write a whole book; chapters are (number, title, content) tuples.
+        """
+        with self.writer(target) as writer:
+            writer.add_title_page(title, theme)
+            for number, chapter_title, content in chapters:
+                writer.add_chapter(number, chapter_title, content)
+
+_shared_exporter: Optional[PDFExporter] = None
+_shared_lock = threading.Lock()
+_fallback_reported = False
+
+def shared_pdf_exporter() -> Optional[PDFExporter]:
+    """
+    The process-wide exporter, or None when no Unicode font is available;
+    the first time that happens the reason is logged as a warning.
+    """
+    global _shared_exporter, _fallback_reported
+    with _shared_lock:
+        if _shared_exporter is None:
+            fonts = find_fonts()
+            if fonts is not None:
+                _shared_exporter = PDFExporter(fonts)
+            elif not _fallback_reported:
+                _fallback_reported = True
+                logger.warning(latin1_fallback_reason())
+        return _shared_exporter
+
+def latin1_fallback_reason() -> str:
+    """
+    Why PDFs are written with the Latin-1 fpdf writer, for showing to users.
+    """
+    if TTFont is None:
+        missing = "fontTools is not installed"
+    else:
+        missing = "no Unicode font was found (install the DejaVu fonts or set PDF_FONT_PATH)"
+    return (
+        f"PDF export falls back to the Latin-1 writer because {missing}. "
+        "Curly quotes and dashes are replaced by plain ones and other characters outside Latin-1 are dropped."
+    )
+
+def _fragment_key(number: int, title: str, content: str, fonts: FontSet, layout: PageLayout) -> str:
+    payload = "\x00".join([str(LAYOUT_VERSION), repr(layout), fonts.digest, str(number), title, content])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def book_paragraphs(content: str) -> List[str]:
+    """
+    A chapter's paragraphs, one per non-empty line with whitespace collapsed.
+    Every export format splits chapters with this.
+    """
+    return [" ".join(paragraph.split()) for paragraph in content.split("\n") if paragraph.strip()]
+
+def _wrap(font: EmbeddedFont, text: str, size: float, width: float) -> List[str]:
+    """
+    Greedy line breaking at spaces; words wider than a line are split.
+    """
+    text = "".join(char if char.isprintable() else " " for char in text)
+    space = font.width(" ", size)
+    lines = []
+    line = ""
+    line_width = 0.0
+    for word in text.split():
+        word_width = font.width(word, size)
+        while word_width > width:
+            # Hard-break a word that cannot fit on any line
+            cut = len(word)
+            while cut > 1 and font.width(word[:cut], size) > width:
+                cut -= 1
+            if line:
+                lines.append(line)
+                line, line_width = "", 0.0
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = font.width(word, size)
+        if line and line_width + space + word_width > width:
+            lines.append(line)
+            line, line_width = "", 0.0
+        if line:
+            line += " " + word
+            line_width += space + word_width
+        else:
+            line, line_width = word, word_width
+    if line:
+        lines.append(line)
+    return lines
+
+def _to_unicode_cmap(glyphs: Dict[int, str]) -> bytes:
+    entries = [f"<{glyph:04X}> <{char.encode('utf-16-be').hex().upper()}>" for glyph, char in sorted(glyphs.items())]
+    blocks = []
+    for start in range(0, len(entries), 100):
+        chunk = entries[start:start + 100]
+        blocks.append(f"{len(chunk)} beginbfchar\n" + "\n".join(chunk) + "\nendbfchar")
+    return (
+        "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+        "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n"
+        "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+        "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+        + "\n".join(blocks)
+        + "\nendcmap\nCMapName currentdict /CMap defineresource pop\nend\nend\n"
+    ).encode("ascii")
+
+def _scale(value: float, units_per_em: int) -> int:
+    return int(round(value * 1000 / units_per_em))
@@ -0,0 +1,388 @@
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+from collections import deque
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+import groq
+
+from utils.metrics import current_tags, note_queue_wait, note_retry
+
+# Retries are counted in the metrics; the log line is only for debugging
+logger = logging.getLogger(__name__)
+
+@dataclass
+class RateLimit:
+    requests_per_minute: int
+    tokens_per_minute: int
+
+# Groq free-tier quotas; override per deployment through RequestScheduler(limits=...)
+DEFAULT_RATE_LIMITS = {
+    "llama-3.1-8b-instant": RateLimit(requests_per_minute=30, tokens_per_minute=6000),
+    "llama-3.3-70b-versatile": RateLimit(requests_per_minute=30, tokens_per_minute=12000),
+}
+FALLBACK_RATE_LIMIT = RateLimit(requests_per_minute=30, tokens_per_minute=6000)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# How often a queued caller re-checks the buckets; settle() may refund tokens early
+POLL_INTERVAL = 0.05
+
+# Admission order of the "priority" metric tag; interactive clicks go before
+# background chapters whatever their share of the quota
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+DEFAULT_PRIORITY = "normal"
+
+# Waits kept per model for the percentiles in stats()
+WAIT_SAMPLES = 500
+
+@dataclass
+class RetryPolicy:
+    max_retries: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Exponential backoff with jitter, never shorter than the server's Retry-After hint.
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def give(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+@dataclass(eq=False)
+class _Waiter:
+    story_id: Optional[str]
+    priority: int
+    tokens: int
+    # Virtual start and finish tags for weighted fair queuing
+    start: float
+    finish: float
+    seq: int
+    enqueued: float = field(default_factory=time.monotonic)
+
+    @property
+    def order(self):
+        return (self.priority, self.finish, self.seq)
+
+class _ModelQueue:
+    """
+    Callers waiting on one model's request and token buckets. Only the next
+    waiter in line may take capacity, so a burst is released at the bucket
+    refill rate instead of all at once. Next in line is the highest priority
+    waiter, then the lowest finish tag: every story's calls are spaced by
+    tokens / weight in virtual time, so a story with many queued calls takes
+    turns with the others instead of holding the head of the queue.
+    """
+    def __init__(self, limit: RateLimit):
+        self.requests = TokenBucket(limit.requests_per_minute, limit.requests_per_minute / 60)
+        self.tokens = TokenBucket(limit.tokens_per_minute, limit.tokens_per_minute / 60)
+        self.waiters: List[_Waiter] = []
+        self.blocked_until = 0.0
+        self.virtual_time = 0.0
+        # Finish tag of each story's last queued call
+        self.finish_tags: Dict[Optional[str], float] = {}
+        self.admitted = 0
+        self.wait_seconds = 0.0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+class RequestScheduler:
+    """
+    Per-model rate limiting (requests/min and tokens/min) plus retry with
+    exponential backoff for throttled or transiently failing calls.
+
+    One scheduler is shared by every story on an API key. Calls are admitted
+    by their "priority" tag (see PRIORITIES), then by weighted fair queuing
+    across their "story_id" tags, with an optional "weight" tag for a larger
+    share. At most max_calls_per_story calls of a story are in flight at once;
+    calls without a story id are not limited.
+    """
+    def __init__(
+        self,
+        limits: Optional[Dict[str, RateLimit]] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        max_calls_per_story: Optional[int] = None
+    ):
+        self.limits = dict(DEFAULT_RATE_LIMITS if limits is None else limits)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.max_calls_per_story = max_calls_per_story
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def call(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request: Callable[[], Any],
+        used_tokens: Optional[Callable[[Any], int]] = None,
+        hold_slot: bool = False
+    ) -> Any:
+        """
+        Make the request once the scheduler admits it, retrying transient
+        failures. With hold_slot the story's concurrency slot stays taken after
+        a successful return, e.g. while a stream is read; give it back with
+        release(story_id).
+        """
+        story_id = current_tags().get("story_id")
+        attempt = 0
+        while True:
+            reserved = self.acquire(model, estimated_tokens)
+            try:
+                result = request()
+            except Exception as e:
+                self.settle(model, reserved, 0)
+                self.release(story_id)
+                delay = self._retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.settle(model, reserved, used_tokens(result) if used_tokens else reserved)
+            if not hold_slot:
+                self.release(story_id)
+            return result
+
+    async def acall(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request: Callable[[], Awaitable[Any]],
+        used_tokens: Optional[Callable[[Any], int]] = None,
+        hold_slot: bool = False
+    ) -> Any:
+        story_id = current_tags().get("story_id")
+        attempt = 0
+        while True:
+            reserved = await self.aacquire(model, estimated_tokens)
+            try:
+                result = await request()
+            except Exception as e:
+                self.settle(model, reserved, 0)
+                self.release(story_id)
+                delay = self._retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.settle(model, reserved, used_tokens(result) if used_tokens else reserved)
+            if not hold_slot:
+                self.release(story_id)
+            return result
+
+    def acquire(self, model: str, estimated_tokens: int) -> int:
+        """
+        Block until the model's buckets admit this request; returns the tokens
+        reserved. The caller's story slot is taken until release(story_id).
+        """
+        ticket = self._enqueue(model, estimated_tokens)
+        try:
+            while True:
+                wait = self._try_take(model, ticket)
+                if wait == 0:
+                    return ticket.tokens
+                time.sleep(min(wait, POLL_INTERVAL))
+        finally:
+            self._dequeue(model, ticket)
+
+    async def aacquire(self, model: str, estimated_tokens: int) -> int:
+        ticket = self._enqueue(model, estimated_tokens)
+        try:
+            while True:
+                wait = self._try_take(model, ticket)
+                if wait == 0:
+                    return ticket.tokens
+                await asyncio.sleep(min(wait, POLL_INTERVAL))
+        finally:
+            self._dequeue(model, ticket)
+
+    def release(self, story_id: Optional[str]):
+        """
+        Give back a concurrency slot of story_id taken by acquire().
+        """
+        if story_id is None:
+            return
+        with self._lock:
+            count = self._in_flight.get(story_id, 0) - 1
+            if count > 0:
+                self._in_flight[story_id] = count
+            else:
+                self._in_flight.pop(story_id, None)
+
+    def settle(self, model: str, reserved: int, actual: int):
+        """
+        Reconcile a reservation with the tokens the call really used.
+        """
+        with self._lock:
+            queue = self._queue(model)
+            queue.tokens.refill(time.monotonic())
+            if actual <= reserved:
+                queue.tokens.give(reserved - actual)
+            else:
+                queue.tokens.take(actual - reserved)
+
+    def clamp_tokens(self, model: str, estimated_tokens: int) -> int:
+        """
+        Tokens actually reserved for an estimate; a single request can never
+        need more than a full bucket.
+        """
+        with self._lock:
+            return int(min(estimated_tokens, self._queue(model).tokens.capacity))
+
+    def queue_depth(self, model: str) -> int:
+        with self._lock:
+            return len(self._queue(model).waiters)
+
+    def in_flight(self, story_id: str) -> int:
+        with self._lock:
+            return self._in_flight.get(story_id, 0)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Per model: calls waiting (in total and by priority), stories waiting,
+        calls admitted and how long they waited for the quota.
+        """
+        with self._lock:
+            names = {rank: name for name, rank in PRIORITIES.items()}
+            rows = []
+            for model, queue in self._queues.items():
+                waits = sorted(queue.waits)
+                by_priority = {name: 0 for name in PRIORITIES}
+                for waiter in queue.waiters:
+                    by_priority[names[waiter.priority]] += 1
+                rows.append({
+                    "model": model,
+                    "queue_depth": len(queue.waiters),
+                    "queued_by_priority": by_priority,
+                    "stories_waiting": len({waiter.story_id for waiter in queue.waiters}),
+                    "admitted": queue.admitted,
+                    "avg_wait": queue.wait_seconds / queue.admitted if queue.admitted else 0.0,
+                    "p95_wait": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                    "max_wait": waits[-1] if waits else 0.0,
+                })
+            return rows
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(self.limits.get(model, FALLBACK_RATE_LIMIT))
+        return self._queues[model]
+
+    def _enqueue(self, model: str, estimated_tokens: int) -> _Waiter:
+        reserved = self.clamp_tokens(model, estimated_tokens)
+        tags = current_tags()
+        story_id = tags.get("story_id")
+        priority = PRIORITIES.get(tags.get("priority", DEFAULT_PRIORITY), PRIORITIES[DEFAULT_PRIORITY])
+        weight = max(float(tags.get("weight", 1.0)), 0.01)
+        with self._lock:
+            queue = self._queue(model)
+            start = max(queue.virtual_time, queue.finish_tags.get(story_id, 0.0))
+            ticket = _Waiter(story_id, priority, reserved, start, start + reserved / weight, next(self._seq))
+            queue.finish_tags[story_id] = ticket.finish
+            queue.waiters.append(ticket)
+        return ticket
+
+    def _dequeue(self, model: str, ticket: _Waiter):
+        with self._lock:
+            waiters = self._queue(model).waiters
+            if ticket in waiters:
+                waiters.remove(ticket)
+
+    def _try_take(self, model: str, ticket: _Waiter) -> float:
+        with self._lock:
+            queue = self._queue(model)
+            # Stories at their concurrency limit wait without holding up the others
+            eligible = [waiter for waiter in queue.waiters if self._has_slot(waiter.story_id)]
+            if not eligible or min(eligible, key=lambda waiter: waiter.order) is not ticket:
+                return POLL_INTERVAL
+            now = time.monotonic()
+            if now < queue.blocked_until:
+                return queue.blocked_until - now
+            queue.requests.refill(now)
+            queue.tokens.refill(now)
+            wait = max(queue.requests.wait_time(1), queue.tokens.wait_time(ticket.tokens))
+            if wait > 0:
+                return wait
+            queue.requests.take(1)
+            queue.tokens.take(ticket.tokens)
+            queue.waiters.remove(ticket)
+            queue.virtual_time = max(queue.virtual_time, ticket.start)
+            if len(queue.finish_tags) > 1024:
+                queue.finish_tags = {
+                    story_id: finish for story_id, finish in queue.finish_tags.items() if finish > queue.virtual_time
+                }
+            if ticket.story_id is not None:
+                self._in_flight[ticket.story_id] = self._in_flight.get(ticket.story_id, 0) + 1
+            waited = now - ticket.enqueued
+            queue.admitted += 1
+            queue.wait_seconds += waited
+            queue.waits.append(waited)
+        note_queue_wait(waited)
+        return 0
+
+    def _has_slot(self, story_id: Optional[str]) -> bool:
+        if story_id is None or self.max_calls_per_story is None:
+            return True
+        return self._in_flight.get(story_id, 0) < self.max_calls_per_story
+
+    def _retry_delay(self, model: str, error: Exception, attempt: int) -> Optional[float]:
+        if attempt >= self.retry_policy.max_retries or not _is_retryable(error):
+            return None
+        retry_after = _retry_after(error)
+        delay = self.retry_policy.backoff(attempt, retry_after)
+        if retry_after is not None:
+            # The server told us the whole model is throttled, hold the queue too
+            with self._lock:
+                queue = self._queue(model)
+                queue.blocked_until = max(queue.blocked_until, time.monotonic() + retry_after)
+        note_retry()
+        logger.debug("LLM request to %s failed (%s), retrying in %.1fs", model, error, delay)
+        return delay
+
+def _is_retryable(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (groq.APIConnectionError, ConnectionError, TimeoutError))
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
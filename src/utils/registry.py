@@ -0,0 +1,165 @@
+from typing import Any, MutableMapping, Optional, Tuple
+from dataclasses import dataclass
+import asyncio
+import os
+import threading
+
+import groq
+import httpx
+import streamlit as st
+
+from utils.llm_provider import AsyncLLMProvider
+from utils.llm_cache import LLMCache
+from utils.metrics import MetricsCollector
+from utils.model_router import ModelRouter, load_router
+from utils.rate_limiter import RequestScheduler
+from agents.plot_planner import PlotPlannerAgent
+from agents.summary_agent import ChapterSummaryAgent
+from agents.chapter_writer import ChapterWritingAgent
+from agents.narrative_tracker import NarrativeTrackingAgent
+from agents.chapter_refiner import ChapterRefinerAgent
+from agents.scene_writer import ScenePlanningAgent
+from pipeline.checkpoint import CheckpointStore
+from pipeline.jobs import JobRunner
+from pipeline.speculation import Speculator
+
+# Connections to the API stay open between calls, reruns and sessions
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=120)
+
+# Clients, the response cache, checkpoints, the scheduler, the model router
+# and the export workers are shared by the whole process through
+# st.cache_resource. Metrics belong to a session, so each session builds its
+# provider and agents once on top of them and keeps them in its state. Session
+# metrics are also counted in process_metrics(), which owns the Prometheus file.
+
+@dataclass
+class Agents:
+    plot_planner: PlotPlannerAgent
+    summary_agent: ChapterSummaryAgent
+    chapter_writer: ChapterWritingAgent
+    chapter_refiner: ChapterRefinerAgent
+    narrative_tracker: NarrativeTrackingAgent
+    scene_planner: ScenePlanningAgent
+
+    @classmethod
+    def create(cls, llm_provider: AsyncLLMProvider) -> "Agents":
+        return cls(
+            PlotPlannerAgent(llm_provider),
+            ChapterSummaryAgent(llm_provider),
+            ChapterWritingAgent(llm_provider, mode=os.getenv('DRAFT_MODE', 'single')),
+            ChapterRefinerAgent(llm_provider, mode=os.getenv('REFINE_MODE', 'rewrite')),
+            NarrativeTrackingAgent(llm_provider),
+            ScenePlanningAgent(llm_provider)
+        )
+
+@st.cache_resource(show_spinner=False)
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    One event loop for the process, running in a background thread. The async
+    client keeps its connections on this loop, so async work goes through
+    iterate_sync(..., loop=event_loop()).
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def groq_clients(api_key: Optional[str]) -> Tuple[groq.Groq, groq.AsyncGroq]:
+    """
+    Sync and async Groq clients with pooled keep-alive connections. Retries
+    are owned by the scheduler, as in LLMProvider.
+    """
+    client = groq.Groq(api_key=api_key, max_retries=0, http_client=groq.DefaultHttpxClient(limits=HTTP_LIMITS))
+    async_client = groq.AsyncGroq(
+        api_key=api_key,
+        max_retries=0,
+        http_client=groq.DefaultAsyncHttpxClient(limits=HTTP_LIMITS)
+    )
+    return client, async_client
+
+@st.cache_resource(show_spinner=False)
+def request_scheduler() -> RequestScheduler:
+    # Rate limits are per API key, not per session, so every story queues here
+    return RequestScheduler(max_calls_per_story=int(os.getenv('MAX_CALLS_PER_STORY', '3')))
+
+@st.cache_resource(show_spinner=False)
+def model_router() -> ModelRouter:
+    # Latency and SLO fallbacks are properties of the shared API, not a session
+    return load_router(os.getenv('MODEL_PROFILES_PATH'))
+
+@st.cache_resource(show_spinner=False)
+def process_metrics() -> MetricsCollector:
+    """
+    Every session's calls, counted once for the process-wide Prometheus file.
+    """
+    return MetricsCollector()
+
+@st.cache_resource(show_spinner=False)
+def llm_cache(path: str) -> LLMCache:
+    return LLMCache(path=path)
+
+@st.cache_resource(show_spinner=False)
+def checkpoint_store(path: str) -> CheckpointStore:
+    return CheckpointStore(path)
+
+@st.cache_resource(show_spinner=False)
+def job_runner(checkpoint_path: str) -> JobRunner:
+    """
+    Generation jobs for every session, run on the shared event loop.
+    """
+    return JobRunner(
+        loop=event_loop(),
+        max_jobs=int(os.getenv('MAX_GENERATION_JOBS', '4')),
+        checkpoints=checkpoint_store(checkpoint_path),
+        refine_mode=os.getenv('REFINE_MODE', 'rewrite'),
+        draft_mode=os.getenv('DRAFT_MODE', 'single')
+    )
+
+@st.cache_resource(show_spinner=False)
+def export_manager() -> Any:
+    """
+    The process-wide ExportManager; the export code is only imported here.
+    """
+    from utils.export import ExportManager
+    return ExportManager(os.getenv('EXPORT_DIR', '.cache/exports'))
+
+def session_provider(state: MutableMapping[str, Any]) -> AsyncLLMProvider:
+    """
+    The session's provider, built on the shared clients the first time and
+    again only if the session's metrics were replaced.
+    """
+    if state.get("metrics") is None:
+        state["metrics"] = MetricsCollector(parent=process_metrics())
+
+    llm_provider = state.get("llm_provider")
+    if llm_provider is None or llm_provider.metrics is not state["metrics"]:
+        client, async_client = groq_clients(os.getenv('GROQ_API_KEY'))
+        llm_provider = AsyncLLMProvider(
+            api_key=os.getenv('GROQ_API_KEY'),
+            cache=llm_cache(os.getenv('LLM_CACHE_PATH', '.cache/llm_responses.sqlite')),
+            scheduler=request_scheduler(),
+            metrics=state["metrics"],
+            client=client,
+            async_client=async_client,
+            router=model_router()
+        )
+        state["llm_provider"] = llm_provider
+        state["agents"] = None
+    return llm_provider
+
+def session_agents(state: MutableMapping[str, Any]) -> Agents:
+    llm_provider = session_provider(state)
+    if state.get("agents") is None:
+        state["agents"] = Agents.create(llm_provider)
+    return state["agents"]
+
+def session_speculator(state: MutableMapping[str, Any]) -> Speculator:
+    """
+    The session's speculator, counting its tokens in the session's metrics.
+    """
+    session_provider(state)
+    speculator = state.get("speculator")
+    if speculator is None or speculator.metrics is not state["metrics"]:
+        speculator = Speculator(event_loop(), state["metrics"])
+        state["speculator"] = speculator
+    return speculator
@@ -0,0 +1,187 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from collections import Counter
+from dataclasses import dataclass
+import math
+import re
+import threading
+
+from utils.tokens import estimate_tokens
+
+# Passages are paragraphs, merged or split to stay near this size
+MAX_PASSAGE_TOKENS = 160
+MIN_PASSAGE_TOKENS = 40
+# Tokens of retrieved passages an agent may add to its prompt
+PASSAGE_TOKEN_BUDGET = 600
+
+_WORD = re.compile(r"[a-z0-9']+")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have having
+he her here hers herself him himself his how i if in into is it its itself just me more most my myself no
+nor not now of off on once only or other our ours out over own same she should so some such than that the
+their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours
+""".split())
+
+@dataclass(frozen=True)
+class Passage:
+    chapter: int
+    index: int
+    text: str
+    tokens: int
+
+class RetrievalIndex:
+    """
+    Offline BM25 index over the paragraphs of generated chapters, so agents can
+    look up what earlier chapters said about a character, place or object.
+    Chapters are added one at a time as they land; adding a chapter again
+    replaces its passages.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._passages: Dict[Tuple[int, int], Passage] = {}
+        self._term_counts: Dict[Tuple[int, int], Counter] = {}
+        # Passage lengths in terms, for BM25's length normalization
+        self._lengths: Dict[Tuple[int, int], int] = {}
+        self._postings: Dict[str, Dict[Tuple[int, int], int]] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_chapters(cls, chapters: Iterable[str]) -> "RetrievalIndex":
+        index = cls()
+        index.sync(chapters)
+        return index
+
+    @property
+    def chapters(self) -> List[int]:
+        with self._lock:
+            return sorted({chapter for chapter, _ in self._passages})
+
+    def sync(self, chapters: Iterable[str]):
+        """
+        Index the chapters of a 1-based list that are not indexed yet.
+        """
+        indexed = set(self.chapters)
+        for number, text in enumerate(chapters, start=1):
+            if number not in indexed:
+                self.add_chapter(number, text)
+
+    def add_chapter(self, chapter: int, text: str):
+        passages = [
+            Passage(chapter, index, passage, estimate_tokens(passage))
+            for index, passage in enumerate(split_passages(text))
+        ]
+        with self._lock:
+            self._remove_chapter(chapter)
+            for passage in passages:
+                key = (passage.chapter, passage.index)
+                counts = Counter(_terms(passage.text))
+                self._passages[key] = passage
+                self._term_counts[key] = counts
+                self._lengths[key] = sum(counts.values())
+                self._total_length += self._lengths[key]
+                for term, count in counts.items():
+                    self._postings.setdefault(term, {})[key] = count
+
+    def remove_chapter(self, chapter: int):
+        with self._lock:
+            self._remove_chapter(chapter)
+
+    def search(self, query: str, k: int = 5, before_chapter: Optional[int] = None) -> List[Tuple[float, Passage]]:
+        """
+        Top-k passages by BM25 score, optionally only from chapters before before_chapter.
+        """
+        terms = set(_terms(query))
+        with self._lock:
+            if not self._passages or not terms:
+                return []
+            count = len(self._passages)
+            average_length = self._total_length / count
+            scores: Dict[Tuple[int, int], float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    if before_chapter is not None and key[0] >= before_chapter:
+                        continue
+                    norm = frequency + self.k1 * (1 - self.b + self.b * self._lengths[key] / average_length)
+                    scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / norm
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(score, self._passages[key]) for key, score in ranked]
+
+    def relevant_passages(
+        self,
+        query: str,
+        token_budget: int = PASSAGE_TOKEN_BUDGET,
+        k: int = 8,
+        before_chapter: Optional[int] = None
+    ) -> str:
+        """
+        The best passages that fit in token_budget, rendered in story order.
+        Empty when nothing relevant is indexed.
+        """
+        chosen = []
+        used = 0
+        for _, passage in self.search(query, k, before_chapter):
+            if used + passage.tokens > token_budget:
+                continue
+            chosen.append(passage)
+            used += passage.tokens
+        chosen.sort(key=lambda passage: (passage.chapter, passage.index))
+        return "\n".join(f"[Chapter {passage.chapter}] {passage.text}" for passage in chosen)
+
+    def _remove_chapter(self, chapter: int):
+        for key in [key for key in self._passages if key[0] == chapter]:
+            counts = self._term_counts.pop(key)
+            self._total_length -= self._lengths.pop(key)
+            for term in counts:
+                postings = self._postings[term]
+                del postings[key]
+                if not postings:
+                    del self._postings[term]
+            del self._passages[key]
+
+def split_passages(text: str) -> List[str]:
+    """
+    Paragraphs of a chapter, short ones merged with the next and long ones cut
+    at sentence boundaries, so passages are of comparable size.
+    """
+    passages = []
+    pending = ""
+    for paragraph in re.split(r"\n\s*\n|\n", text.strip()):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) > MAX_PASSAGE_TOKENS:
+            if pending:
+                passages.append(pending)
+                pending = ""
+            passages.extend(_split_sentences(paragraph))
+            continue
+        pending = f"{pending} {paragraph}".strip()
+        if estimate_tokens(pending) >= MIN_PASSAGE_TOKENS:
+            passages.append(pending)
+            pending = ""
+    if pending:
+        passages.append(pending)
+    return passages
+
+def _split_sentences(paragraph: str) -> List[str]:
+    passages = []
+    current = ""
+    for sentence in _SENTENCE_END.split(paragraph):
+        if current and estimate_tokens(current) + estimate_tokens(sentence) > MAX_PASSAGE_TOKENS:
+            passages.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        passages.append(current)
+    return passages
+
+def _terms(text: str) -> List[str]:
+    return [word for word in _WORD.findall(text.lower()) if len(word) > 2 and word not in _STOPWORDS]
@@ -0,0 +1,60 @@
+from typing import List
+from dataclasses import dataclass
+import re
+
+# Layouts that split into fewer or more scenes than this are written in one pass
+MIN_SCENES = 2
+MAX_SCENES = 8
+
+# "Scene 2: The Harbour", "**Scene 2 - The Harbour**", "### Scene 2"
+_SCENE_HEADING = re.compile(r"^[\s#*_>]*scene\s+(\d+)\b[\s*_]*[:.\-–—]?\s*(.*)$", re.IGNORECASE)
+# "2. The Harbour", "**2) The Harbour**", used when no line says "Scene"
+_NUMBERED_HEADING = re.compile(r"^[#*_\s]*(\d+)[.)][\s*_]+(.*)$")
+
+@dataclass
+class Scene:
+    number: int
+    title: str
+    outline: str
+
+    @property
+    def handoff(self) -> str:
+        """
+        The scene in a line or two, for the writers of its neighbours.
+        """
+        text = f"{self.title}: {self.outline}" if self.title else self.outline
+        text = " ".join(text.split())
+        return text if len(text) <= 400 else text[:400].rsplit(" ", 1)[0] + "..."
+
+def parse_scenes(scene_layout: str) -> List[Scene]:
+    """
+    Split a planner's free-text layout into its scenes. Lines before the first
+    heading are dropped; an empty list means the layout has no recognisable
+    scene structure.
+    """
+    lines = scene_layout.splitlines()
+    scenes = _split(lines, _SCENE_HEADING)
+    if len(scenes) < MIN_SCENES:
+        # Numbered lists may also be details inside a scene, so only as a fallback
+        scenes = _split(lines, _NUMBERED_HEADING)
+    return scenes
+
+def _split(lines: List[str], heading: re.Pattern) -> List[Scene]:
+    scenes: List[Scene] = []
+    outline: List[str] = []
+    for line in lines:
+        match = heading.match(line)
+        if match:
+            if scenes:
+                scenes[-1].outline = "\n".join(outline).strip()
+            outline = []
+            title = match.group(2).strip().strip("*_#:").strip()
+            scenes.append(Scene(number=len(scenes) + 1, title=title, outline=""))
+        elif scenes:
+            outline.append(line)
+    if scenes:
+        scenes[-1].outline = "\n".join(outline).strip()
+    scenes = [scene for scene in scenes if scene.title or scene.outline]
+    for number, scene in enumerate(scenes, start=1):
+        scene.number = number
+    return scenes
@@ -0,0 +1,198 @@
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union, get_args, get_origin, get_type_hints
+import dataclasses
+import json
+import re
+
+T = TypeVar("T")
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"'})
+
+class StructuredOutputError(ValueError):
+    """
+    Raised when a response cannot be parsed or validated against its schema,
+    even after local repair and a re-ask.
+    """
+    def __init__(self, message: str, response: str = "", errors: Optional[List[str]] = None):
+        super().__init__(message)
+        self.response = response
+        self.errors = errors or []
+
+def repair_json(text: str) -> str:
+    """
+    Cheap fixes for the ways models usually break JSON: code fences, prose
+    before or after the object, smart quotes, trailing commas and brackets
+    left open by a cut-off response.
+    """
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    if starts:
+        text = text[min(starts):]
+    text = text.translate(_SMART_QUOTES)
+    text = _TRAILING_COMMA.sub(r"\1", text.strip())
+    return _balance(text)
+
+def parse_json(text: str) -> Tuple[Any, bool]:
+    """
+    The JSON value in text and whether it needed repair. Raises StructuredOutputError.
+    """
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(text)), True
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"Response is not valid JSON: {e}", text, [str(e)]) from e
+
+def validate(data: Any, schema: Type[T]) -> T:
+    """
+    Check parsed JSON against a dataclass schema and build the instance.
+    Keys the schema does not name are ignored, fields with defaults may be
+    missing. Raises StructuredOutputError listing every mismatch.
+    """
+    errors: List[str] = []
+    value = _convert(data, schema, "$", errors)
+    if errors:
+        raise StructuredOutputError(f"Response does not match {_type_name(schema)}: {'; '.join(errors)}", errors=errors)
+    return value
+
+def parse_structured(text: str, schema: Type[T]) -> Tuple[T, bool]:
+    """
+    Parse and validate a response; returns the instance and whether it needed repair.
+    """
+    data, repaired = parse_json(text)
+    try:
+        return validate(data, schema), repaired
+    except StructuredOutputError as e:
+        e.response = text
+        raise
+
+def schema_description(schema: Any) -> str:
+    """
+    Compact JSON-like outline of a schema, for re-ask prompts.
+    """
+    if dataclasses.is_dataclass(schema):
+        hints = get_type_hints(schema)
+        fields = ", ".join(f'"{field.name}": {schema_description(hints[field.name])}' for field in dataclasses.fields(schema))
+        return "{" + fields + "}"
+    origin = get_origin(schema)
+    if origin in (list, List):
+        return f"[{schema_description(get_args(schema)[0])}, ...]"
+    if origin in (dict, Dict):
+        return f"{{string: {schema_description(get_args(schema)[1])}}}"
+    if origin is Union:
+        return " | ".join(schema_description(arg) for arg in get_args(schema))
+    return _type_name(schema)
+
+def reask_messages(schema: Any, response: str, errors: List[str]) -> List[Dict[str, str]]:
+    """
+    Short follow-up asking the model to fix its own output, much cheaper than
+    regenerating it from the original prompt.
+    """
+    return [
+        {
+            "role": "system",
+            "content": "You fix JSON documents so they match a schema. Keep the content, change only what the errors point at. Respond with only the corrected JSON."
+        },
+        {
+            "role": "user",
+            "content": f"Schema: {schema_description(schema)}\n\nErrors: {'; '.join(errors)}\n\nJSON to fix:\n{response}"
+        }
+    ]
+
+def _convert(value: Any, schema: Any, path: str, errors: List[str]) -> Any:
+    if schema is Any:
+        return value
+    if dataclasses.is_dataclass(schema):
+        if not isinstance(value, dict):
+            errors.append(f"{path} should be an object")
+            return None
+        hints = get_type_hints(schema)
+        kwargs = {}
+        for field in dataclasses.fields(schema):
+            if field.name in value and value[field.name] is not None:
+                kwargs[field.name] = _convert(value[field.name], hints[field.name], f"{path}.{field.name}", errors)
+            elif field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+                errors.append(f"{path}.{field.name} is missing")
+        return None if errors else schema(**kwargs)
+
+    origin = get_origin(schema)
+    if origin is Union:
+        options = [arg for arg in get_args(schema) if arg is not type(None)]
+        if value is None:
+            return None
+        for option in options:
+            option_errors: List[str] = []
+            converted = _convert(value, option, path, option_errors)
+            if not option_errors:
+                return converted
+        errors.append(f"{path} should be {_type_name(schema)}")
+        return None
+    if origin in (list, List):
+        if not isinstance(value, list):
+            errors.append(f"{path} should be a list")
+            return None
+        item_type = get_args(schema)[0] if get_args(schema) else Any
+        return [_convert(item, item_type, f"{path}[{index}]", errors) for index, item in enumerate(value)]
+    if origin in (dict, Dict):
+        if not isinstance(value, dict):
+            errors.append(f"{path} should be an object")
+            return None
+        value_type = get_args(schema)[1] if get_args(schema) else Any
+        return {str(key): _convert(item, value_type, f"{path}.{key}", errors) for key, item in value.items()}
+
+    if schema is str:
+        # Numbers are fine where text is expected, objects and lists are not
+        if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            return str(value)
+    elif schema is bool:
+        if isinstance(value, bool):
+            return value
+    elif schema is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            return int(value)
+    elif schema is float:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif isinstance(value, schema):
+        return value
+    errors.append(f"{path} should be {_type_name(schema)}, got {type(value).__name__}")
+    return None
+
+def _type_name(schema: Any) -> str:
+    names = {str: "string", int: "integer", float: "number", bool: "boolean", Any: "any"}
+    return names.get(schema, getattr(schema, "__name__", str(schema)))
+
+def _balance(text: str) -> str:
+    # Close strings and brackets a truncated response left open, and drop
+    # anything after the outermost value closes
+    stack = []
+    in_string = False
+    escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+            if not stack:
+                return text[:index + 1]
+    if in_string:
+        text += '"'
+    text = _TRAILING_COMMA.sub(r"\1", text.rstrip().rstrip(","))
+    return text + "".join(reversed(stack))
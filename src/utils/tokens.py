@@ -0,0 +1,20 @@
+from typing import List, Dict
+import math
+
+# Llama tokenizers average roughly four characters of English prose per token.
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate, good enough for budgeting and rate limiting.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(
+        estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )